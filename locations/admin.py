@@ -1,8 +1,10 @@
 from django.contrib import admin
 from django.conf.urls.defaults import patterns, url
 from django.contrib.auth.decorators import permission_required
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, ugettext_lazy
 
+# Registers the custom admin filter specs
+from locations import filters
 from locations.models import Location, LocationCategory
 from locations.views import CsvUpload
 from locations.exceptions import LocationEncodingError
@@ -47,7 +49,8 @@ class LocationAdmin(admin.ModelAdmin):
                 }),
             )
 
-    actions = ['geocode_address', 'toggle_active_status']
+    actions = ['geocode_address', 'toggle_active_status',
+            'activate_locations', 'deactivate_locations', 'deactivate_uploads']
 
     def geocode_address(self, request, queryset):
         """
@@ -76,21 +79,52 @@ class LocationAdmin(admin.ModelAdmin):
     def toggle_active_status(self, request, queryset):
         """
         Makes the status of each selected location the opposite of its current
-        status
+        status, using one UPDATE for the locations being activated and one for
+        those being deactivated.
         """
-        active_count = 0
-        inactive_count = 0
-        for location in queryset:
-            location.is_active = not location.is_active
-            if location.is_active:
-                active_count += 1
-            else:
-                inactive_count += 1
-            location.save()
+        statuses = queryset.values_list('pk', 'is_active')
+        activate = [pk for pk, is_active in statuses if not is_active]
+        deactivate = [pk for pk, is_active in statuses if is_active]
+        active_count = Location.objects.bulk_update(activate, is_active=True)
+        inactive_count = Location.objects.bulk_update(deactivate,
+                is_active=False)
         self.message_user(request,
             "%(active)s locations made active, %(inactive)s locations made inactive." % {
                 'active': active_count, 'inactive': inactive_count})
 
+    def activate_locations(self, request, queryset):
+        """Makes all of the selected locations active"""
+        rows_updated = Location.objects.bulk_update(
+                queryset.filter(is_active=False).values_list('pk', flat=True),
+                is_active=True)
+        self.message_user(request, "%s locations made active." % rows_updated)
+    activate_locations.short_description = ugettext_lazy("Activate selected locations")
+
+    def deactivate_locations(self, request, queryset):
+        """Makes all of the selected locations inactive"""
+        rows_updated = Location.objects.bulk_update(
+                queryset.filter(is_active=True).values_list('pk', flat=True),
+                is_active=False)
+        self.message_user(request,
+                "%s locations made inactive." % rows_updated)
+    deactivate_locations.short_description = ugettext_lazy(
+            "Deactivate selected locations")
+
+    def deactivate_uploads(self, request, queryset):
+        """
+        Makes every location from the same CSV uploads as the selected
+        locations inactive.
+        """
+        upload_counts = set(queryset.values_list('upload_count', flat=True))
+        rows_updated = Location.objects.bulk_update(
+                Location.objects.filter(upload_count__in=upload_counts,
+                    is_active=True).values_list('pk', flat=True),
+                is_active=False)
+        self.message_user(request,
+                "%s locations made inactive." % rows_updated)
+    deactivate_uploads.short_description = ugettext_lazy(
+            "Deactivate all locations from the selected uploads")
+
     def get_urls(self):
         urls = super(LocationAdmin, self).get_urls()
         my_urls = patterns('',
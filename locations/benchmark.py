@@ -0,0 +1,436 @@
+"""
+Benchmark harness for the locations app's hot paths.
+
+Generates a synthetic data set of locations with realistic state, postal code,
+category and coordinate distributions, times the search, import and feed code
+paths against it, and compares the results with a stored baseline.
+
+The benchmarks are run through the `benchmark_locations` management command,
+which uses a throwaway test database. Run it with settings pointing at SQLite
+or PostgreSQL to compare the backends.
+"""
+import gc
+import itertools
+from datetime import datetime
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+from django.conf import settings
+from django.db import connection, reset_queries, transaction
+from django.test.client import RequestFactory
+from django.utils import simplejson as json
+
+from postalcodes.models import PostalCode
+
+from locations import geo
+from locations.cache import bump_generation
+from locations.models import Location, LocationCategory
+
+
+# (state, weight, latitude, longitude, spread in degrees, zip prefix)
+STATES = (
+    ('CA', 120, 36.17, -119.75, 3.0, '9'),
+    ('TX', 80, 31.05, -97.56, 3.5, '7'),
+    ('FL', 60, 27.77, -81.69, 2.0, '3'),
+    ('NY', 60, 42.17, -74.95, 1.5, '1'),
+    ('PA', 40, 40.59, -77.21, 1.5, '1'),
+    ('IL', 40, 40.35, -88.99, 1.5, '6'),
+    ('OH', 35, 40.39, -82.76, 1.2, '4'),
+    ('GA', 30, 33.04, -83.64, 1.5, '3'),
+    ('NC', 30, 35.63, -79.81, 1.5, '2'),
+    ('VA', 30, 37.77, -78.17, 1.2, '2'),
+    ('MD', 20, 39.06, -76.80, 0.6, '2'),
+    ('DC', 10, 38.90, -77.03, 0.05, '2'),
+    ('WA', 25, 47.40, -121.49, 1.5, '9'),
+    ('CO', 20, 39.06, -105.31, 1.5, '8'),
+    ('LA', 15, 31.17, -91.87, 1.2, '7'),
+    ('AK', 5, 61.37, -152.40, 6.0, '9'),
+)
+
+# (name, weight)
+CATEGORIES = (
+    ('Restaurant', 50),
+    ('Retail', 35),
+    ('Bar', 25),
+    ('Grocery', 10),
+    ('Stadium', 1),
+)
+
+
+def weighted_choice(rng, choices):
+    total = sum([choice[1] for choice in choices])
+    point = rng.uniform(0, total)
+    for choice in choices:
+        point -= choice[1]
+        if point <= 0:
+            return choice
+    return choices[-1]
+
+
+def synthetic_rows(count, seed=0, prefix="Location"):
+    """
+    Yields dictionaries of synthetic location data. About 5% of the rows are
+    inactive and 10% are not geocoded.
+    """
+    rng = random.Random(seed)
+    for counter in xrange(count):
+        state, weight, lat, lng, spread, zip_prefix = weighted_choice(rng,
+                STATES)
+        postal_code = "%s%04d" % (zip_prefix, rng.randint(0, 9999))
+        geocoded = rng.random() > 0.1
+        yield {
+            'name': "%s %s" % (prefix, counter),
+            'street_address': "%s Main St" % rng.randint(1, 9999),
+            'city': "City %s" % rng.randint(1, 200),
+            'state': state,
+            'postal_code': postal_code,
+            'latitude': geocoded and round(rng.gauss(lat, spread / 2), 6) or None,
+            'longitude': geocoded and round(rng.gauss(lng, spread), 6) or None,
+            'is_active': rng.random() > 0.05,
+            'category': weighted_choice(rng, CATEGORIES)[0],
+        }
+
+
+@transaction.commit_on_success
+def generate_locations(count, seed=0):
+    """
+    Inserts `count` synthetic locations, their categories and postal codes.
+
+    Rows are inserted in batches with raw SQL rather than saved one at a time,
+    which would dominate the setup time of large data sets.
+    """
+    rows = list(synthetic_rows(count, seed))
+    categories = {}
+    for name, weight in CATEGORIES:
+        categories[name], created = LocationCategory.objects.get_or_create(
+                name=name, defaults={'slug': name.lower()})
+    masks = dict([(name, 0 if category.bit is None else 1 << category.bit)
+        for name, category in categories.items()])
+    cursor = connection.cursor()
+    version = Location.objects.next_version()
+    modified = datetime.now()
+    cursor.executemany("INSERT INTO %s (original_name, name, street_address, "
+            "city, state, postal_code, latitude, longitude, url, description, "
+            "is_active, upload_count, version, created_version, modified, "
+            "category_mask) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, '', "
+            "'', %%s, 0, %s, %s, %%s, %%s)" % (Location._meta.db_table, version,
+                version), [(
+                row['name'], row['name'], row['street_address'], row['city'],
+                row['state'], row['postal_code'], row['latitude'],
+                row['longitude'], row['is_active'], modified,
+                masks[row['category']]) for row in rows])
+    ids = dict(Location.objects.filter(original_name__in=[row['name'] for row
+        in rows]).values_list('original_name', 'id'))
+    through = Location.category.through
+    cursor.executemany("INSERT INTO %s (location_id, locationcategory_id) "
+            "VALUES (%%s, %%s)" % through._meta.db_table, [
+                (ids[row['name']], categories[row['category']].id)
+                for row in rows])
+    postal_codes = {}
+    for row in rows:
+        if row['latitude'] is not None:
+            postal_codes.setdefault(row['postal_code'],
+                    (row['latitude'], row['longitude']))
+    existing = set(PostalCode.objects.values_list('code', flat=True))
+    for code, (latitude, longitude) in postal_codes.items():
+        if code not in existing:
+            PostalCode.objects.create(code=code, latitude=str(latitude),
+                    longitude=str(longitude))
+    bump_generation()
+    return rows
+
+
+def synthetic_csv(count, seed=0, prefix="Location"):
+    """Returns a file-like CSV upload of synthetic locations"""
+    lines = [u'"%(name)s","%(street_address)s","%(city)s","%(state)s",'
+            u'"%(postal_code)s"' % row for row in
+            synthetic_rows(count, seed, prefix)]
+    return StringIO("\r\n".join(lines).encode('cp1252'))
+
+
+def current_memory():
+    """
+    Returns the resident set size of the process in kilobytes, or None where
+    it cannot be read from /proc.
+    """
+    try:
+        statm = open('/proc/self/statm').read()
+    except IOError:
+        return None
+    return int(statm.split()[1]) * resource.getpagesize() // 1024
+
+
+def peak_memory(func, interval=0.001):
+    """
+    Calls `func` and returns the peak growth of the resident set size during
+    the call in kilobytes, sampled every `interval` seconds by another
+    thread, or None where the resident set size cannot be read.
+
+    Unlike the process' lifetime peak (`ru_maxrss`), which stays put once an
+    earlier call has raised it, this is the memory the call itself takes.
+    Memory the process had already freed and reuses does not count, so
+    garbage is collected first.
+    """
+    gc.collect()
+    start = current_memory()
+    if start is None:
+        func()
+        return None
+    samples = [start]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            samples.append(current_memory())
+            done.wait(interval)
+
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+    try:
+        func()
+    finally:
+        done.set()
+        sampler.join()
+    samples.append(current_memory())
+    return max(samples) - start
+
+
+def measure(name, func, repeat=3):
+    """
+    Calls `func` `repeat` times and returns a dictionary with the best and
+    mean wall time in seconds and the number of queries of one call. The
+    peak memory growth of a call, see `peak_memory`, is measured on one more
+    call, so that sampling does not slow down the timed ones.
+    """
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    times = []
+    queries = None
+    try:
+        for counter in range(repeat):
+            reset_queries()
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+            if queries is None:
+                queries = len(connection.queries)
+        memory = peak_memory(func)
+    except Exception, e:
+        return {'name': name, 'error': u"%s: %s" % (e.__class__.__name__, e)}
+    finally:
+        settings.DEBUG = debug
+        reset_queries()
+    return {
+        'name': name,
+        'best': min(times),
+        'mean': sum(times) / len(times),
+        'queries': queries,
+        'peak_memory_kb': memory,
+    }
+
+
+def benchmark_cases(rows):
+    """
+    Returns a list of (name, callable) benchmarks for the generated rows.
+    """
+    from locations.utils import locations_from_csv
+    from locations.views import LocationListView, LocationKMLFeed
+
+    factory = RequestFactory()
+    geocoded = [row for row in rows if row['latitude'] is not None]
+    sample = geocoded[len(geocoded) // 2]
+    latlng = "%s,%s" % (sample['latitude'], sample['longitude'])
+    category = LocationCategory.objects.all()[0]
+    list_view = LocationListView.as_view(
+            template_name="locations/location_list.html")
+
+    def geosearch(query):
+        return lambda: list(Location.objects.geosearch(query)[:25])
+
+    def render(view_func, path):
+        def call():
+            response = view_func(factory.get(path))
+            if hasattr(response, 'render'):
+                response.render()
+            return response
+        return call
+
+    uploads = itertools.count()
+
+    def import_csv():
+        upload = "Upload %s" % uploads.next()
+        locations_from_csv(synthetic_csv(200, seed=len(rows), prefix=upload),
+                category)
+
+    return [
+        ('geosearch_postal_code', geosearch(sample['postal_code'])),
+        ('geosearch_latlng', geosearch(latlng)),
+        ('list_html', render(list_view, "/?paginate_by=25")),
+        ('list_html_postal_code', render(list_view,
+            "/?geo_query=%s&limit=25" % sample['postal_code'])),
+        ('list_json', render(list_view, "/?format=json&limit=100")),
+        ('list_json_postal_code', render(list_view,
+            "/?format=json&geo_query=%s&limit=25" % sample['postal_code'])),
+        ('kml_feed', render(LocationKMLFeed.as_view(), "/locations.kml")),
+        ('import_csv_200', import_csv),
+        ('state_choices', Location.objects.state_choices),
+    ]
+
+
+def geo_benchmark_cases(rows):
+    """
+    Returns (name, callable) benchmarks comparing the batched operations of
+    `locations.geo` with the equivalent per-point Python loops.
+    """
+    points = [(row['latitude'], row['longitude']) for row in rows
+            if row['latitude'] is not None]
+    latitude, longitude = points[len(points) // 2]
+
+    def centroid_loop():
+        lat = 0
+        lng = 0
+        for point in points:
+            lat += point[0]
+            lng += point[1]
+        return (lat / len(points), lng / len(points))
+
+    def distances_loop():
+        return sorted([geo.haversine(latitude, longitude, lat, lng)
+            for lat, lng in points])[:25]
+
+    def coordinates():
+        return geo.Coordinates.from_points(points)
+
+    buffer = coordinates()
+    return [
+        ('geo_centroid_loop', centroid_loop),
+        ('geo_centroid', lambda: geo.centroid(buffer)),
+        ('geo_coordinates', coordinates),
+        ('geo_distances_loop', distances_loop),
+        ('geo_k_nearest', lambda: geo.k_nearest(latitude, longitude,
+            buffer, 25)),
+    ]
+
+
+# Modules imported when a worker boots or a management command runs
+IMPORT_MODULES = ('locations.models', 'locations.forms', 'locations.views',
+        'locations.urls', 'locations.utils', 'locations.admin')
+
+IMPORT_SCRIPT = """
+import resource, sys, time
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson
+settings.DEBUG = True
+memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+for module in sys.argv[1:]:
+    __import__(module)
+sys.stdout.write(simplejson.dumps([time.time() - start,
+    len(connection.queries), sorted([name for name in sys.modules
+        if name.split('.')[0] in ('googlemaps', 'django_google_maps',
+            'numpy')]),
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory]))
+"""
+
+
+def import_benchmark(modules=IMPORT_MODULES):
+    """
+    Imports the modules in a fresh interpreter and returns a dictionary with
+    the import time in seconds, the number of queries run during the import,
+    which must be zero, the optional heavy dependencies loaded and the
+    memory taken by the imports. As the interpreter is fresh, the growth of
+    its peak resident set size is that of the imports alone.
+    """
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT] +
+            list(modules), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=environment)
+    output, errors = process.communicate()
+    if process.returncode:
+        raise RuntimeError("Importing failed:\n%s" % errors)
+    seconds, queries, dependencies, memory = json.loads(output)
+    return {
+        'name': 'import',
+        'best': seconds,
+        'mean': seconds,
+        'queries': queries,
+        'peak_memory_kb': memory,
+        'optional_dependencies': dependencies,
+    }
+
+
+def csv_benchmark(count, seed=0, repeat=3):
+    """
+    Measures the parsing of a CSV file of `count` synthetic locations on disk
+    and adds the throughput in rows per second to the result.
+    """
+    from locations.utils import read_csv
+
+    csv_file = tempfile.TemporaryFile()
+    try:
+        csv_file.write(synthetic_csv(count, seed).getvalue())
+        result = measure('csv_parse_%s' % count, lambda: read_csv(csv_file),
+                repeat)
+    finally:
+        csv_file.close()
+    if result.get('best'):
+        result['rows_per_second'] = count / result['best']
+    return result
+
+
+def run_benchmarks(count, seed=0, repeat=3):
+    """
+    Generates `count` locations and returns the benchmark results as a
+    dictionary which can be serialized to JSON.
+    """
+    rows = generate_locations(count, seed)
+    results = [import_benchmark(), csv_benchmark(max(count, 10000), seed,
+        repeat)]
+    results.extend([measure(name, func, repeat) for name, func in
+            benchmark_cases(rows) + geo_benchmark_cases(rows)])
+    return {
+        'engine': settings.DATABASES['default']['ENGINE'],
+        'numpy': geo.get_numpy() is not None,
+        'count': count,
+        'seed': seed,
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns a list of messages describing regressions of the results against
+    the baseline: best wall times slower by more than `tolerance` (a fraction)
+    and any increase in the number of queries.
+    """
+    previous = dict([(result['name'], result) for result in
+        baseline.get('results', [])])
+    regressions = []
+    for result in results['results']:
+        before = previous.get(result['name'])
+        if before is None or 'error' in before:
+            continue
+        if 'error' in result:
+            regressions.append("%s failed: %s" % (result['name'],
+                result['error']))
+            continue
+        if result['best'] > before['best'] * (1 + tolerance):
+            regressions.append("%s took %.4fs, baseline %.4fs" % (
+                result['name'], result['best'], before['best']))
+        if result['queries'] > before['queries']:
+            regressions.append("%s ran %s queries, baseline %s" % (
+                result['name'], result['queries'], before['queries']))
+    return regressions
+
+
+def dumps(results):
+    return json.dumps(results, indent=2, sort_keys=True)
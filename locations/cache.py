@@ -0,0 +1,51 @@
+"""
+Cache helpers for the locations app.
+
+Cached location data is keyed by a data "generation", a counter stored in the
+cache which is bumped whenever a location changes. Bumping the generation
+invalidates every dependent cache entry at once without having to track the
+individual keys.
+
+Rendered location fragments are instead keyed by each location's version, so
+a change only re-renders that location, plus a separate category generation
+bumped when categories or category memberships change.
+"""
+import time
+
+from django.core.cache import cache
+
+
+GENERATION_KEY = 'locations:generation'
+CATEGORY_GENERATION_KEY = 'locations:category_generation'
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def get_generation(key=GENERATION_KEY):
+    """Returns the current data generation"""
+    generation = cache.get(key)
+    if generation is None:
+        # Seed from the clock so that a lost counter never reuses the
+        # generation of entries which may still be cached.
+        generation = int(time.time())
+        cache.add(key, generation, GENERATION_TIMEOUT)
+        generation = cache.get(key, generation)
+    return generation
+
+
+def bump_generation(key=GENERATION_KEY):
+    """Increments the data generation, invalidating dependent entries"""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        generation = int(time.time())
+        cache.set(key, generation, GENERATION_TIMEOUT)
+        return generation
+
+
+def generation_key(*parts):
+    """
+    Returns a cache key for the given parts which is scoped to the current
+    data generation.
+    """
+    return "locations:%s:%s" % (get_generation(),
+            ":".join([str(part) for part in parts]))
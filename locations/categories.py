@@ -0,0 +1,111 @@
+"""
+Denormalized category membership of locations.
+
+Each category is assigned one bit of the `Location.category_mask` column,
+which holds the bits of all the categories of a location and is kept in sync
+with the `category` many-to-many relation by the models' signal handlers.
+Category filters then become a single-table predicate rather than a join,
+and category labels are resolved from the mask with the in-memory category
+table instead of a query.
+
+Only the first `MAX_CATEGORY_BITS` categories are assigned a bit. Filters on
+categories without a bit fall back to joining the many-to-many table.
+"""
+from locations.cache import get_generation, CATEGORY_GENERATION_KEY
+from locations.managers import BULK_UPDATE_BATCH_SIZE
+
+
+# The mask is a signed 64-bit integer column
+MAX_CATEGORY_BITS = 63
+
+_table = (None, {})
+
+
+def category_table():
+    """
+    Returns a dictionary of all the categories by id, kept in memory until
+    the category generation changes.
+    """
+    global _table
+    from locations.models import LocationCategory
+    generation = get_generation(CATEGORY_GENERATION_KEY)
+    if _table[0] != generation:
+        _table = (generation, dict([(category.pk, category) for category in
+            LocationCategory.objects.order_by('id')]))
+    return _table[1]
+
+
+def free_bit():
+    """Returns the lowest bit not assigned to a category, or None"""
+    from locations.models import LocationCategory
+    used = set(LocationCategory.objects.exclude(bit=None).values_list('bit',
+        flat=True))
+    for bit in range(MAX_CATEGORY_BITS):
+        if bit not in used:
+            return bit
+    return None
+
+
+def category_mask(category_ids):
+    """
+    Returns the mask of the categories with the given ids, or None if any of
+    them has no bit. Unknown ids are ignored.
+    """
+    table = category_table()
+    mask = 0
+    for pk in category_ids:
+        category = table.get(int(pk))
+        if category is None:
+            continue
+        if category.bit is None:
+            return None
+        mask |= 1 << category.bit
+    return mask
+
+
+def categories_from_mask(mask):
+    """Returns the list of the categories in the mask, ordered by id"""
+    return [category for pk, category in sorted(category_table().items())
+            if category.bit is not None and mask >> category.bit & 1]
+
+
+def all_categories_have_bits():
+    return None not in [category.bit for category in
+            category_table().values()]
+
+
+def filter_categories(queryset, category_ids):
+    """
+    Returns the queryset narrowed down to the locations in any of the
+    categories with the given ids.
+    """
+    mask = category_mask(category_ids)
+    if mask is None:
+        return queryset.filter(category__id__in=category_ids).distinct()
+    return queryset.extra(where=["(%s.category_mask & %%s) != 0" %
+        queryset.model._meta.db_table], params=[mask])
+
+
+def update_category_masks(pks):
+    """
+    Recomputes the category masks of the locations with the given ids from
+    their many-to-many memberships, with one UPDATE per distinct mask.
+    """
+    from locations.models import Location
+    pks = list(pks)
+    table = category_table()
+    masks = dict([(pk, 0) for pk in pks])
+    for start in range(0, len(pks), BULK_UPDATE_BATCH_SIZE):
+        for location_id, category_id in Location.category.through.objects.filter(
+                location__in=pks[start:start + BULK_UPDATE_BATCH_SIZE]
+                ).values_list('location_id', 'locationcategory_id'):
+            category = table.get(category_id)
+            if category is not None and category.bit is not None:
+                masks[location_id] |= 1 << category.bit
+    groups = {}
+    for pk, mask in masks.items():
+        groups.setdefault(mask, []).append(pk)
+    for mask, group in groups.items():
+        for start in range(0, len(group), BULK_UPDATE_BATCH_SIZE):
+            Location.objects.filter(pk__in=group[start:start +
+                BULK_UPDATE_BATCH_SIZE]).update(category_mask=mask)
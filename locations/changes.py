@@ -0,0 +1,96 @@
+"""
+Incremental feed of location changes for sync clients.
+
+Every location is stamped with an increasing version on each save and bulk
+update (see `LocationManager.next_version`). Clients keep the version of the
+last change they saw and request everything after it. A bulk update stamps
+many locations with the same version, so the feed pages through changes by
+(version, id) and hands back both as the continuation cursor.
+"""
+from django.db.models import Q
+from django.utils import simplejson as json
+
+from locations.models import Location
+
+
+FIELDS = ('id', 'version', 'created_version', 'is_active', 'name',
+        'street_address', 'city', 'state', 'postal_code', 'latitude',
+        'longitude', 'url', 'description')
+
+
+def changed_after(version, last_id=None):
+    """
+    Returns a QuerySet of the locations after the (version, id) cursor. Without
+    an id the cursor covers the whole version.
+    """
+    condition = Q(version__gt=version)
+    if last_id is not None:
+        condition |= Q(version=version, id__gt=last_id)
+    return Location.objects.filter(condition).order_by('version', 'id')
+
+
+def change_batches(since, after=None, limit=5000, batch_size=500):
+    """
+    Yields lists of the value dictionaries of the locations changed after the
+    (since, after) cursor, at most `limit` in total, fetching `batch_size`
+    locations per query.
+    """
+    version, last_id = since, after
+    remaining = limit
+    while remaining > 0:
+        rows = list(changed_after(version, last_id).values(
+            *FIELDS)[:min(batch_size, remaining)])
+        if not rows:
+            break
+        memberships = {}
+        through = Location.category.through
+        for location_id, category_id in through.objects.filter(
+                location__in=[row['id'] for row in rows]).values_list(
+                'location_id', 'locationcategory_id'):
+            memberships.setdefault(location_id, []).append(category_id)
+        for row in rows:
+            row['categories'] = sorted(memberships.get(row['id'], []))
+        yield rows
+        version, last_id = rows[-1]['version'], rows[-1]['id']
+        remaining -= len(rows)
+        if len(rows) < batch_size:
+            break
+
+
+def change_record(row, since):
+    """Returns the JSON-serializable change record for a location row"""
+    if not row['is_active']:
+        operation = 'deactivated'
+    elif row['created_version'] > since:
+        operation = 'created'
+    else:
+        operation = 'updated'
+    record = dict(row, op=operation)
+    for field in ('latitude', 'longitude'):
+        if record[field] is not None:
+            record[field] = float(record[field])
+    return record
+
+
+def change_stream(since=-1, after=None, limit=5000, batch_size=500):
+    """
+    Yields the JSON document of the changes after the cursor in chunks, one
+    per batch, so large change sets are never held in memory at once:
+
+        {"since": 10, "changes": [...], "version": 12, "after": 250,
+         "more": false}
+
+    `version` and `after` are the cursor for the next request and `more`
+    tells whether the limit cut the changes short. The default cursor
+    fetches every location.
+    """
+    yield '{"since":%s,"changes":[' % json.dumps(since)
+    version, last_id, count = since, after, 0
+    for rows in change_batches(since, after, limit, batch_size):
+        yield (',' if count else '') + ','.join([json.dumps(
+            change_record(row, since)) for row in rows])
+        version, last_id = rows[-1]['version'], rows[-1]['id']
+        count += len(rows)
+    more = count >= limit and changed_after(version, last_id).exists()
+    yield '],"version":%s,"after":%s,"more":%s}' % (json.dumps(version),
+            json.dumps(last_id), json.dumps(more))
@@ -0,0 +1,176 @@
+"""
+Server-side marker clustering for map views.
+
+The globe is split in square tiles of 360 / 2 ** zoom degrees and each tile
+in a grid of `LOCATIONS_CLUSTER_GRID_SIZE` cells per side. The public,
+geocoded locations in a cell are aggregated into a single cluster with their
+count, centroid and bounds. Because cells never straddle tiles, the clusters
+of each tile are computed and cached independently, keyed by the tile, the
+zoom level and the filters.
+"""
+import hashlib
+import math
+
+from django.core.cache import cache
+
+from locations import conf, geo
+from locations.cache import generation_key
+from locations.categories import filter_categories
+from locations.models import Location
+
+
+class ClusterError(ValueError):
+    """For invalid cluster requests"""
+    pass
+
+
+def tile_size(zoom):
+    return 360.0 / 2 ** zoom
+
+
+def tiles_for_bbox(west, south, east, north, zoom):
+    """
+    Returns the (x, y) indexes of the tiles covering the bounding box. Boxes
+    whose west edge is east of their east edge cross the antimeridian.
+    """
+    size = tile_size(zoom)
+    columns = int(math.ceil(360.0 / size))
+    first_x = int(math.floor((west + 180) / size))
+    last_x = int(math.floor((east + 180) / size))
+    if east < west:
+        last_x += columns
+    xs = [x % columns for x in range(first_x, min(last_x, first_x + columns -
+        1) + 1)]
+    ys = range(int(math.floor((south + 90) / size)),
+            int(math.floor((min(north, 89.999999) + 90) / size)) + 1)
+    return [(x, y) for x in xs for y in ys]
+
+
+def point_tile(latitude, longitude, zoom):
+    """
+    Returns the (x, y) indexes of the tile containing the point. Longitudes
+    wrap around the antimeridian, so 180 falls in the first column, and the
+    north pole falls in the last row.
+    """
+    size = tile_size(zoom)
+    columns = int(math.ceil(360.0 / size))
+    rows = int(math.ceil(180.0 / size))
+    x = int((geo.normalize_longitude(longitude) + 180) // size) % columns
+    y = min(max(int((latitude + 90) // size), 0), rows - 1)
+    return x, y
+
+
+def tile_bounds(x, y, zoom):
+    """Returns the (south, west, north, east) bounds of the tile"""
+    size = tile_size(zoom)
+    west = x * size - 180
+    south = y * size - 90
+    return south, west, min(90.0, south + size), west + size
+
+
+def cluster_points(points, x, y, zoom, grid_size=None):
+    """
+    Aggregates the (id, name, latitude, longitude) points of a tile into
+    clusters and single points. Returns a (clusters, points) tuple.
+    """
+    grid_size = grid_size or conf.CLUSTER_GRID_SIZE
+    south, west, north, east = tile_bounds(x, y, zoom)
+    cell_size = tile_size(zoom) / grid_size
+    cells = {}
+    for point in points:
+        cell = (min(grid_size - 1, int((point[2] - south) / cell_size)),
+                min(grid_size - 1, int((point[3] - west) / cell_size)))
+        cells.setdefault(cell, []).append(point)
+    clusters = []
+    singles = []
+    for cell_points in cells.values():
+        if len(cell_points) == 1:
+            singles.extend(cell_points)
+            continue
+        coordinates = geo.Coordinates.from_points(
+                [point[2:] for point in cell_points])
+        clusters.append({
+            'latlng': geo.centroid(coordinates),
+            'count': len(cell_points),
+            'bounds': geo.bounds(coordinates),
+        })
+    return clusters, [{'id': pk, 'name': name, 'latlng': (lat, lng)}
+            for pk, name, lat, lng in singles]
+
+
+def filtered_locations(categories=None, states=None):
+    queryset = Location.objects.geocoded()
+    if states:
+        queryset = queryset.filter(state__in=states)
+    if categories:
+        queryset = filter_categories(queryset, categories)
+    return queryset
+
+
+def tile_key(x, y, zoom, categories, states):
+    # The filters come from the request and are hashed to stay valid in
+    # memcached keys
+    filters = repr((sorted(categories), sorted(states)))
+    return generation_key('clusters', zoom, x, y,
+            hashlib.md5(filters).hexdigest())
+
+
+def clusters(west, south, east, north, zoom, categories=(), states=()):
+    """
+    Returns a dictionary with the clusters and the single points of the
+    locations within the bounding box. At or above
+    `LOCATIONS_CLUSTER_POINTS_ZOOM` every location is returned as a point.
+
+    Cached tiles are read with one multi-get; the missing ones are computed
+    from a single query covering all of them.
+    """
+    if not (-90 <= south <= north <= 90) or not (-180 <= west <= 180) or \
+            not (-180 <= east <= 180):
+        raise ClusterError("Invalid bounding box")
+    if not 0 <= zoom <= 30:
+        raise ClusterError("Invalid zoom level")
+    tiles = tiles_for_bbox(west, south, east, north, zoom)
+    if len(tiles) > conf.CLUSTER_MAX_TILES:
+        raise ClusterError("The bounding box covers too many tiles")
+    categories = [str(category) for category in categories]
+    states = [str(state) for state in states]
+    keys = dict([(tile_key(x, y, zoom, categories, states), (x, y))
+        for x, y in tiles])
+    cached = cache.get_many(keys.keys())
+    missing = [keys[key] for key in keys if key not in cached]
+    if missing:
+        tile_points = dict([(tile, []) for tile in missing])
+        queryset = filtered_locations(categories, states)
+        bounds = [tile_bounds(x, y, zoom) for x, y in missing]
+        queryset = queryset.filter(
+                latitude__gte=str(min([bound[0] for bound in bounds])),
+                latitude__lte=str(max([bound[2] for bound in bounds])))
+        xs = set([x for x, y in missing])
+        if max(xs) - min(xs) + 1 == len(xs):
+            # Contiguous columns, i.e. not wrapping around the antimeridian
+            queryset = queryset.filter(
+                    longitude__gte=str(min([bound[1] for bound in bounds])),
+                    longitude__lte=str(max([bound[3] for bound in bounds])))
+        for pk, name, lat, lng in queryset.values_list('id', 'name',
+                'latitude', 'longitude'):
+            lat, lng = float(lat), float(lng)
+            tile = point_tile(lat, lng, zoom)
+            if tile in tile_points:
+                tile_points[tile].append((pk, name, lat, lng))
+        computed = {}
+        for key, tile in keys.items():
+            if tile in tile_points:
+                if zoom >= conf.CLUSTER_POINTS_ZOOM:
+                    computed[key] = [], [{'id': pk, 'name': name,
+                        'latlng': (lat, lng)} for pk, name, lat, lng in
+                        tile_points[tile]]
+                else:
+                    computed[key] = cluster_points(tile_points[tile], tile[0],
+                            tile[1], zoom)
+        cache.set_many(computed, conf.CLUSTER_CACHE_TIMEOUT)
+        cached.update(computed)
+    result = {'zoom': zoom, 'clusters': [], 'points': []}
+    for tile_clusters, tile_points in cached.values():
+        result['clusters'].extend(tile_clusters)
+        result['points'].extend(tile_points)
+    return result
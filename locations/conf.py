@@ -0,0 +1,124 @@
+"""
+Application settings for the locations app.
+
+Each setting can be overridden in the project settings module using the
+`LOCATIONS_` prefixed name.
+"""
+from django.conf import settings
+
+
+# Precision (number of characters) of the geohash cells used to cache
+# latitude/longitude proximity searches. `None` disables the cache.
+GEOHASH_PRECISION = getattr(settings, 'LOCATIONS_GEOHASH_PRECISION', None)
+
+# Number of nearest locations stored for each cached geohash cell.
+GEOHASH_CANDIDATES = getattr(settings, 'LOCATIONS_GEOHASH_CANDIDATES', 100)
+
+# Seconds to keep a cached geohash cell.
+GEOHASH_CACHE_TIMEOUT = getattr(settings, 'LOCATIONS_GEOHASH_CACHE_TIMEOUT',
+        60 * 60)
+
+# Answer postal code searches from the precomputed `NearestLocation` table.
+# Build the table with the `build_nearest_locations` command before enabling.
+POSTAL_NEAREST = getattr(settings, 'LOCATIONS_POSTAL_NEAREST', False)
+
+# Number of nearest locations stored for each postal code.
+POSTAL_NEAREST_COUNT = getattr(settings, 'LOCATIONS_POSTAL_NEAREST_COUNT', 50)
+
+# Radius in miles around a changed location within which the nearest
+# locations of postal codes are recomputed.
+POSTAL_NEAREST_RADIUS = getattr(settings, 'LOCATIONS_POSTAL_NEAREST_RADIUS',
+        100)
+
+# Snap latitude and longitude searches to the nearest postal code within this
+# many miles, found with the in-memory `locations.postalindex`, and answer
+# them as searches of that postal code, e.g. from the `NearestLocation`
+# table. `None` searches from the exact point.
+POSTAL_SNAP_DISTANCE = getattr(settings, 'LOCATIONS_POSTAL_SNAP_DISTANCE',
+        None)
+
+# Record per-phase timings of searches, feeds and imports.
+INSTRUMENTATION = getattr(settings, 'LOCATIONS_INSTRUMENTATION', False)
+
+# A callable, or its dotted path, called as `callback(phase, duration,
+# queries)` for every timed phase when instrumentation is enabled.
+METRICS_CALLBACK = getattr(settings, 'LOCATIONS_METRICS_CALLBACK', None)
+
+# Add a `Server-Timing` header with the phase timings to view responses when
+# instrumentation is enabled.
+SERVER_TIMING = getattr(settings, 'LOCATIONS_SERVER_TIMING', False)
+
+# Seconds to keep the cached distinct state choices.
+STATE_CHOICES_CACHE_TIMEOUT = getattr(settings,
+        'LOCATIONS_STATE_CHOICES_CACHE_TIMEOUT', 60 * 60)
+
+# Zoom level from which the cluster endpoint returns individual points.
+CLUSTER_POINTS_ZOOM = getattr(settings, 'LOCATIONS_CLUSTER_POINTS_ZOOM', 14)
+
+# Number of grid cells along each side of a cluster tile.
+CLUSTER_GRID_SIZE = getattr(settings, 'LOCATIONS_CLUSTER_GRID_SIZE', 8)
+
+# Maximum number of tiles a single cluster request may cover.
+CLUSTER_MAX_TILES = getattr(settings, 'LOCATIONS_CLUSTER_MAX_TILES', 64)
+
+# Seconds to keep the cached clusters of a tile.
+CLUSTER_CACHE_TIMEOUT = getattr(settings, 'LOCATIONS_CLUSTER_CACHE_TIMEOUT',
+        60 * 60)
+
+# Seconds to keep the encoded exports of a generation, see `locations.export`.
+EXPORT_CACHE_TIMEOUT = getattr(settings, 'LOCATIONS_EXPORT_CACHE_TIMEOUT',
+        60 * 60 * 24)
+
+# Directory the static feed snapshots are written to, and the URL it is
+# served from by the web server. Views redirect to the snapshot of the
+# current generation when both are set and the snapshot exists.
+SNAPSHOT_ROOT = getattr(settings, 'LOCATIONS_SNAPSHOT_ROOT', None)
+SNAPSHOT_URL = getattr(settings, 'LOCATIONS_SNAPSHOT_URL', None)
+
+# Republish the snapshots, and rebuild the binary snapshot, whenever
+# locations change. Leave this off for large imports and run the
+# `publish_location_snapshots` and `build_location_snapshot` commands instead.
+SNAPSHOT_AUTO = getattr(settings, 'LOCATIONS_SNAPSHOT_AUTO', False)
+
+# Database alias reads of the locations are sent to by the
+# `locations.routers.LocationRouter`, e.g. a read replica. `None` reads from
+# the default database.
+READ_DATABASE = getattr(settings, 'LOCATIONS_READ_DATABASE', None)
+
+# Seconds reads stay on the primary database after a write, covering the
+# replication lag of the read database.
+READ_PRIMARY_WINDOW = getattr(settings, 'LOCATIONS_READ_PRIMARY_WINDOW', 10)
+
+# Seconds to keep the rendered location cards of the list templates. The
+# cards are keyed by location version, so they never go stale.
+CARD_CACHE_TIMEOUT = getattr(settings, 'LOCATIONS_CARD_CACHE_TIMEOUT',
+        60 * 60 * 24)
+
+# Seconds to keep a location in the object cache, see
+# `LocationManager.get_many_cached`. Changes remove it right away; the timeout
+# bounds how long a read racing an uncommitted change can keep it stale.
+OBJECT_CACHE_TIMEOUT = getattr(settings, 'LOCATIONS_OBJECT_CACHE_TIMEOUT',
+        60 * 60)
+
+# Number of consecutive location ids covered by each sitemap chunk, at most
+# the 50,000 URLs the sitemap protocol allows.
+SITEMAP_CHUNK_SIZE = getattr(settings, 'LOCATIONS_SITEMAP_CHUNK_SIZE', 50000)
+
+# Seconds to keep the sitemap chunk list and the rendered chunks.
+SITEMAP_CACHE_TIMEOUT = getattr(settings, 'LOCATIONS_SITEMAP_CACHE_TIMEOUT',
+        60 * 60 * 24)
+
+# Include the facet counts of the search results in every list view
+# response, rather than only when requested with the `facets` parameter.
+SEARCH_FACETS = getattr(settings, 'LOCATIONS_SEARCH_FACETS', False)
+
+# Seconds to keep the facet counts of a search.
+FACET_CACHE_TIMEOUT = getattr(settings, 'LOCATIONS_FACET_CACHE_TIMEOUT',
+        60 * 60)
+
+# Directory the memory-mapped binary location snapshot is written to, see
+# `locations.snapshot`. Nearest location searches read the candidate
+# locations, and the JSON list view the listed locations, from the snapshot
+# of the current generation when it exists.
+BINARY_SNAPSHOT_ROOT = getattr(settings, 'LOCATIONS_BINARY_SNAPSHOT_ROOT',
+        None)
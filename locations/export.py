@@ -0,0 +1,174 @@
+"""
+Compact columnar export of the public locations for bulk sync clients.
+
+Rather than one object per location, the export holds one array per field.
+Repeated strings (cities, states, categories) are interned in tables and
+referenced by index, and the categories of each location are stored as a
+list of offsets into a flat array of category indexes, like so:
+
+    categories of location i = category_indexes[
+            category_offsets[i]:category_offsets[i + 1]]
+
+Exports are versioned by the generation, the latest change version (see
+`LocationManager.current_version`), which is the same in every process, so
+clients which already hold the current generation can skip the download.
+
+The binary format is little-endian:
+
+    header      magic 'LOKJ', format version (uint16), float size in bytes
+                (uint8), generation (uint64), location count (uint32),
+                category index size in bytes (uint8)
+    ids         uint32 * count
+    latitudes   float32/float64 * count, NaN when not geocoded
+    longitudes  float32/float64 * count, NaN when not geocoded
+    cities      uint32 * count, indexes into the city table
+    states      uint8 * count, indexes into the state table
+    offsets     uint32 * (count + 1), category offsets
+    categories  uint8/uint16/uint32 * offsets[count], indexes into the
+                category table, as narrow as the number of categories allows
+    tables      uint32 length followed by UTF-8 JSON holding the string
+                columns and tables
+"""
+import struct
+
+from django.core.cache import cache
+from django.utils import simplejson as json
+
+from locations import conf
+from locations.cache import generation_key
+from locations.models import Location, LocationCategory
+
+
+FORMAT_VERSION = 2
+MAGIC = 'LOKJ'
+NAN = float('nan')
+
+
+def intern(values):
+    """
+    Returns a (table, indexes) tuple where the table lists the distinct values
+    in order of appearance and the indexes point into it.
+    """
+    table = []
+    positions = {}
+    indexes = []
+    for value in values:
+        if value not in positions:
+            positions[value] = len(table)
+            table.append(value)
+        indexes.append(positions[value])
+    return table, indexes
+
+
+def export_columns():
+    """
+    Returns a dictionary of the columns and tables of the public locations,
+    ordered by id, read with two queries.
+    """
+    rows = list(Location.objects.public().order_by('id').values_list('id',
+        'name', 'street_address', 'city', 'state', 'postal_code', 'latitude',
+        'longitude'))
+    through = Location.category.through
+    memberships = {}
+    for location_id, category_id in through.objects.filter(
+            location__is_active=True).values_list('location_id',
+            'locationcategory_id'):
+        memberships.setdefault(location_id, []).append(category_id)
+    categories = list(LocationCategory.objects.order_by('id').values_list(
+        'id', 'name', 'slug'))
+    category_positions = dict([(category[0], index) for index, category in
+        enumerate(categories)])
+    cities, city_indexes = intern([row[3] for row in rows])
+    states, state_indexes = intern([row[4] for row in rows])
+    offsets = [0]
+    category_indexes = []
+    for row in rows:
+        category_indexes.extend(sorted([category_positions[category_id] for
+            category_id in memberships.get(row[0], [])]))
+        offsets.append(len(category_indexes))
+    return {
+        'ids': [row[0] for row in rows],
+        'names': [row[1] for row in rows],
+        'street_addresses': [row[2] or u"" for row in rows],
+        'postal_codes': [row[5] or u"" for row in rows],
+        'latitudes': [float(row[6]) if row[6] is not None else None
+            for row in rows],
+        'longitudes': [float(row[7]) if row[7] is not None else None
+            for row in rows],
+        'cities': city_indexes,
+        'states': state_indexes,
+        'category_offsets': offsets,
+        'category_indexes': category_indexes,
+        'city_table': cities,
+        'state_table': states,
+        'category_table': [{'id': pk, 'name': name, 'slug': slug} for
+            pk, name, slug in categories],
+    }
+
+
+def encode_json(columns, generation):
+    """Encodes the columns as compact JSON arrays"""
+    data = dict(columns, version=FORMAT_VERSION, generation=generation)
+    return json.dumps(data, separators=(',', ':'))
+
+
+def index_code(size):
+    """
+    Returns the struct code of the narrowest unsigned integer able to index
+    a table of the given size
+    """
+    if size <= 0x100:
+        return 'B'
+    if size <= 0x10000:
+        return 'H'
+    return 'I'
+
+
+def encode_binary(columns, generation, float_size=8):
+    """Encodes the columns in the packed binary format"""
+    count = len(columns['ids'])
+    float_code = 'f' if float_size == 4 else 'd'
+    category_code = index_code(len(columns['category_table']))
+    tables = json.dumps({
+        'names': columns['names'],
+        'street_addresses': columns['street_addresses'],
+        'postal_codes': columns['postal_codes'],
+        'city_table': columns['city_table'],
+        'state_table': columns['state_table'],
+        'category_table': columns['category_table'],
+    }, separators=(',', ':')).encode('utf-8')
+    parts = [
+        struct.pack('<4sHBQIB', MAGIC, FORMAT_VERSION, float_size,
+            generation, count, struct.calcsize(category_code)),
+        struct.pack('<%dI' % count, *columns['ids']),
+        struct.pack('<%d%s' % (count, float_code), *[NAN if value is None
+            else value for value in columns['latitudes']]),
+        struct.pack('<%d%s' % (count, float_code), *[NAN if value is None
+            else value for value in columns['longitudes']]),
+        struct.pack('<%dI' % count, *columns['cities']),
+        struct.pack('<%dB' % count, *columns['states']),
+        struct.pack('<%dI' % (count + 1), *columns['category_offsets']),
+        struct.pack('<%d%s' % (len(columns['category_indexes']),
+            category_code), *columns['category_indexes']),
+        struct.pack('<I', len(tables)),
+        tables,
+    ]
+    return ''.join(parts)
+
+
+def export(format='json', float_size=8):
+    """
+    Returns a (generation, payload) tuple for the current data generation.
+    Payloads are cached per generation and format.
+    """
+    generation = Location.objects.current_version()
+    key = generation_key('export', generation, format, float_size)
+    payload = cache.get(key)
+    if payload is None:
+        columns = export_columns()
+        if format == 'binary':
+            payload = encode_binary(columns, generation, float_size)
+        else:
+            payload = encode_json(columns, generation)
+        cache.set(key, payload, conf.EXPORT_CACHE_TIMEOUT)
+    return generation, payload
@@ -0,0 +1,81 @@
+"""
+Facet counts of location search results.
+
+Each facet dimension is counted with a single grouped aggregate query over
+the ids of the filtered search results, so the cost does not grow with the
+number of options. The counts are cached per data generation and set of
+search filters, alongside the other cached search data.
+"""
+import hashlib
+
+from django.contrib.localflavor.us.us_states import STATE_CHOICES
+from django.core.cache import cache
+from django.db.models import Count
+
+from locations import conf, instrumentation
+from locations.cache import generation_key
+from locations.models import Location
+
+
+# Parameters which do not change the filtered result set
+IGNORED_PARAMETERS = ('page', 'paginate_by', 'format', 'sort', 'direction',
+        'limit', 'facets')
+
+
+def facet_cache_key(querydict):
+    # The filters are hashed, as raw query values may hold characters and
+    # lengths which are not valid in memcached keys
+    filters = sorted([(key, sorted(querydict.getlist(key))) for key in
+        querydict if key not in IGNORED_PARAMETERS])
+    return generation_key('facets', hashlib.md5(repr(filters)).hexdigest())
+
+
+def facet_counts(queryset):
+    """
+    Returns a dictionary of the state, category and city counts of the
+    locations in the queryset, each a list of dictionaries sorted by
+    decreasing count.
+    """
+    ids = queryset.order_by().values('pk')
+    locations = Location.objects.filter(pk__in=ids).order_by()
+    state_names = dict(STATE_CHOICES)
+    with instrumentation.phase('facets'):
+        states = [{
+            'value': state,
+            'name': state_names.get(state, state),
+            'count': count,
+            } for state, count in locations.values_list('state').annotate(
+                count=Count('id'))]
+        categories = [{
+            'id': category_id,
+            'name': name,
+            'slug': slug,
+            'count': count,
+            } for category_id, name, slug, count in
+            Location.category.through.objects.filter(location__in=ids
+                ).order_by().values_list('locationcategory__id',
+                'locationcategory__name', 'locationcategory__slug').annotate(
+                count=Count('id'))]
+        cities = [{
+            'value': city,
+            'count': count,
+            } for city, count in locations.values_list('city').annotate(
+                count=Count('id'))]
+    facets = {'state': states, 'category': categories, 'city': cities}
+    for counts in facets.values():
+        counts.sort(key=lambda facet: (-facet['count'], facet.get('name',
+            facet.get('value'))))
+    return facets
+
+
+def cached_facet_counts(queryset, querydict):
+    """
+    Returns the `facet_counts` of the search results of the query, cached
+    until the next change to any location.
+    """
+    key = facet_cache_key(querydict)
+    facets = cache.get(key)
+    if facets is None:
+        facets = facet_counts(queryset)
+        cache.set(key, facets, conf.FACET_CACHE_TIMEOUT)
+    return facets
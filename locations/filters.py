@@ -42,9 +42,7 @@ class StateFieldFilterSpec(FilterSpec):
 
     def choices(self, cl):
         from .models import Location
-        state_choices = set([(loc.state, loc.get_state_display()) for
-            loc in Location.objects.all()])
-        state_choices = sorted(list(state_choices), key=lambda ch: ch[0])
+        state_choices = Location.objects.state_choices(public=False)
         yield {
             'selected': self.lookup_val is None,
             'query_string': cl.get_query_string({}, [self.lookup_kwarg]),
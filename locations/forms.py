@@ -3,7 +3,6 @@ from decimal import InvalidOperation
 from django import forms
 from django.utils.translation import ugettext as _
 
-from django_google_maps.widgets import GoogleMapsAddressWidget
 from locations.models import Location, LocationCategory
 
 
@@ -15,7 +14,6 @@ class LocationSearchForm(forms.Form):
     should not be present without the geo_query.
     """
     state = forms.ChoiceField(required=False,
-            choices=Location.objects.state_choices(),
             widget=forms.CheckboxSelectMultiple)
     category = forms.ModelMultipleChoiceField(required=False,
             help_text="Limit your search by establishment type",
@@ -29,6 +27,12 @@ class LocationSearchForm(forms.Form):
             help_text="Search by 5 digit zip code",
             label="Zip Code")
 
+    def __init__(self, *args, **kwargs):
+        super(LocationSearchForm, self).__init__(*args, **kwargs)
+        # Read the states when the form is used rather than when the module
+        # is imported, which must not touch the database
+        self.fields['state'].choices = Location.objects.state_choices()
+
     def clean_geo_query(self):
         """Only allow 5-digit zip codes for now"""
         geo_query = self.cleaned_data["geo_query"]
@@ -53,10 +57,9 @@ class LocationAdminForm(forms.ModelForm):
 
     The GoogleMapsAddressWidget does not, despite its name, depend on an
     address field. All it does is render a text input and append the div
-    wrapper for the Google Map.
+    wrapper for the Google Map. It is only imported when the form is used.
     """
     geolocation = forms.CharField(max_length=100, required=False,
-        widget=GoogleMapsAddressWidget,
         help_text="Latitude and longitude, e.g. (-90.801, 108.123)")
 
     class Meta:
@@ -71,6 +74,9 @@ class LocationAdminForm(forms.ModelForm):
                 initial['geolocation'] = u"%s,%s" % (instance.latitude, instance.longitude)
         kwargs['initial'] = initial
         super(LocationAdminForm, self).__init__(*args, **kwargs)
+        from django_google_maps.widgets import GoogleMapsAddressWidget
+        self.fields['geolocation'].widget = GoogleMapsAddressWidget(
+                attrs=self.fields['geolocation'].widget.attrs)
 
     def clean_geolocation(self):
         """
@@ -121,3 +127,6 @@ class CsvUploadForm(forms.Form):
         label=_("Location category"),
         help_text=_("This will be applied to all new locations."))
     csv_file = forms.FileField(label=_("CSV file"))
+    sync = forms.BooleanField(required=False, label=_("Full sync"),
+        help_text=_("Deactivate the locations in this category which are "
+            "missing from the file."))
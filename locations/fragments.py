@@ -0,0 +1,53 @@
+"""
+Cache of the rendered location cards of the list templates.
+
+A card is the markup of a location in the list: the link to its detail page,
+which otherwise takes a URL reversal per row, its name and its category
+listing, which otherwise takes a query per location. The distance from the
+searched point changes with every search, so the list templates render it
+outside the card. Each card is rendered from the `locations/location_card.html`
+template once and cached under a key made of the location's id and version,
+so it stays valid until that location changes, and of the category
+generation, bumped when categories change. The list views fetch the cards of
+a page with a single multi-get and only render the misses.
+"""
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from locations import conf
+from locations.cache import get_generation, CATEGORY_GENERATION_KEY
+from locations.models import location_categories
+
+
+CARD_TEMPLATE = "locations/location_card.html"
+
+
+def card_key(location, category_generation):
+    return "locations:card:%s:%s:%s" % (location.pk, location.version,
+            category_generation)
+
+
+def render_cards(locations):
+    """
+    Returns the list of the rendered cards of the locations, in order.
+
+    The categories of all the missing cards are read with a single query.
+    """
+    locations = list(locations)
+    category_generation = get_generation(CATEGORY_GENERATION_KEY)
+    keys = [card_key(location, category_generation) for location in
+            locations]
+    cards = cache.get_many(keys)
+    misses = [(key, location) for key, location in zip(keys, locations) if
+            key not in cards]
+    if misses:
+        categories = location_categories([location.pk for key, location in
+            misses])
+        rendered = dict([(key, render_to_string(CARD_TEMPLATE, {
+            'location': location,
+            'categories': categories[location.pk],
+            })) for key, location in misses])
+        cache.set_many(rendered, conf.CARD_CACHE_TIMEOUT)
+        cards.update(rendered)
+    return [mark_safe(cards[key]) for key in keys]
@@ -0,0 +1,198 @@
+"""
+Geographic calculations done in Python rather than in the database.
+
+Batched operations work on `Coordinates`, array-backed buffers of latitudes
+and longitudes. NumPy is used when it is installed; otherwise the buffers are
+`array('d')` instances and the operations fall back to plain Python loops.
+NumPy is only imported by the first batched operation, see `get_numpy`.
+"""
+import heapq
+import math
+from array import array
+
+
+# Great circle radius coefficients, see `LocationManager.distance`
+EARTH_RADIUS_MILES = 3959
+EARTH_RADIUS_KM = 6371
+
+# The NumPy module, None if it is not installed, or False until imported
+_numpy = False
+
+
+def get_numpy():
+    """
+    Returns the NumPy module, or None if it is not installed. It is imported
+    on first use rather than with the app, whose import time it would
+    otherwise dominate.
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+def haversine(lat1, lng1, lat2, lng2, radius=EARTH_RADIUS_MILES):
+    """
+    Returns the great circle distance between two points using the
+    Haversine formula.
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+            math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * radius * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, distance, radius=EARTH_RADIUS_MILES):
+    """
+    Returns the (south, west, north, east) box enclosing every point within
+    `distance` of the given point.
+    """
+    lat_delta = math.degrees(distance / float(radius))
+    south = max(-90.0, latitude - lat_delta)
+    north = min(90.0, latitude + lat_delta)
+    if south == -90.0 or north == 90.0:
+        return south, -180.0, north, 180.0
+    lng_delta = lat_delta / math.cos(math.radians(max(abs(south), abs(north))))
+    if lng_delta >= 180.0:
+        return south, -180.0, north, 180.0
+    return south, longitude - lng_delta, north, longitude + lng_delta
+
+
+def normalize_longitude(longitude):
+    """Wraps the longitude into the [-180, 180) range"""
+    return (longitude + 180.0) % 360.0 - 180.0
+
+
+def bounding_boxes(latitude, longitude, distance, radius=EARTH_RADIUS_MILES):
+    """
+    Returns the `bounding_box` of the point as a list of (south, west, north,
+    east) boxes within the valid longitude range: a single box, or two boxes
+    on either side of the antimeridian when it crosses it, as longitude
+    range queries cannot wrap around.
+    """
+    south, west, north, east = bounding_box(latitude, longitude, distance,
+            radius)
+    if west == -180.0 and east == 180.0:
+        return [(south, west, north, east)]
+    west, east = normalize_longitude(west), normalize_longitude(east)
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+class Coordinates(object):
+    """
+    A buffer of latitudes and longitudes stored as two float64 arrays.
+    """
+    def __init__(self, latitudes, longitudes):
+        numpy = get_numpy()
+        if numpy is not None:
+            self.latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+            self.longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+        else:
+            self.latitudes = array('d', latitudes)
+            self.longitudes = array('d', longitudes)
+        if len(self.latitudes) != len(self.longitudes):
+            raise ValueError("latitudes and longitudes differ in length")
+
+    @classmethod
+    def from_points(cls, points):
+        """Builds the buffer from a sequence of (latitude, longitude) pairs"""
+        points = list(points)
+        return cls([float(point[0]) for point in points],
+                [float(point[1]) for point in points])
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def __iter__(self):
+        return iter(zip(self.latitudes, self.longitudes))
+
+
+def centroid(coordinates):
+    """
+    Returns the (latitude, longitude) average of the coordinates, or None if
+    there are none.
+    """
+    count = len(coordinates)
+    if not count:
+        return None
+    if get_numpy() is not None:
+        return (float(coordinates.latitudes.mean()),
+                float(coordinates.longitudes.mean()))
+    return (math.fsum(coordinates.latitudes) / count,
+            math.fsum(coordinates.longitudes) / count)
+
+
+def bounds(coordinates):
+    """
+    Returns the (south, west, north, east) box of the coordinates, or None if
+    there are none.
+    """
+    if not len(coordinates):
+        return None
+    return (float(min(coordinates.latitudes)),
+            float(min(coordinates.longitudes)),
+            float(max(coordinates.latitudes)),
+            float(max(coordinates.longitudes)))
+
+
+def haversine_many(latitude, longitude, coordinates,
+        radius=EARTH_RADIUS_MILES):
+    """
+    Returns an array of the great circle distances from the point to each of
+    the coordinates.
+    """
+    numpy = get_numpy()
+    if numpy is None:
+        return array('d', [haversine(latitude, longitude, lat, lng, radius)
+            for lat, lng in coordinates])
+    lat1, lng1 = math.radians(latitude), math.radians(longitude)
+    lat2 = numpy.radians(coordinates.latitudes)
+    lng2 = numpy.radians(coordinates.longitudes)
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + \
+            math.cos(lat1) * numpy.cos(lat2) * numpy.sin((lng2 - lng1) / 2) ** 2
+    return 2 * radius * numpy.arcsin(numpy.minimum(1.0, numpy.sqrt(a)))
+
+
+def within(latitude, longitude, coordinates, distance,
+        radius=EARTH_RADIUS_MILES):
+    """
+    Returns the (index, distance) pairs of the coordinates within `distance`
+    of the point, nearest first.
+    """
+    distances = haversine_many(latitude, longitude, coordinates, radius)
+    numpy = get_numpy()
+    if numpy is None:
+        return [(index, value) for value, index in sorted([(value, index)
+            for index, value in enumerate(distances) if value <= distance])]
+    indexes = numpy.flatnonzero(distances <= distance)
+    indexes = indexes[numpy.argsort(distances[indexes], kind='mergesort')]
+    return [(int(index), float(distances[index])) for index in indexes]
+
+
+def k_nearest(latitude, longitude, coordinates, k,
+        radius=EARTH_RADIUS_MILES):
+    """
+    Returns the (index, distance) pairs of the `k` coordinates nearest to the
+    point, nearest first.
+    """
+    count = len(coordinates)
+    k = min(k, count)
+    if k < 1:
+        return []
+    distances = haversine_many(latitude, longitude, coordinates, radius)
+    numpy = get_numpy()
+    if numpy is None:
+        return [(index, distance) for distance, index in heapq.nsmallest(k,
+            [(distance, index) for index, distance in enumerate(distances)])]
+    if k < count:
+        indexes = numpy.argpartition(distances, k - 1)[:k]
+    else:
+        indexes = numpy.arange(count)
+    indexes = indexes[numpy.argsort(distances[indexes], kind='mergesort')]
+    return [(int(index), float(distances[index])) for index in indexes]
@@ -0,0 +1,98 @@
+"""
+Geohash encoding and decoding.
+
+A geohash is a short string identifying a rectangular cell on the globe.
+Nearby points share a common prefix, which makes geohashes useful for
+quantizing coordinates, e.g. to build cache keys for proximity searches.
+
+http://en.wikipedia.org/wiki/Geohash
+"""
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+DECODE_MAP = dict([(char, index) for index, char in enumerate(BASE32)])
+
+
+def encode(latitude, longitude, precision=6):
+    """
+    Returns the geohash of the given precision for the point.
+    """
+    latitude, longitude = float(latitude), float(longitude)
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            value, interval = longitude, lng_range
+        else:
+            value, interval = latitude, lat_range
+        middle = (interval[0] + interval[1]) / 2
+        if value >= middle:
+            bits = (bits << 1) | 1
+            interval[0] = middle
+        else:
+            bits = bits << 1
+            interval[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+def bounds(geohash):
+    """
+    Returns the (south, west, north, east) bounds of the geohash cell.
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        try:
+            bits = DECODE_MAP[char]
+        except KeyError:
+            raise ValueError("Invalid geohash character: %r" % char)
+        for shift in (4, 3, 2, 1, 0):
+            interval = lng_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if bits >> shift & 1:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+
+def decode(geohash):
+    """
+    Returns the (latitude, longitude) center of the geohash cell.
+    """
+    south, west, north, east = bounds(geohash)
+    return (south + north) / 2, (west + east) / 2
+
+
+def neighbors(geohash):
+    """
+    Returns the geohashes of the (up to) eight cells surrounding the given
+    cell. Cells wrap around the antimeridian; there are no cells beyond the
+    poles.
+    """
+    south, west, north, east = bounds(geohash)
+    latitude, longitude = (south + north) / 2, (west + east) / 2
+    lat_step, lng_step = north - south, east - west
+    cells = []
+    for lat_offset in (-1, 0, 1):
+        neighbor_lat = latitude + lat_offset * lat_step
+        if not -90 < neighbor_lat < 90:
+            continue
+        for lng_offset in (-1, 0, 1):
+            if not lat_offset and not lng_offset:
+                continue
+            neighbor_lng = longitude + lng_offset * lng_step
+            neighbor_lng = (neighbor_lng + 180) % 360 - 180
+            cells.append(encode(neighbor_lat, neighbor_lng, len(geohash)))
+    return cells
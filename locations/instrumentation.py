@@ -0,0 +1,149 @@
+"""
+Lightweight timing instrumentation for searches, feeds and imports.
+
+Code paths are split in named phases:
+
+    with instrumentation.phase('postal_code_lookup'):
+        ...
+
+When `LOCATIONS_INSTRUMENTATION` is enabled each phase sends the
+`locations.signals.phase_timed` signal and calls the optional
+`LOCATIONS_METRICS_CALLBACK`. Views collect their phases with `recording` to
+report them in a `Server-Timing` response header. When disabled, `phase`
+returns a shared no-op context manager, so the overhead is a single check.
+
+Query counts rely on `connection.queries`, which Django only keeps when DEBUG
+is on; otherwise they are reported as None.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.utils.importlib import import_module
+
+from locations import conf
+from locations.signals import phase_timed
+
+
+_local = threading.local()
+_callbacks = {}
+
+
+def get_callback():
+    """Returns the configured metrics callback, importing it once"""
+    callback = conf.METRICS_CALLBACK
+    if not isinstance(callback, basestring):
+        return callback
+    if callback not in _callbacks:
+        module, attr = callback.rsplit('.', 1)
+        try:
+            _callbacks[callback] = getattr(import_module(module), attr)
+        except (ImportError, AttributeError):
+            raise ImproperlyConfigured(
+                    "Could not import metrics callback %s" % callback)
+    return _callbacks[callback]
+
+
+def query_count():
+    if settings.DEBUG:
+        return sum([len(db.queries) for db in connections.all()])
+    return None
+
+
+class NoopPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Phase(object):
+    """Times the enclosed block and reports it on exit"""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.queries = query_count()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.time() - self.start
+        queries = query_count()
+        if queries is not None:
+            queries -= self.queries
+        record(self.name, duration, queries)
+        return False
+
+
+NOOP = NoopPhase()
+
+
+def phase(name):
+    """Returns a context manager timing the named phase"""
+    if not conf.INSTRUMENTATION:
+        return NOOP
+    return Phase(name)
+
+
+def record(name, duration, queries=None):
+    """Reports a timed phase"""
+    phase_timed.send(sender=None, phase=name, duration=duration,
+            queries=queries)
+    callback = get_callback()
+    if callback is not None:
+        callback(name, duration, queries)
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.append((name, duration, queries))
+
+
+class Recording(object):
+    """
+    Collects the phases timed in the current thread, e.g. during a request.
+    Recordings do not nest; the innermost one collects the phases.
+    """
+    def __enter__(self):
+        self.previous = getattr(_local, 'timings', None)
+        self.timings = _local.timings = []
+        return self.timings
+
+    def __exit__(self, *exc_info):
+        _local.timings = self.previous
+        return False
+
+
+class NoopRecording(NoopPhase):
+    def __enter__(self):
+        return []
+
+
+def recording():
+    """
+    Returns a context manager collecting the (name, duration, queries) tuples
+    of the phases timed within it.
+    """
+    if not conf.INSTRUMENTATION:
+        return NoopRecording()
+    return Recording()
+
+
+def server_timing(timings):
+    """Formats the timings as a `Server-Timing` header value"""
+    metrics = []
+    for name, duration, queries in timings:
+        metric = "%s;dur=%.2f" % (name, duration * 1000)
+        if queries is not None:
+            metric += ';desc="%s queries"' % queries
+        metrics.append(metric)
+    return ", ".join(metrics)
+
+
+def add_server_timing(response, timings):
+    """Adds the `Server-Timing` header to the response if configured"""
+    if conf.SERVER_TIMING and timings:
+        response['Server-Timing'] = server_timing(timings)
+    return response
@@ -0,0 +1,249 @@
+"""
+Load testing harness for the store finder endpoints.
+
+Serves the project through a local, threaded WSGI server and replays a mix
+of postal code, latitude and longitude, state and category searches, JSON
+searches and KML feed requests from concurrent clients. Unlike the
+`locations.benchmark` timings, this exercises connection handling, cache
+stampedes and the database under concurrent requests.
+
+Each request kind is reported with its throughput, p50/p95/p99 latency and
+mean number of database queries per request, and can be compared with a
+stored baseline. The load test is run through the `loadtest_locations`
+management command against synthetic data in a throwaway test database.
+"""
+import math
+import random
+import threading
+import time
+import urllib2
+from Queue import Queue, Empty
+from SocketServer import ThreadingMixIn
+from urllib import urlencode
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.urlresolvers import reverse
+
+from locations import instrumentation
+from locations.models import LocationCategory
+
+
+# (kind, weight) of the replayed requests
+REQUEST_MIX = (
+    ('postal_code', 30),
+    ('latlng', 20),
+    ('state', 15),
+    ('category', 15),
+    ('json_postal_code', 10),
+    ('json_latlng', 5),
+    ('kml', 5),
+)
+
+PERCENTILES = (50, 95, 99)
+
+# Header identifying each replayed request to the server
+REQUEST_HEADER = 'X-Load-Test-Request'
+
+
+class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of the values"""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+def request_paths(rows, count, seed=0):
+    """
+    Returns a list of `count` (kind, path) requests drawn from the request
+    mix, with query values taken from the synthetic rows.
+    """
+    generator = random.Random(seed)
+    geocoded = [row for row in rows if row['latitude'] is not None]
+    categories = list(LocationCategory.objects.values_list('id', flat=True))
+    search = reverse('location_list')
+    kinds = []
+    for kind, weight in REQUEST_MIX:
+        kinds.extend([kind] * weight)
+
+    def query(kind):
+        row = generator.choice(geocoded)
+        latlng = "%.4f,%.4f" % (row['latitude'] + generator.uniform(-0.1,
+            0.1), row['longitude'] + generator.uniform(-0.1, 0.1))
+        if kind == 'kml':
+            return reverse('location_kml')
+        params = {
+            'postal_code': {'geo_query': row['postal_code'], 'limit': 25},
+            'latlng': {'geo_query': latlng, 'limit': 25},
+            'state': {'state': row['state'], 'paginate_by': 25},
+            'category': {'category': generator.choice(categories),
+                'state': row['state'], 'paginate_by': 25},
+            'json_postal_code': {'geo_query': row['postal_code'],
+                'limit': 25, 'format': 'json'},
+            'json_latlng': {'geo_query': latlng, 'limit': 25,
+                'format': 'json'},
+        }[kind]
+        return "%s?%s" % (search, urlencode(params))
+
+    return [(kind, query(kind)) for kind in [generator.choice(kinds)
+        for counter in range(count)]]
+
+
+def counting_application(queries):
+    """
+    Returns the project's WSGI application, recording the number of queries
+    of each replayed request in the queries dictionary.
+    """
+    handler = WSGIHandler()
+    key = 'HTTP_' + REQUEST_HEADER.upper().replace('-', '_')
+
+    def application(environ, start_response):
+        response = handler(environ, start_response)
+        # Django resets the query log when the request starts
+        queries[environ.get(key)] = instrumentation.query_count()
+        return response
+    return application
+
+
+def run_load(requests, concurrency=4, host='127.0.0.1', port=0):
+    """
+    Serves the project locally and sends the (kind, path) requests from
+    `concurrency` client threads. Returns the wall time in seconds and a
+    list of (kind, seconds, status, queries) samples.
+    """
+    queries = {}
+    server = make_server(host, port, counting_application(queries),
+            server_class=ThreadedWSGIServer, handler_class=QuietRequestHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    base_url = "http://%s:%s" % (host, server.server_port)
+    pending = Queue()
+    for index, (kind, path) in enumerate(requests):
+        pending.put((str(index), kind, path))
+    samples = []
+
+    def client():
+        while True:
+            try:
+                index, kind, path = pending.get_nowait()
+            except Empty:
+                return
+            request = urllib2.Request(base_url + path,
+                    headers={REQUEST_HEADER: index})
+            start = time.time()
+            try:
+                response = urllib2.urlopen(request)
+                response.read()
+                status = response.getcode()
+            except urllib2.HTTPError, e:
+                status = e.code
+            except urllib2.URLError:
+                status = None
+            samples.append((index, kind, time.time() - start, status))
+
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    start = time.time()
+    try:
+        clients = [threading.Thread(target=client) for counter in
+                range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+    finally:
+        elapsed = time.time() - start
+        settings.DEBUG = debug
+        server.shutdown()
+        server.server_close()
+    return elapsed, [(kind, seconds, status, queries.get(index)) for index,
+            kind, seconds, status in samples]
+
+
+def summarize(name, elapsed, samples):
+    """Returns a dictionary of the statistics of the samples"""
+    times = [seconds for kind, seconds, status, count in samples]
+    counts = [count for kind, seconds, status, count in samples
+            if count is not None]
+    result = {
+        'name': name,
+        'requests': len(samples),
+        'errors': len([status for kind, seconds, status, count in samples
+            if status != 200]),
+        'throughput': len(samples) / elapsed if elapsed else None,
+        'queries': float(sum(counts)) / len(counts) if counts else None,
+    }
+    for percent in PERCENTILES:
+        result['p%s' % percent] = percentile(times, percent)
+    return result
+
+
+def run_load_test(rows, count=500, concurrency=4, seed=0):
+    """
+    Replays `count` requests against the synthetic rows and returns the
+    results as a dictionary which can be serialized to JSON. The overall
+    throughput is shared by the request kinds, whose own throughput is the
+    rate at which they completed during the run.
+    """
+    requests = request_paths(rows, count, seed)
+    # One request of each kind first loads the URLconf and templates, which
+    # a running site has long done
+    run_load(dict([(kind, (kind, path)) for kind, path in requests
+        ]).values(), 1)
+    elapsed, samples = run_load(requests, concurrency)
+    results = [summarize('all', elapsed, samples)]
+    for kind, weight in REQUEST_MIX:
+        kind_samples = [sample for sample in samples if sample[0] == kind]
+        if kind_samples:
+            results.append(summarize(kind, elapsed, kind_samples))
+    return {
+        'engine': settings.DATABASES['default']['ENGINE'],
+        'locations': len(rows),
+        'requests': count,
+        'concurrency': concurrency,
+        'seed': seed,
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns a list of messages describing regressions of the results against
+    the baseline: p95 latencies slower or throughputs lower by more than
+    `tolerance` (a fraction), more queries per request, and failed requests.
+    """
+    previous = dict([(result['name'], result) for result in
+        baseline.get('results', [])])
+    regressions = []
+    for result in results['results']:
+        if result['errors']:
+            regressions.append("%s had %s failed requests" % (result['name'],
+                result['errors']))
+        before = previous.get(result['name'])
+        if before is None:
+            continue
+        if result['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append("%s p95 was %.4fs, baseline %.4fs" % (
+                result['name'], result['p95'], before['p95']))
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append("%s served %.1f requests/s, baseline %.1f" % (
+                result['name'], result['throughput'], before['throughput']))
+        if (result['queries'] is not None and before['queries'] is not None
+                and round(result['queries'], 1) > round(before['queries'], 1)):
+            regressions.append("%s ran %.1f queries per request, baseline "
+                    "%.1f" % (result['name'], result['queries'],
+                        before['queries']))
+    return regressions
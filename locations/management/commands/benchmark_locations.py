@@ -0,0 +1,98 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson as json
+
+from locations.benchmark import run_benchmarks, compare, dumps
+
+
+class Command(BaseCommand):
+    """
+    The benchmark_locations management command times the search, import and
+    feed code paths against a synthetic data set in a throwaway test database.
+
+        > ./manage.py benchmark_locations --count 10000 --output results.json
+        > ./manage.py benchmark_locations --baseline results.json
+
+    Results are written as JSON. When a baseline file is given the command
+    fails if any benchmark got slower by more than the tolerance or runs more
+    queries than before.
+    """
+    help = """
+        Benchmark location searches, feeds and imports against synthetic data.
+        """
+    option_list = BaseCommand.option_list + (
+            make_option('--count',
+                action='store',
+                type='int',
+                dest='count',
+                default=10000,
+                help="""Number of synthetic locations to generate
+                        Default is 10000"""),
+            make_option('--seed',
+                action='store',
+                type='int',
+                dest='seed',
+                default=0,
+                help="""Random seed for the synthetic data"""),
+            make_option('--repeat',
+                action='store',
+                type='int',
+                dest='repeat',
+                default=3,
+                help="""Number of times each benchmark is run
+                        Default is 3"""),
+            make_option('--output',
+                action='store',
+                dest='output',
+                default=None,
+                help="""File to write the JSON results to"""),
+            make_option('--baseline',
+                action='store',
+                dest='baseline',
+                default=None,
+                help="""JSON results file to compare against"""),
+            make_option('--tolerance',
+                action='store',
+                type='float',
+                dest='tolerance',
+                default=0.2,
+                help="""Allowed slowdown against the baseline, as a fraction
+                        Default is 0.2"""),
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options.get('baseline'):
+            try:
+                baseline = json.load(open(options['baseline']))
+            except (IOError, ValueError):
+                raise CommandError(
+                        "Could not read the baseline %s" % options['baseline'])
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            results = run_benchmarks(options['count'], options['seed'],
+                    options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        output = dumps(results)
+        if options.get('output'):
+            open(options['output'], 'w').write(output)
+        else:
+            self.stdout.write(output + "\r\n")
+        for result in results['results']:
+            if 'error' in result:
+                self.stdout.write("%(name)s: %(error)s\r\n" % result)
+                continue
+            summary = "%(name)s: %(best).4fs, %(queries)s queries" % result
+            if result.get('peak_memory_kb') is not None:
+                summary += ", %(peak_memory_kb)s KB" % result
+            self.stdout.write(summary + "\r\n")
+        if baseline is not None:
+            regressions = compare(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError("Regressions against the baseline:\r\n%s" %
+                        "\r\n".join(regressions))
+            self.stdout.write("No regressions against the baseline\r\n")
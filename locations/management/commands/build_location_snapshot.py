@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from locations import conf
+from locations.snapshot import build_snapshot
+
+
+class Command(BaseCommand):
+    """
+    The build_location_snapshot management command writes the binary
+    snapshot of the geocoded public locations which the worker processes
+    memory-map for their nearest location searches.
+
+        > ./manage.py build_location_snapshot --root /var/lib/locations
+    """
+    help = """
+        Write the memory-mapped binary snapshot of the locations.
+        """
+    option_list = BaseCommand.option_list + (
+            make_option('--root',
+                action='store',
+                dest='root',
+                default=conf.BINARY_SNAPSHOT_ROOT,
+                help="""Directory to write the snapshot to
+                        Default is LOCATIONS_BINARY_SNAPSHOT_ROOT"""),
+        )
+
+    def handle(self, *args, **options):
+        root = options.get('root')
+        if not root:
+            raise CommandError(
+                    "Set LOCATIONS_BINARY_SNAPSHOT_ROOT or pass the --root option")
+        generation = build_snapshot(root)
+        self.stdout.write("Built generation %s in %s\r\n" % (
+            generation, root))
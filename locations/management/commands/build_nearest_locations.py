@@ -0,0 +1,46 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from locations import conf
+from locations.nearest import rebuild_nearest_locations
+
+
+class Command(BaseCommand):
+    """
+    The build_nearest_locations management command rebuilds the table of the
+    nearest public locations to each postal code, which is used to answer
+    postal code searches when `LOCATIONS_POSTAL_NEAREST` is enabled.
+
+        > ./manage.py build_nearest_locations --processes 4 --count 50
+
+    The distances are computed by a pool of worker processes. Once built, the
+    table is kept up to date as locations change.
+    """
+    help = """
+        Rebuild the precomputed nearest locations for every postal code.
+        """
+    option_list = BaseCommand.option_list + (
+            make_option('--count',
+                action='store',
+                type='int',
+                dest='count',
+                default=conf.POSTAL_NEAREST_COUNT,
+                help="""Number of locations to store per postal code
+                        Default is %s""" % conf.POSTAL_NEAREST_COUNT),
+            make_option('--processes',
+                action='store',
+                type='int',
+                dest='processes',
+                default=None,
+                help="""Number of worker processes
+                        Default is the number of CPUs"""),
+        )
+
+    def handle(self, *args, **options):
+        count = options.get('count')
+        processes = options.get('processes')
+        if count < 1 or (processes is not None and processes < 1):
+            raise CommandError("The count and processes must be positive")
+        rows = rebuild_nearest_locations(count=count, processes=processes)
+        self.stdout.write("%s nearest locations stored\r\n" % rows)
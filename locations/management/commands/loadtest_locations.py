@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson as json
+
+from locations.benchmark import generate_locations, dumps
+from locations.loadtest import run_load_test, compare
+
+
+class Command(BaseCommand):
+    """
+    The loadtest_locations management command replays a mix of searches and
+    feed requests from concurrent clients against a local WSGI server, using
+    synthetic data in a throwaway test database.
+
+        > ./manage.py loadtest_locations --requests 1000 --output load.json
+        > ./manage.py loadtest_locations --concurrency 8 --baseline load.json
+
+    Results are written as JSON. When a baseline file is given the command
+    fails if any request kind got slower or served fewer requests per second
+    by more than the tolerance, runs more queries per request than before or
+    had failed requests.
+    """
+    help = """
+        Load test the location searches and feeds with concurrent clients.
+        """
+    option_list = BaseCommand.option_list + (
+            make_option('--count',
+                action='store',
+                type='int',
+                dest='count',
+                default=10000,
+                help="""Number of synthetic locations to generate
+                        Default is 10000"""),
+            make_option('--requests',
+                action='store',
+                type='int',
+                dest='requests',
+                default=500,
+                help="""Number of requests to replay
+                        Default is 500"""),
+            make_option('--concurrency',
+                action='store',
+                type='int',
+                dest='concurrency',
+                default=4,
+                help="""Number of concurrent clients
+                        Default is 4"""),
+            make_option('--seed',
+                action='store',
+                type='int',
+                dest='seed',
+                default=0,
+                help="""Random seed for the synthetic data and requests"""),
+            make_option('--output',
+                action='store',
+                dest='output',
+                default=None,
+                help="""File to write the JSON results to"""),
+            make_option('--baseline',
+                action='store',
+                dest='baseline',
+                default=None,
+                help="""JSON results file to compare against"""),
+            make_option('--tolerance',
+                action='store',
+                type='float',
+                dest='tolerance',
+                default=0.2,
+                help="""Allowed slowdown against the baseline, as a fraction
+                        Default is 0.2"""),
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options.get('baseline'):
+            try:
+                baseline = json.load(open(options['baseline']))
+            except (IOError, ValueError):
+                raise CommandError(
+                        "Could not read the baseline %s" % options['baseline'])
+        old_name = connection.settings_dict['NAME']
+        test_name = connection.settings_dict.get('TEST_NAME')
+        test_directory = None
+        if (connection.vendor == 'sqlite' and
+                connection.settings_dict.get('TEST_NAME') in (None, '',
+                    ':memory:')):
+            # The server threads open their own connections, which would
+            # each get an empty in-memory database
+            test_directory = tempfile.mkdtemp()
+            connection.settings_dict['TEST_NAME'] = os.path.join(
+                    test_directory, 'loadtest.db')
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            rows = generate_locations(options['count'], options['seed'])
+            results = run_load_test(rows, options['requests'],
+                    options['concurrency'], options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if test_directory is not None:
+                connection.settings_dict['TEST_NAME'] = test_name
+                shutil.rmtree(test_directory)
+        output = dumps(results)
+        if options.get('output'):
+            open(options['output'], 'w').write(output)
+        else:
+            self.stdout.write(output + "\r\n")
+        for result in results['results']:
+            self.stdout.write("%(name)s: %(requests)s requests, %(throughput).1f "
+                    "requests/s, p50 %(p50).4fs, p95 %(p95).4fs, p99 %(p99).4fs, "
+                    "%(errors)s errors\r\n" % result)
+        if baseline is not None:
+            regressions = compare(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError("Regressions against the baseline:\r\n%s" %
+                        "\r\n".join(regressions))
+            self.stdout.write("No regressions against the baseline\r\n")
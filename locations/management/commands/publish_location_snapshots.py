@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from locations import conf
+from locations.publish import publish_snapshots
+
+
+class Command(BaseCommand):
+    """
+    The publish_location_snapshots management command writes the KML feed,
+    the full JSON list and the geo sitemap as static, precompressed files
+    named by data generation, which the views redirect to.
+
+        > ./manage.py publish_location_snapshots --root /var/www/locations
+    """
+    help = """
+        Write static, precompressed snapshots of the location feeds.
+        """
+    option_list = BaseCommand.option_list + (
+            make_option('--root',
+                action='store',
+                dest='root',
+                default=conf.SNAPSHOT_ROOT,
+                help="""Directory to write the snapshots to
+                        Default is LOCATIONS_SNAPSHOT_ROOT"""),
+        )
+
+    def handle(self, *args, **options):
+        root = options.get('root')
+        if not root:
+            raise CommandError(
+                    "Set LOCATIONS_SNAPSHOT_ROOT or pass the --root option")
+        generation = publish_snapshots(root)
+        self.stdout.write("Published generation %s to %s\r\n" % (
+            generation, root))
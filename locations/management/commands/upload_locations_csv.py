@@ -43,6 +43,13 @@ class Command(BaseCommand):
                 default=False,
                 help="""Does this CSV file have a header row?
                         Default is False""",
+            ),
+            make_option('--sync',
+                action='store_true',
+                dest='sync',
+                default=False,
+                help="""Deactivate locations in the chosen category which
+                        are missing from the file. Default is False""",
             )
         )
 
@@ -63,6 +70,7 @@ class Command(BaseCommand):
                 categories""")
         duplicates_field = options.get('duplicates_field')
         has_header = options.get('has_header')
+        sync = options.get('sync')
 
         # Presuming we do not set the category with a command line option,
         # interrogate the user for which category should be assigned to each
@@ -92,7 +100,7 @@ class Command(BaseCommand):
             raise CommandError(
                     "There was a problem reading the file, %s" % file_name)
         results = locations_from_csv(csv_file, category, has_header=has_header,
-                duplicates_field=duplicates_field)
+                duplicates_field=duplicates_field, sync=sync)
         self.stdout.write("----------------------------\r\n")
         if results['errors']:
             self.stdout.write("There were errors!\r\n")
@@ -103,4 +111,7 @@ class Command(BaseCommand):
             self.stdout.write("No errors reported\r\n")
             self.stdout.write("%s locations created\r\n" % len(results['created']))
             self.stdout.write("%s duplicates skipped\r\n" % len(results['skipped']))
+            if sync:
+                self.stdout.write("%s missing locations deactivated\r\n" %
+                        results['deactivated_count'])
         self.stdout.write("----------------------------\r\n")
@@ -1,10 +1,22 @@
+import copy
 import logging
+from datetime import datetime
 
-from django.db import models
-from django.db.models import Q
+from django.core.cache import cache
+from django.db import connections, models, router, transaction
+from django.db.models import Max, Q
 
 from postalcodes.models import PostalCode
 
+from locations import conf, geo, geohash, instrumentation
+from locations.cache import generation_key, get_generation, \
+        CATEGORY_GENERATION_KEY
+from locations.signals import locations_updated
+from locations.snapshot import current_snapshot
+
+# SQLite allows at most 999 parameters per query
+BULK_UPDATE_BATCH_SIZE = 900
+
 
 def get_multiple_ids_string(queryset):
     """Returns a string of ids from a queryset for use in a SQL query"""
@@ -14,6 +26,42 @@ def get_multiple_ids_string(queryset):
     return querystring
 
 
+def distance_sql(latitude, longitude, radius=geo.EARTH_RADIUS_MILES):
+    """
+    Returns the SQL expression and parameters of the great circle distance
+    of the `latitude` and `longitude` columns from the given point.
+
+    The expression uses the haversine formula in its atan2 form. Unlike the
+    spherical law of cosines, whose acos argument rounds to just above 1 for
+    a location at the query point and then yields NULL or a domain error, it
+    is well defined for every pair of points and accurate at short
+    distances. The haversine term is kept within [0, 1] by taking the
+    absolute value of its complement rather than with LEAST, which SQLite
+    lacks.
+    """
+    haversine = ("power(sin(radians(latitude - %s) / 2), 2) + "
+            "cos(radians(%s)) * cos(radians(latitude)) * "
+            "power(sin(radians(longitude - %s) / 2), 2)")
+    params = (latitude, latitude, longitude)
+    return ("2 * %%s * atan2(sqrt(%s), sqrt(abs(1 - (%s))))" % (haversine,
+        haversine), (radius,) + params + params)
+
+
+def farthest_corner(latitude, longitude, cells):
+    """
+    Returns the distance from the point to the farthest corner of the
+    geohash cells.
+    """
+    return max([geo.haversine(latitude, longitude, corner_lat, corner_lng)
+        for south, west, north, east in [geohash.bounds(cell) for cell in
+            cells] for corner_lat in (south, north) for corner_lng in (west,
+            east)])
+
+
+def object_cache_key(pk, category_generation):
+    return "locations:object:%s:%s" % (category_generation, pk)
+
+
 class LocationManager(models.Manager):
     """
     Manager class for Location objects.
@@ -23,6 +71,142 @@ class LocationManager(models.Manager):
         """Returns only locations which are marked as available"""
         return super(LocationManager, self).get_query_set().filter(is_active=True)
 
+    def next_version(self):
+        """
+        Returns the next change version. Every save and bulk update stamps
+        the changed locations with a new, increasing version, which sync
+        clients use to fetch only what changed, see `changes`.
+
+        The version is taken from the `ChangeCounter` row of the database
+        written to, never from a lagging read replica. Incrementing the row
+        locks it until the transaction ends, so a concurrent change waits
+        for the one before it to commit and versions become visible in
+        order; otherwise a client could sync past a smaller version which
+        had not been committed yet and never see it. The stamped locations
+        must be written in the same transaction.
+        """
+        from locations.models import ChangeCounter
+        using = self._db or router.db_for_write(self.model)
+        table = connections[using].ops.quote_name(
+                ChangeCounter._meta.db_table)
+        cursor = connections[using].cursor()
+        cursor.execute("UPDATE %s SET version = version + 1 WHERE id = 1" %
+                table)
+        if not cursor.rowcount:
+            latest = self.get_query_set().using(using).aggregate(
+                    Max('version'))['version__max']
+            cursor.execute("INSERT INTO %s (id, version) VALUES (1, %%s)" %
+                    table, [(latest or 0) + 1])
+        cursor.execute("SELECT version FROM %s WHERE id = 1" % table)
+        return cursor.fetchone()[0]
+
+    def current_version(self):
+        """
+        Returns the latest change version, see `next_version`. Deleting
+        locations and changing categories advance it too.
+
+        Unlike the cache generation, which the default local memory cache
+        keeps per process, the version is stored in the database and is the
+        same in every process, so it names the published snapshots and tags
+        the responses which must agree across processes.
+        """
+        from locations.models import ChangeCounter
+        using = self._db or router.db_for_write(self.model)
+        try:
+            return ChangeCounter.objects.using(using).get(pk=1).version
+        except ChangeCounter.DoesNotExist:
+            return self.get_query_set().using(using).aggregate(
+                    Max('version'))['version__max'] or 0
+
+    def changes(self, since, limit=None):
+        """
+        Returns a QuerySet of all the locations, active or not, changed after
+        the given version, ordered by version and id.
+        """
+        queryset = self.get_query_set().filter(version__gt=since).order_by(
+                'version', 'id')
+        return queryset[:limit]
+
+    def bulk_update(self, pks, **values):
+        """
+        Updates the locations with the given ids with set-based UPDATE
+        statements and sends the `locations_updated` signal once for the
+        whole batch, as the model's save signals are not sent. All of the
+        locations are stamped with the same new version and modification
+        time. Returns the number of rows updated.
+
+        Ids are sent in batches of `BULK_UPDATE_BATCH_SIZE` to stay within the
+        query parameter limits of some databases. The batches are committed
+        together, with the version, unless the caller manages the
+        transaction.
+        """
+        pks = list(pks)
+        if not pks:
+            return 0
+        using = self._db or router.db_for_write(self.model)
+        if not transaction.is_managed(using=using):
+            return transaction.commit_on_success(using=using)(
+                    self.bulk_update)(pks, **values)
+        rows = 0
+        values['version'] = self.next_version()
+        values.setdefault('modified', datetime.now())
+        for start in range(0, len(pks), BULK_UPDATE_BATCH_SIZE):
+            rows += self.get_query_set().filter(
+                    pk__in=pks[start:start + BULK_UPDATE_BATCH_SIZE]).update(
+                    **values)
+        locations_updated.send(sender=self.model, pks=pks)
+        return rows
+
+    def get_cached(self, pk):
+        """
+        Returns the location with the given id, active or not, read through
+        the object cache, see `get_many_cached`.
+        """
+        try:
+            return self.get_many_cached([pk])[int(pk)]
+        except KeyError:
+            raise self.model.DoesNotExist(
+                    "Location matching query does not exist.")
+
+    def get_many_cached(self, pks):
+        """
+        Returns a dictionary of the locations with the given ids by id, read
+        through the object cache. Each location comes with the list of its
+        categories as its `cached_categories` attribute.
+
+        Locations missing from the cache are read with a single query, plus
+        one for their categories, and cached until they change, see
+        `uncache`. Category changes invalidate all of the cached locations,
+        as the key includes the category generation.
+        """
+        from locations.models import location_categories
+        pks = [int(pk) for pk in pks]
+        category_generation = get_generation(CATEGORY_GENERATION_KEY)
+        keys = dict([(object_cache_key(pk, category_generation), pk) for pk
+            in pks])
+        locations = dict([(keys[key], location) for key, location in
+            cache.get_many(keys.keys()).items()])
+        missing = [pk for pk in set(pks) if pk not in locations]
+        if missing:
+            fetched = {}
+            for start in range(0, len(missing), BULK_UPDATE_BATCH_SIZE):
+                fetched.update(self.in_bulk(
+                    missing[start:start + BULK_UPDATE_BATCH_SIZE]))
+            categories = location_categories(fetched.keys())
+            for pk, location in fetched.items():
+                location.cached_categories = categories[pk]
+            cache.set_many(dict([(object_cache_key(pk, category_generation),
+                location) for pk, location in fetched.items()]),
+                conf.OBJECT_CACHE_TIMEOUT)
+            locations.update(fetched)
+        return locations
+
+    def uncache(self, pks):
+        """Removes the locations with the given ids from the object cache"""
+        category_generation = get_generation(CATEGORY_GENERATION_KEY)
+        cache.delete_many([object_cache_key(pk, category_generation) for pk
+            in pks])
+
     def geocodeable(self):
         """Returns only locations with addresses that can be geocoded"""
         return super(LocationManager, self).get_query_set().filter(
@@ -34,19 +218,31 @@ class LocationManager(models.Manager):
         """
         return self.public().filter(~Q(latitude=None))
 
-    def state_choices(self):
+    def state_choices(self, public=True):
         """
         Returns a tuple of tuples ((x,y), (a,b)) with the distinct state values
-        and full names for active locations.
+        and full names for active locations, or all locations if `public` is
+        False.
+
+        The choices come from a single DISTINCT query and are cached until
+        the next change to any location.
         """
         from django.contrib.localflavor.us.us_states import STATE_CHOICES
-        state_names = dict(STATE_CHOICES)
-        states = self.public().values('state')
-        state_vals = list(set([state['state'].upper() for state in states]))
-        state_vals.sort()
-        return tuple([(state_val, state_names[state_val]) for state_val in state_vals])
+        key = generation_key('state_choices', public)
+        choices = cache.get(key)
+        if choices is None:
+            state_names = dict(STATE_CHOICES)
+            queryset = self.public() if public else self.get_query_set()
+            states = queryset.order_by().values_list('state',
+                    flat=True).distinct()
+            state_vals = list(set([state.upper() for state in states]))
+            state_vals.sort()
+            choices = tuple([(state_val, state_names.get(state_val, state_val))
+                for state_val in state_vals])
+            cache.set(key, choices, conf.STATE_CHOICES_CACHE_TIMEOUT)
+        return choices
 
-    def geosearch(self, query):
+    def geosearch(self, query, exact=False):
         """
         Returns a queryset sorted by geographic proximity to the query.
 
@@ -54,17 +250,38 @@ class LocationManager(models.Manager):
         its inputs without relying on Django to protect from SQL injection
         attacks.
 
+        When `LOCATIONS_GEOHASH_PRECISION` is set, latitude and longitude
+        queries are answered from the cached candidates of the query's
+        geohash cell, see `geohash_candidates`. When `LOCATIONS_POSTAL_NEAREST`
+        is set, postal code queries are answered from the precomputed
+        `NearestLocation` table when it lists the postal code, see
+        `postal_code_nearest`. When `LOCATIONS_POSTAL_SNAP_DISTANCE` is set,
+        latitude and longitude queries near a postal code are answered as
+        queries of that postal code, see `snap_postal_code`.
+
+        The cached candidates and precomputed tables only hold a set number
+        of the nearest locations, so filtering them may leave out matching
+        locations which are farther away. Searches whose results are
+        filtered further must be `exact`, which ranks all the locations.
+
         :param query: The location against which to search, either represents
             a postal code or latitude and longitude
         :type query: Either a string or a tuple
+        :param exact: Whether to skip the cached and precomputed nearest
+            locations
+        :type exact: bool
         """
         try:
             latitude, longitude = query.split(',')
         except ValueError:
             # Possibly a zip code?
             postal_code = query[:5]
+            if conf.POSTAL_NEAREST and not exact and \
+                    self.has_postal_code_nearest(postal_code):
+                return self.postal_code_nearest(postal_code)
             try:
-                postal_area = PostalCode.objects.get(code=postal_code)
+                with instrumentation.phase('postal_code_lookup'):
+                    postal_area = PostalCode.objects.get(code=postal_code)
             except PostalCode.DoesNotExist:
                 # No such postal code, dolts!
                 # TODO: there should be a warning somewhere about this, perhaps
@@ -74,32 +291,196 @@ class LocationManager(models.Manager):
                 latitude, longitude = postal_area.latitude, postal_area.longitude
         else:
             latitude, longitude = float(latitude), float(longitude)
+            snapped = self.snap_postal_code(latitude, longitude)
+            if snapped is not None:
+                code, latitude, longitude, distance = snapped
+                if conf.POSTAL_NEAREST and not exact and \
+                        self.has_postal_code_nearest(code):
+                    return self.postal_code_nearest(code)
+            if conf.GEOHASH_PRECISION and not exact:
+                return self.distance(latitude, longitude).filter(
+                        pk__in=self.geohash_candidates(latitude, longitude))
         return self.distance(latitude, longitude)
 
-    def distance(self, latitude, longitude):
+    def snap_postal_code(self, latitude, longitude):
         """
-        Returns a QuerySet of locations annotated with their distance from the
-        given point.
+        Returns the (code, latitude, longitude, distance) of the postal code
+        nearest to the point within `LOCATIONS_POSTAL_SNAP_DISTANCE` miles, or
+        None if there is none or snapping is disabled.
+        """
+        from locations.postalindex import nearest_postal_code
+        if not conf.POSTAL_SNAP_DISTANCE:
+            return None
+        with instrumentation.phase('postal_code_snap'):
+            return nearest_postal_code(latitude, longitude,
+                    conf.POSTAL_SNAP_DISTANCE)
 
-        It implements the Haversine formula.
+    def geosearch_many(self, queries, k=10):
+        """
+        Returns a dictionary of the `k` public, geocoded locations nearest to
+        each query, nearest first and annotated with their distance, keyed by
+        query. Queries are postal codes or "latitude,longitude" strings as
+        for `geosearch`; unknown postal codes map to an empty list.
 
-        Coefficients represent great cirlce measurements. Options include
-            3956 - miles
-            6371 - kilometers
+        All the postal codes are resolved with a single query and the
+        candidate locations are read once, or not at all when the binary
+        snapshot of the current generation is available. The nearest locations of every
+        point are then found in memory with `geo.k_nearest`, rather than with
+        one distance query per point.
+        """
+        points = {}
+        postal_codes = {}
+        for query in queries:
+            try:
+                latitude, longitude = [float(value) for value in
+                        query.split(',')]
+            except ValueError:
+                postal_codes.setdefault(query[:5], []).append(query)
+            else:
+                points[query] = (latitude, longitude)
+        if postal_codes:
+            with instrumentation.phase('postal_code_lookup'):
+                for code, latitude, longitude in PostalCode.objects.filter(
+                        code__in=postal_codes.keys()).exclude(
+                        latitude=None).exclude(longitude=None).values_list(
+                        'code', 'latitude', 'longitude'):
+                    for query in postal_codes[code]:
+                        points[query] = (float(latitude), float(longitude))
+        results = dict([(query, []) for query in queries])
+        if not points:
+            return results
+        with instrumentation.phase('candidates'):
+            snapshot = current_snapshot()
+            if snapshot is not None:
+                ids, coordinates = snapshot.ids, snapshot.coordinates
+            else:
+                candidates = list(self.geocoded().values_list('id',
+                    'latitude', 'longitude'))
+                ids = [candidate[0] for candidate in candidates]
+                coordinates = geo.Coordinates.from_points([candidate[1:] for
+                    candidate in candidates])
+        with instrumentation.phase('nearest'):
+            nearest = [(query, [(int(ids[index]), distance) for index,
+                distance in geo.k_nearest(latitude, longitude, coordinates,
+                k)]) for query, (latitude, longitude) in points.items()]
+        with instrumentation.phase('locations'):
+            pks = list(set([pk for query, pairs in nearest
+                for pk, distance in pairs]))
+            locations = {}
+            for start in range(0, len(pks), BULK_UPDATE_BATCH_SIZE):
+                locations.update(self.in_bulk(
+                    pks[start:start + BULK_UPDATE_BATCH_SIZE]))
+        for query, pairs in nearest:
+            for pk, distance in pairs:
+                # The same location may be near several of the queries
+                location = copy.copy(locations[pk])
+                location.distance = distance
+                results[query].append(location)
+        return results
 
-        http://www.benamy.info/guides/haversine-formula-distance-query-with-django-postgresql
+    def postal_code_nearest(self, postal_code):
+        """
+        Returns a QuerySet of the precomputed nearest locations to the postal
+        code, annotated with their distance from it.
+        """
+        return self.get_query_set().filter(
+                nearest_postal_codes__postal_code=postal_code).extra(
+                select={'distance': 'locations_nearestlocation.distance'}
+                ).order_by('distance')
+
+    def has_postal_code_nearest(self, postal_code):
+        """
+        Returns whether the nearest locations to the postal code have been
+        precomputed. Unknown postal codes, and those added since the table
+        was built, have none and are searched like without the table.
+        """
+        from locations.models import NearestLocation
+        return NearestLocation.objects.filter(
+                postal_code=postal_code).exists()
 
-        Trying this on Sqlite will yield a DatabaseError exception
+    def geohash_candidates(self, latitude, longitude):
+        """
+        Returns a list of the ids of the candidate public, geocoded locations
+        for a query in the geohash cell containing the given point, sorted by
+        distance from the cell's center.
 
+        Raw coordinates are practically never repeated, but the cells they
+        fall in are, so the candidate list is cached per cell and data
+        generation. The candidates are every location within the cell and
+        its neighbors, and within the distance of the
+        `LOCATIONS_GEOHASH_CANDIDATES`th location nearest to the center plus
+        the cell's diagonal. A point of the cell is never farther than that
+        from as many locations, so its nearest ones are all candidates,
+        wherever the point lies in the cell; re-ranking this small set
+        against the exact query point is then cheap. They are found in the
+        binary snapshot when it is available.
         """
-        # TODO: tests for type on latitude, longitude as well as database
-        # This is returning a queryset but not a queryset that can be iterated
-        # over until it's been coerced into a list
-        coefficient = 3959
+        cell = geohash.encode(latitude, longitude, conf.GEOHASH_PRECISION)
+        key = generation_key('geohash', cell)
+        candidates = cache.get(key)
+        if candidates is None:
+            center_lat, center_lng = geohash.decode(cell)
+            diagonal = 2 * farthest_corner(center_lat, center_lng, [cell])
+            neighborhood = farthest_corner(center_lat, center_lng, [cell] +
+                    geohash.neighbors(cell))
+            count = conf.GEOHASH_CANDIDATES
+            with instrumentation.phase('geohash_candidates'):
+                snapshot = current_snapshot()
+                if snapshot is not None:
+                    nearest = geo.k_nearest(center_lat, center_lng,
+                            snapshot.coordinates, count)
+                    if len(nearest) == count:
+                        nearest = geo.within(center_lat, center_lng,
+                                snapshot.coordinates, max(nearest[-1][1] +
+                                    diagonal, neighborhood))
+                    candidates = [int(snapshot.ids[index]) for index,
+                            distance in nearest]
+                else:
+                    nearest = list(self.distance(center_lat,
+                        center_lng).filter(is_active=True).exclude(
+                        latitude=None).order_by('distance').values_list('id',
+                        'distance')[:count])
+                    if len(nearest) == count:
+                        nearest = self.within(center_lat, center_lng,
+                                max(nearest[-1][1] + diagonal,
+                                    neighborhood)).filter(
+                                is_active=True).order_by(
+                                'distance').values_list('id', 'distance')
+                    candidates = [pk for pk, distance in nearest]
+            cache.set(key, candidates, conf.GEOHASH_CACHE_TIMEOUT)
+        return candidates
+
+    def distance(self, latitude, longitude):
+        """
+        Returns a QuerySet of locations annotated with their distance in miles
+        from the given point, nearest first. Locations without geolocation
+        come last on every database.
+
+        See `distance_sql` for the formula. SQLite needs to be built with its
+        math functions.
+        """
+        sql, params = distance_sql(latitude, longitude)
         return self.get_query_set().extra(select={
-            "distance": "%s * acos(cos(radians(%s)) * cos(radians(latitude)) "
-                        "* cos(radians(longitude) - radians(%s)) + "
-                        "sin(radians(%s)) * sin(radians(latitude)))"},
-                select_params=(coefficient, latitude, longitude,
-                    latitude)).order_by('distance')
+                    "distance": sql,
+                    "ungeocoded": "latitude IS NULL"},
+                select_params=params).order_by('ungeocoded', 'distance')
+
+    def within(self, latitude, longitude, radius):
+        """
+        Returns a QuerySet of the locations within `radius` miles of the
+        given point, annotated with their distance and nearest first.
+
+        The latitude and longitude columns are first narrowed down to the
+        bounding box of the search, split in two where it crosses the
+        antimeridian, so that the distance is only computed for the rows in
+        the box.
+        """
+        boxes = Q()
+        for south, west, north, east in geo.bounding_boxes(latitude,
+                longitude, radius):
+            boxes |= Q(latitude__range=(south, north),
+                    longitude__range=(west, east))
+        sql, params = distance_sql(latitude, longitude)
+        return self.distance(latitude, longitude).filter(boxes).extra(
+                where=["%s <= %%s" % sql], params=params + (radius,))
 
@@ -0,0 +1,41 @@
+import time
+
+from locations import conf, routers
+
+
+PINNING_COOKIE = 'locations_primary'
+
+
+class PrimaryPinningMiddleware(object):
+    """
+    Keeps a client's reads on the primary database for
+    `LOCATIONS_READ_PRIMARY_WINDOW` seconds after a request of theirs wrote
+    to it, so that they see their own changes despite replication lag.
+
+    Requests with unsafe methods are read from the primary altogether. The
+    end of the window is kept in a cookie rather than the session, which
+    would itself cost a write.
+    """
+
+    def process_request(self, request):
+        routers.reset()
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            routers.pin_to_primary()
+            return None
+        try:
+            until = float(request.COOKIES.get(PINNING_COOKIE, 0))
+        except ValueError:
+            return None
+        # Never trust the client with more than one window
+        until = min(until, time.time() + conf.READ_PRIMARY_WINDOW)
+        if until > time.time():
+            routers.pin_to_primary(until)
+        return None
+
+    def process_response(self, request, response):
+        if routers.has_written():
+            until = routers.pinned_until()
+            response.set_cookie(PINNING_COOKIE, "%.3f" % until,
+                    max_age=int(until - time.time()) + 1)
+        routers.reset()
+        return response
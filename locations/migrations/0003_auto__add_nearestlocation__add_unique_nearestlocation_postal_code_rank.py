@@ -0,0 +1,68 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'NearestLocation'
+        db.create_table('locations_nearestlocation', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('postal_code', self.gf('django.db.models.fields.CharField')(max_length=10, db_index=True)),
+            ('location', self.gf('django.db.models.fields.related.ForeignKey')(related_name='nearest_postal_codes', to=orm['locations.Location'])),
+            ('distance', self.gf('django.db.models.fields.FloatField')()),
+            ('rank', self.gf('django.db.models.fields.PositiveIntegerField')()),
+        ))
+        db.send_create_signal('locations', ['NearestLocation'])
+
+        # Adding unique constraint on 'NearestLocation', fields ['postal_code', 'rank']
+        db.create_unique('locations_nearestlocation', ['postal_code', 'rank'])
+
+
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'NearestLocation', fields ['postal_code', 'rank']
+        db.delete_unique('locations_nearestlocation', ['postal_code', 'rank'])
+
+        # Deleting model 'NearestLocation'
+        db.delete_table('locations_nearestlocation')
+
+
+    models = {
+        'locations.location': {
+            'Meta': {'ordering': "['name']", 'object_name': 'Location'},
+            'category': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['locations.LocationCategory']", 'symmetrical': 'False'}),
+            'city': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'latitude': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '18', 'decimal_places': '15', 'blank': 'True'}),
+            'longitude': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '18', 'decimal_places': '15', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'original_name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'postal_code': ('django.db.models.fields.CharField', [], {'max_length': '10', 'null': 'True', 'blank': 'True'}),
+            'state': ('django.contrib.localflavor.us.models.USStateField', [], {'max_length': '2'}),
+            'street_address': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'upload_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'blank': 'True'})
+        },
+        'locations.nearestlocation': {
+            'Meta': {'ordering': "['postal_code', 'rank']", 'unique_together': "(('postal_code', 'rank'),)", 'object_name': 'NearestLocation'},
+            'distance': ('django.db.models.fields.FloatField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'nearest_postal_codes'", 'to': "orm['locations.Location']"}),
+            'postal_code': ('django.db.models.fields.CharField', [], {'max_length': '10', 'db_index': 'True'}),
+            'rank': ('django.db.models.fields.PositiveIntegerField', [], {})
+        },
+        'locations.locationcategory': {
+            'Meta': {'object_name': 'LocationCategory'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '100', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['locations']
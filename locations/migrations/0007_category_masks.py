@@ -0,0 +1,75 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+# The mask is a signed 64-bit integer column
+MAX_CATEGORY_BITS = 63
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Assigns the category bits and computes the location category masks"
+        bits = {}
+        for category in orm['locations.LocationCategory'].objects.order_by('id')[:MAX_CATEGORY_BITS]:
+            category.bit = bits[category.pk] = len(bits)
+            category.save()
+        masks = {}
+        Membership = orm['locations.Location'].category.through
+        for location_id, category_id in Membership.objects.values_list('location_id', 'locationcategory_id'):
+            if category_id in bits:
+                masks[location_id] = masks.get(location_id, 0) | 1 << bits[category_id]
+        groups = {}
+        for location_id, mask in masks.items():
+            groups.setdefault(mask, []).append(location_id)
+        for mask, location_ids in groups.items():
+            for start in range(0, len(location_ids), 500):
+                orm['locations.Location'].objects.filter(pk__in=location_ids[start:start + 500]).update(category_mask=mask)
+
+    def backwards(self, orm):
+        "Clears the category bits and masks"
+        orm['locations.LocationCategory'].objects.update(bit=None)
+        orm['locations.Location'].objects.update(category_mask=0)
+
+    models = {
+        'locations.location': {
+            'Meta': {'ordering': "['name']", 'object_name': 'Location'},
+            'category': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['locations.LocationCategory']", 'symmetrical': 'False'}),
+            'category_mask': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'city': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'created_version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'latitude': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '18', 'decimal_places': '15', 'blank': 'True'}),
+            'longitude': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '18', 'decimal_places': '15', 'blank': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'original_name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'postal_code': ('django.db.models.fields.CharField', [], {'max_length': '10', 'null': 'True', 'blank': 'True'}),
+            'state': ('django.contrib.localflavor.us.models.USStateField', [], {'max_length': '2'}),
+            'street_address': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'upload_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'blank': 'True'}),
+            'version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'db_index': 'True'})
+        },
+        'locations.locationcategory': {
+            'Meta': {'object_name': 'LocationCategory'},
+            'bit': ('django.db.models.fields.PositiveSmallIntegerField', [], {'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '100'})
+        },
+        'locations.nearestlocation': {
+            'Meta': {'ordering': "['postal_code', 'rank']", 'unique_together': "(('postal_code', 'rank'),)", 'object_name': 'NearestLocation'},
+            'distance': ('django.db.models.fields.FloatField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'nearest_postal_codes'", 'to': "orm['locations.Location']"}),
+            'postal_code': ('django.db.models.fields.CharField', [], {'max_length': '10', 'db_index': 'True'}),
+            'rank': ('django.db.models.fields.PositiveIntegerField', [], {})
+        }
+    }
+
+    complete_apps = ['locations']
+    symmetrical = True
@@ -1,13 +1,22 @@
+from datetime import datetime
+
 from django.conf import settings
 from django.contrib.localflavor.us.models import USStateField
 from django.db import models
 from django.db.models import permalink
+from django.db.models.signals import (pre_save, post_save, pre_delete,
+        post_delete, m2m_changed)
 from django.utils.translation import ugettext_lazy as _
 
+from locations import conf
+from locations.cache import bump_generation, CATEGORY_GENERATION_KEY
 from locations.exceptions import PointException
-from locations.managers import LocationManager
-# Need to import this module somewhere
-from locations.filters import NullableFieldFilterSpec
+from locations.managers import LocationManager, BULK_UPDATE_BATCH_SIZE
+from locations.signals import locations_updated
+
+
+# Admin changelist image tags, keyed by whether the location has geodata
+GEOLOCATION_ICONS = {}
 
 
 class LocationCategory(models.Model):
@@ -16,6 +25,9 @@ class LocationCategory(models.Model):
     """
     name = models.CharField(max_length=100)
     slug = models.SlugField(max_length=100)
+    bit = models.PositiveSmallIntegerField(null=True, blank=True, unique=True,
+            editable=False,
+            help_text="The bit of the category in the location category masks")
 
     class Meta:
         verbose_name = "Location category"
@@ -47,6 +59,12 @@ class Location(models.Model):
             help_text="An optional description for this location")
     is_active = models.BooleanField(default=True)
     upload_count = models.IntegerField(default=0)
+    version = models.PositiveIntegerField(default=0, db_index=True,
+            editable=False)
+    created_version = models.PositiveIntegerField(default=0, editable=False)
+    modified = models.DateTimeField(auto_now=True, default=datetime.now)
+    category_mask = models.BigIntegerField(default=0, editable=False,
+            help_text="The bits of the location's categories")
 
     objects = LocationManager()
 
@@ -57,6 +75,13 @@ class Location(models.Model):
         return u"%s" % self.name
 
     def save(self, *args, **kwargs):
+        """
+        Stamps the location with the next change version, see
+        `LocationManager.next_version`.
+        """
+        self.version = Location.objects.next_version()
+        if not self.pk:
+            self.created_version = self.version
         return super(Location, self).save(*args, **kwargs)
 
     @permalink
@@ -114,14 +139,15 @@ class Location(models.Model):
     def admin_geolocation(self):
         """
         This method adds a custom column to the admin interface to display an
-        icon identifying whether this location has geodata.
+        icon identifying whether this location has geodata. The two possible
+        image tags are built once rather than for every row.
         """
-        if self.has_geolocation:
-            return u"<img src='%s%s'>" % (settings.STATIC_URL,
-                    'locations/green-globe.png')
-        else:
-            return u"<img src='%s%s'>" % (settings.STATIC_URL,
-                    'admin/img/admin/icon-no.gif')
+        if not GEOLOCATION_ICONS:
+            GEOLOCATION_ICONS[True] = u"<img src='%s%s'>" % (
+                    settings.STATIC_URL, 'locations/green-globe.png')
+            GEOLOCATION_ICONS[False] = u"<img src='%s%s'>" % (
+                    settings.STATIC_URL, 'admin/img/admin/icon-no.gif')
+        return GEOLOCATION_ICONS[self.has_geolocation]
     admin_geolocation.short_description = 'Geolocated?'
     admin_geolocation.allow_tags = True
 
@@ -136,3 +162,192 @@ class Location(models.Model):
         field.
         """
         return u"%s" % self.original_name if self.original_name else u"%s" % self.name
+
+
+class ChangeCounter(models.Model):
+    """
+    The single row holding the latest location change version, see
+    `LocationManager.next_version`.
+    """
+    version = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return u"%s" % self.version
+
+
+class NearestLocation(models.Model):
+    """
+    Precomputed nearest public locations for a postal code, ranked by their
+    distance from the postal code's centroid.
+    """
+    postal_code = models.CharField(max_length=10, db_index=True)
+    location = models.ForeignKey(Location,
+            related_name='nearest_postal_codes')
+    distance = models.FloatField()
+    rank = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['postal_code', 'rank']
+        unique_together = ('postal_code', 'rank')
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.postal_code, self.location_id)
+
+
+def location_categories(pks):
+    """
+    Returns a dictionary of the lists of categories of the locations with the
+    given ids. The ids are sent in batches to stay within the query
+    parameter limits of some databases.
+
+    The categories are resolved from the location category masks with the
+    in-memory category table, unless some category has no bit.
+    """
+    from locations.categories import (category_table,
+            categories_from_mask, all_categories_have_bits)
+    pks = list(pks)
+    location_categories = dict([(pk, []) for pk in pks])
+    if all_categories_have_bits():
+        for start in range(0, len(pks), BULK_UPDATE_BATCH_SIZE):
+            for pk, mask in Location.objects.filter(
+                    pk__in=pks[start:start + BULK_UPDATE_BATCH_SIZE]
+                    ).order_by().values_list('pk', 'category_mask'):
+                location_categories[pk] = categories_from_mask(mask)
+        return location_categories
+    memberships = []
+    for start in range(0, len(pks), BULK_UPDATE_BATCH_SIZE):
+        memberships.extend(Location.category.through.objects.filter(
+            location__in=pks[start:start + BULK_UPDATE_BATCH_SIZE]
+            ).values_list('location_id', 'locationcategory_id'))
+    categories = category_table()
+    for location_id, category_id in memberships:
+        location_categories[location_id].append(categories[category_id])
+    return location_categories
+
+
+def invalidate_location_caches(sender, **kwargs):
+    """Invalidates all cached location data when a location changes"""
+    bump_generation()
+
+
+def uncache_location(sender, instance, **kwargs):
+    """Removes a changed location from the object cache"""
+    Location.objects.uncache([instance.pk])
+
+
+def uncache_many_locations(sender, pks, **kwargs):
+    """Removes the changed locations from the object cache"""
+    Location.objects.uncache(pks)
+
+
+def invalidate_category_caches(sender, **kwargs):
+    """
+    Invalidates all cached location data, including the rendered location
+    fragments, when a category or a location's categories change
+    """
+    bump_generation()
+    bump_generation(CATEGORY_GENERATION_KEY)
+
+
+def assign_category_bit(sender, instance, **kwargs):
+    """Assigns the lowest free mask bit to a new category"""
+    from locations.categories import free_bit
+    if instance.bit is None:
+        instance.bit = free_bit()
+
+
+def clear_category_bit(sender, instance, **kwargs):
+    """Clears the bit of a deleted category from the location masks"""
+    from locations.categories import update_category_masks
+    if instance.bit is not None:
+        update_category_masks(Location.objects.extra(
+            where=["(category_mask & %s) != 0"], params=[1 << instance.bit]
+            ).order_by().values_list('pk', flat=True))
+
+
+def sync_category_masks(sender, instance, action, reverse, pk_set,
+        **kwargs):
+    """Updates the category masks of the locations whose categories changed"""
+    from locations.categories import (update_category_masks,
+            filter_categories)
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        pks = [instance.pk]
+    elif action == 'post_clear':
+        # The memberships are gone, so look for the category's bit instead
+        pks = filter_categories(Location.objects.order_by(),
+                [instance.pk]).values_list('pk', flat=True)
+    else:
+        pks = pk_set
+    update_category_masks(pks)
+
+
+def collect_nearest_postal_codes(sender, instance, **kwargs):
+    """
+    Remembers the postal codes listing a location about to be deleted, as
+    the deletion cascades to their nearest location rows
+    """
+    from locations.nearest import listing_postal_codes
+    if conf.POSTAL_NEAREST:
+        instance._nearest_postal_codes = listing_postal_codes([instance])
+
+
+def update_nearest_locations(sender, instance, raw=False, **kwargs):
+    """Updates the nearest locations of postal codes near the location"""
+    from locations.nearest import refresh_nearest_locations
+    if conf.POSTAL_NEAREST and not raw:
+        refresh_nearest_locations([instance], codes=getattr(instance,
+            '_nearest_postal_codes', ()))
+
+
+def update_many_nearest_locations(sender, pks, **kwargs):
+    """Updates the nearest locations of postal codes near the locations"""
+    from locations.nearest import refresh_nearest_locations
+    if conf.POSTAL_NEAREST:
+        refresh_nearest_locations(list(Location.objects.filter(pk__in=pks)))
+
+
+def advance_version(sender, action=None, raw=False, **kwargs):
+    """
+    Advances the change version when a location is deleted or categories
+    change, as no location is stamped, so that the snapshots and responses
+    tagged with the previous version are no longer served
+    """
+    if not raw and action in (None, 'post_add', 'post_remove', 'post_clear'):
+        Location.objects.next_version()
+
+
+def republish_snapshots(sender, **kwargs):
+    """Republishes the static feed snapshots and the binary snapshot"""
+    from locations.publish import publish_snapshots
+    from locations.snapshot import build_snapshot
+    if conf.SNAPSHOT_AUTO and conf.SNAPSHOT_ROOT:
+        publish_snapshots()
+    if conf.SNAPSHOT_AUTO and conf.BINARY_SNAPSHOT_ROOT:
+        build_snapshot()
+
+post_save.connect(invalidate_location_caches, sender=Location)
+post_delete.connect(invalidate_location_caches, sender=Location)
+locations_updated.connect(invalidate_location_caches, sender=Location)
+post_save.connect(uncache_location, sender=Location)
+post_delete.connect(uncache_location, sender=Location)
+locations_updated.connect(uncache_many_locations, sender=Location)
+post_save.connect(update_nearest_locations, sender=Location)
+pre_delete.connect(collect_nearest_postal_codes, sender=Location)
+post_delete.connect(update_nearest_locations, sender=Location)
+locations_updated.connect(update_many_nearest_locations, sender=Location)
+post_delete.connect(advance_version, sender=Location)
+post_save.connect(republish_snapshots, sender=Location)
+post_delete.connect(republish_snapshots, sender=Location)
+locations_updated.connect(republish_snapshots, sender=Location)
+post_save.connect(advance_version, sender=LocationCategory)
+post_delete.connect(advance_version, sender=LocationCategory)
+m2m_changed.connect(advance_version, sender=Location.category.through)
+post_save.connect(invalidate_category_caches, sender=LocationCategory)
+post_delete.connect(invalidate_category_caches, sender=LocationCategory)
+m2m_changed.connect(invalidate_category_caches,
+        sender=Location.category.through)
+pre_save.connect(assign_category_bit, sender=LocationCategory)
+post_delete.connect(clear_category_bit, sender=LocationCategory)
+m2m_changed.connect(sync_category_masks, sender=Location.category.through)
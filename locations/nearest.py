@@ -0,0 +1,202 @@
+"""
+Builds and maintains the precomputed table of the locations nearest to each
+postal code.
+
+Postal code searches only ever use the postal code's centroid, so the nearest
+locations for each postal code are fully deterministic and can be stored in
+the `NearestLocation` table, turning a postal code search into a single
+indexed lookup.
+"""
+from multiprocessing import Pool
+
+from django.db import connection, transaction
+from django.db.models import Q
+
+from postalcodes.models import PostalCode
+
+from locations import conf, geo
+from locations.models import Location, NearestLocation
+
+
+# The location points are shared with the worker processes once, through the
+# pool initializer, rather than pickled with every chunk of work
+_location_ids = None
+_location_coordinates = None
+
+
+def _init_worker(location_points):
+    global _location_ids, _location_coordinates
+    _location_ids = [point[0] for point in location_points]
+    _location_coordinates = geo.Coordinates.from_points(
+            [point[1:] for point in location_points])
+
+
+def _nearest_chunk(args):
+    postal_points, count = args
+    return [(code, [(_location_ids[index], distance) for index, distance in
+        geo.k_nearest(lat, lng, _location_coordinates, count)])
+        for code, lat, lng in postal_points]
+
+
+def postal_code_points(queryset=None):
+    """Returns (code, latitude, longitude) tuples of located postal codes"""
+    if queryset is None:
+        queryset = PostalCode.objects.all()
+    return [(code, float(lat), float(lng)) for code, lat, lng in
+            queryset.exclude(latitude=None).exclude(longitude=None).values_list(
+                'code', 'latitude', 'longitude')]
+
+
+def location_points():
+    """Returns (id, latitude, longitude) tuples of public geocoded locations"""
+    return [(pk, float(lat), float(lng)) for pk, lat, lng in
+            Location.objects.geocoded().values_list(
+                'id', 'latitude', 'longitude')]
+
+
+def compute_nearest(postal_points, locations, count, processes=1,
+        chunk_size=500):
+    """
+    Returns a list of (code, [(location_id, distance), ...]) tuples with the
+    `count` locations nearest to each postal code.
+
+    With more than one process the postal codes are split in chunks across a
+    pool of worker processes.
+    """
+    chunks = [(postal_points[start:start + chunk_size], count)
+            for start in range(0, len(postal_points), chunk_size)]
+    if processes == 1:
+        _init_worker(locations)
+        results = map(_nearest_chunk, chunks)
+    else:
+        pool = Pool(processes, _init_worker, (locations,))
+        try:
+            results = pool.map(_nearest_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    return [row for chunk in results for row in chunk]
+
+
+def _insert_nearest(results):
+    """Writes the computed rows in a single batch"""
+    rows = []
+    for code, nearest in results:
+        for rank, (location_id, distance) in enumerate(nearest):
+            rows.append((code, location_id, distance, rank))
+    cursor = connection.cursor()
+    cursor.executemany("INSERT INTO %s (postal_code, location_id, distance, "
+            "rank) VALUES (%%s, %%s, %%s, %%s)" % NearestLocation._meta.db_table,
+            rows)
+    # Raw queries are not committed by Django outside of managed
+    # transactions, unlike the ORM delete that precedes them
+    transaction.commit_unless_managed()
+    return len(rows)
+
+
+@transaction.commit_on_success
+def _replace_all_nearest(results):
+    NearestLocation.objects.all().delete()
+    return _insert_nearest(results)
+
+
+def rebuild_nearest_locations(count=None, processes=None):
+    """
+    Rebuilds the whole nearest locations table and returns the number of rows
+    written. The distances are computed by a pool of `processes` workers,
+    defaulting to the number of CPUs.
+    """
+    count = count or conf.POSTAL_NEAREST_COUNT
+    postal_points = postal_code_points()
+    locations = location_points()
+    # Worker processes must not share the parent's database connection
+    connection.close()
+    results = compute_nearest(postal_points, locations, count,
+            processes=processes)
+    return _replace_all_nearest(results)
+
+
+def listing_postal_codes(locations):
+    """Returns the set of the postal codes listing any of the locations"""
+    return set(NearestLocation.objects.filter(
+        location__in=[location.pk for location in locations]).values_list(
+            'postal_code', flat=True))
+
+
+def exact_nearest(latitude, longitude, count):
+    """
+    Returns the [(location_id, distance), ...] of the `count` public
+    geocoded locations nearest to the point, ranked by the database.
+    """
+    return list(Location.objects.distance(latitude, longitude).filter(
+        is_active=True).exclude(latitude=None).order_by('distance')
+        .values_list('id', 'distance')[:count])
+
+
+def refresh_nearest_locations(locations, radius=None, count=None,
+        codes=()):
+    """
+    Recomputes the nearest locations of the postal codes affected by changes
+    to the given locations: those within `radius` miles of any of them, those
+    which currently list any of them, and the given `codes`, which lets
+    deleted locations pass the postal codes that listed them before their
+    rows were cascade-deleted.
+
+    Only the changed locations are measured against each postal code and
+    merged into its current list, as the locations it leaves out are no
+    nearer than its last one. The database ranks all the locations again
+    for the postal codes without a list, those given in `codes`, and those
+    whose list a changed location leaves or moves beyond the last one of,
+    as an unlisted location may now come first.
+
+    This runs in the caller's transaction when it is managed, usually from a
+    signal handler, and commits its changes otherwise.
+    """
+    radius = radius or conf.POSTAL_NEAREST_RADIUS
+    count = count or conf.POSTAL_NEAREST_COUNT
+    exact = set(codes)
+    codes = listing_postal_codes(locations) | exact
+    changed = {}
+    for location in locations:
+        if not (location.has_geolocation and location.is_active):
+            continue
+        latitude, longitude = location.float_point()
+        changed[location.pk] = (latitude, longitude)
+        boxes = Q()
+        for south, west, north, east in geo.bounding_boxes(latitude,
+                longitude, radius):
+            boxes |= Q(latitude__gte=south, latitude__lte=north,
+                    longitude__gte=west, longitude__lte=east)
+        candidates = PostalCode.objects.filter(boxes)
+        codes.update([code for code, lat, lng in
+                postal_code_points(candidates) if
+                geo.haversine(latitude, longitude, lat, lng) <= radius])
+    if not codes:
+        return 0
+    listed = dict([(code, {}) for code in codes])
+    for code, location_id, distance in NearestLocation.objects.filter(
+            postal_code__in=codes).values_list('postal_code', 'location_id',
+                    'distance'):
+        listed[code][location_id] = distance
+    pks = set([location.pk for location in locations])
+    results = []
+    for code, lat, lng in postal_code_points(PostalCode.objects.filter(
+            code__in=codes)):
+        distances = listed[code]
+        merged = dict([(pk, geo.haversine(lat, lng, point[0], point[1]))
+            for pk, point in changed.items()])
+        if distances and len(distances) == count:
+            last = max(distances.values())
+            if [pk for pk in pks & set(distances) if merged.get(pk,
+                    last + 1) > last]:
+                exact.add(code)
+        if not distances or code in exact:
+            results.append((code, exact_nearest(lat, lng, count)))
+            continue
+        for pk, distance in distances.items():
+            if pk not in pks:
+                merged[pk] = distance
+        results.append((code, sorted(merged.items(),
+            key=lambda item: item[1])[:count]))
+    NearestLocation.objects.filter(postal_code__in=codes).delete()
+    return _insert_nearest(results)
@@ -0,0 +1,179 @@
+"""
+In-memory spatial index of the postal code centroids.
+
+The located postal codes are read once per process and bucketed in a grid of
+`CELL_SIZE` degree cells. Each cell is a contiguous range of flat arrays of
+codes, latitudes and longitudes sorted by cell, so the index takes a few
+megabytes for every US postal code. A nearest postal code query scans the
+rings of cells around the point until no unscanned cell can hold a nearer
+centroid, which takes microseconds rather than a distance query over the
+whole `PostalCode` table.
+
+The index is dropped whenever a postal code changes and rebuilt on the next
+query.
+"""
+import math
+import threading
+from array import array
+
+from django.db.models.signals import post_save, post_delete
+
+from postalcodes.models import PostalCode
+
+from locations import geo
+
+
+# Side of the grid cells in degrees
+CELL_SIZE = 0.2
+
+_index = None
+_lock = threading.Lock()
+
+
+class PostalCodeIndex(object):
+    """
+    A grid index of (code, latitude, longitude) postal code points.
+    """
+    def __init__(self, points, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.columns = int(math.ceil(360.0 / cell_size))
+        self.rows = int(math.ceil(180.0 / cell_size))
+        points = sorted([(self.cell(lat, lng), code, lat, lng) for code,
+            lat, lng in points])
+        self.codes = [point[1] for point in points]
+        self.latitudes = array('d', [point[2] for point in points])
+        self.longitudes = array('d', [point[3] for point in points])
+        # Precomputed haversine terms
+        self._radians = array('d', [math.radians(point[2]) for point in
+            points])
+        self._lng_radians = array('d', [math.radians(point[3]) for point in
+            points])
+        self._cosines = array('d', [math.cos(value) for value in
+            self._radians])
+        # Cell -> (start, end) range of the arrays
+        self.cells = {}
+        for index, point in enumerate(points):
+            start, end = self.cells.get(point[0], (index, index))
+            self.cells[point[0]] = (start, index + 1)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def cell(self, latitude, longitude):
+        row = min(int((latitude + 90.0) / self.cell_size), self.rows - 1)
+        column = int((geo.normalize_longitude(longitude) + 180.0) /
+                self.cell_size) % self.columns
+        return row, column
+
+    def ring(self, row, column, radius):
+        """Returns the cells at `radius` cells from the given cell"""
+        cells = set()
+        for y in range(row - radius, row + radius + 1):
+            if y < 0 or y >= self.rows:
+                continue
+            if y in (row - radius, row + radius):
+                xs = range(column - radius, column + radius + 1)
+            else:
+                xs = (column - radius, column + radius)
+            for x in xs:
+                cells.add((y, x % self.columns))
+        return cells
+
+    def lower_bound(self, latitude, longitude, row, column, radius,
+            earth_radius):
+        """
+        Returns the least distance from the point to any point outside of
+        the cells within `radius` cells of its cell.
+        """
+        south = (row - radius) * self.cell_size - 90.0
+        north = (row + radius + 1) * self.cell_size - 90.0
+        west = (column - radius) * self.cell_size - 180.0
+        east = (column + radius + 1) * self.cell_size - 180.0
+        lat_degrees = min(latitude - south if south > -90.0 else 180.0,
+                north - latitude if north < 90.0 else 180.0)
+        lng_degrees = min(geo.normalize_longitude(longitude) - west,
+                east - geo.normalize_longitude(longitude))
+        # The distance to the nearest meridian beyond the cells, or to the
+        # nearest pole when they are more than 90 degrees away
+        lng_distance = math.asin(math.cos(math.radians(latitude)) *
+                math.sin(math.radians(min(lng_degrees, 90.0))))
+        return earth_radius * min(math.radians(lat_degrees), lng_distance)
+
+    def nearest(self, latitude, longitude, max_distance=None,
+            radius=geo.EARTH_RADIUS_MILES):
+        """
+        Returns the (code, latitude, longitude, distance) of the postal code
+        nearest to the point, or None if there is none within
+        `max_distance`.
+
+        Candidates are compared by the haversine term of their distance,
+        which grows with it, saving the square root and arcsine of each.
+        """
+        if not self.codes:
+            return None
+        sin, cos = math.sin, math.cos
+        lat1, lng1 = math.radians(latitude), math.radians(longitude)
+        cos1 = cos(lat1)
+        radians, lng_radians, cosines = (self._radians, self._lng_radians,
+                self._cosines)
+        row, column = self.cell(latitude, longitude)
+        best = None
+        best_term = None
+        if max_distance is not None:
+            best_term = haversine_term(max_distance, radius)
+        # The rings cover the whole globe long before the last radius
+        for ring_radius in xrange(max(self.rows, self.columns // 2 + 1)):
+            for cell in self.ring(row, column, ring_radius):
+                start, end = self.cells.get(cell, (0, 0))
+                for index in xrange(start, end):
+                    term = sin((radians[index] - lat1) / 2) ** 2 + cos1 * \
+                            cosines[index] * sin((lng_radians[index] - lng1) /
+                                    2) ** 2
+                    if best_term is None or term < best_term:
+                        best, best_term = index, term
+            if best_term is not None and best_term <= haversine_term(
+                    self.lower_bound(latitude, longitude, row, column,
+                        ring_radius, radius), radius):
+                break
+        if best is None:
+            return None
+        return (self.codes[best], self.latitudes[best], self.longitudes[best],
+                2 * radius * math.asin(min(1.0, math.sqrt(best_term))))
+
+
+def haversine_term(distance, radius=geo.EARTH_RADIUS_MILES):
+    """Returns the haversine term of a great circle distance"""
+    return math.sin(min(math.pi, distance / float(radius)) / 2) ** 2
+
+
+def postal_code_index():
+    """Returns the index of the located postal codes, loading it once"""
+    global _index
+    index = _index
+    if index is None:
+        with _lock:
+            if _index is None:
+                _index = PostalCodeIndex([(code, float(lat), float(lng))
+                    for code, lat, lng in PostalCode.objects.exclude(
+                        latitude=None).exclude(longitude=None).values_list(
+                        'code', 'latitude', 'longitude')])
+            index = _index
+    return index
+
+
+def nearest_postal_code(latitude, longitude, max_distance=None):
+    """
+    Returns the (code, latitude, longitude, distance) of the postal code
+    nearest to the point, or None if there is none within `max_distance`
+    miles.
+    """
+    return postal_code_index().nearest(latitude, longitude, max_distance)
+
+
+def reset_index(sender=None, **kwargs):
+    """Drops the index, which is rebuilt on the next query"""
+    global _index
+    _index = None
+
+post_save.connect(reset_index, sender=PostalCode)
+post_delete.connect(reset_index, sender=PostalCode)
@@ -0,0 +1,165 @@
+"""
+Publishes the location feeds as static, precompressed snapshot files.
+
+The KML feed, the full JSON list and the geo sitemap are rendered once per
+generation and written to `LOCATIONS_SNAPSHOT_ROOT` along with gzip and,
+when the `brotli` package is installed, brotli compressed copies:
+
+    locations-kml.<generation>.kml
+    locations-kml.<generation>.kml.gz
+    locations-kml.<generation>.kml.br
+
+so that the web server can serve them (e.g. with nginx's gzip_static)
+without touching Python or the database. Files are written atomically and
+only the last few generations are kept.
+
+The generation is the latest change version stored in the database (see
+`LocationManager.current_version`) rather than the cache generation, which
+the default local memory cache keeps per process: every worker must agree on
+the file names, whichever process published them.
+"""
+import gzip
+import os
+import re
+import tempfile
+from StringIO import StringIO
+
+from django.core.urlresolvers import reverse
+from django.template.loader import render_to_string
+from django.utils import simplejson as json
+
+from locations import conf
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Snapshot names and their file extensions
+SNAPSHOTS = {
+    'kml': 'kml',
+    'json': 'json',
+    'sitemap': 'xml',
+}
+KEEP_GENERATIONS = 2
+FILE_PATTERN = re.compile(r'^locations-(?P<name>\w+)\.(?P<generation>\d+)\.')
+
+
+def current_generation():
+    """Returns the generation of the snapshots, the latest change version"""
+    from locations.models import Location
+    return Location.objects.current_version()
+
+
+def snapshot_filename(name, generation):
+    return "locations-%s.%s.%s" % (name, generation, SNAPSHOTS[name])
+
+
+def atomic_write(path, data):
+    """
+    Writes the data to a temporary file in the same directory and renames it
+    into place, so readers never see a partially written file.
+    """
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        temp_file = os.fdopen(fd, 'wb')
+        try:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        finally:
+            temp_file.close()
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def gzip_compress(data):
+    buffer = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9)
+    try:
+        gzip_file.write(data)
+    finally:
+        gzip_file.close()
+    return buffer.getvalue()
+
+
+def render_snapshots():
+    """Returns a dictionary of the rendered snapshot contents by name"""
+    from django.contrib.sites.models import Site
+    from locations.models import Location
+    from locations.views import location_dicts
+
+    locations = list(Location.objects.public().order_by('name'))
+    memberships = {}
+    through = Location.category.through
+    for membership in through.objects.filter(
+            location__is_active=True).select_related('locationcategory'):
+        memberships.setdefault(membership.location_id, []).append(
+                membership.locationcategory)
+    return {
+        'kml': render_to_string("locations/location_list.xml", {
+            'locations': [location for location in locations
+                if location.latitude is not None],
+        }).encode('utf-8'),
+        'json': json.dumps(location_dicts([(location,
+            memberships.get(location.pk, [])) for location in locations])),
+        'sitemap': render_to_string('locations/geo_sitemap.xml', {
+            'site': Site.objects.get_current(),
+            'url': reverse('location_kml'),
+        }).encode('utf-8'),
+    }
+
+
+def publish_snapshots(root=None):
+    """
+    Renders and writes the snapshots of the current generation and removes
+    those of old generations. Returns the generation.
+    """
+    root = root or conf.SNAPSHOT_ROOT
+    generation = current_generation()
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    for name, content in render_snapshots().items():
+        path = os.path.join(root, snapshot_filename(name, generation))
+        # The uncompressed file is written last: its presence marks the
+        # snapshot as complete
+        atomic_write(path + '.gz', gzip_compress(content))
+        if brotli is not None:
+            atomic_write(path + '.br', brotli.compress(content))
+        atomic_write(path, content)
+    prune_snapshots(root, generation)
+    return generation
+
+
+def prune_snapshots(root, generation, keep=KEEP_GENERATIONS):
+    """Removes the snapshot files of all but the last `keep` generations"""
+    generations = set([generation])
+    files = []
+    for filename in os.listdir(root):
+        match = FILE_PATTERN.match(filename)
+        if match:
+            files.append((int(match.group('generation')), filename))
+            generations.add(int(match.group('generation')))
+    kept = sorted(generations)[-keep:]
+    for file_generation, filename in files:
+        if file_generation not in kept:
+            os.remove(os.path.join(root, filename))
+
+
+def snapshot_url(name):
+    """
+    Returns the URL of the current generation's snapshot, or None if
+    snapshots are not configured or it has not been published.
+    """
+    if not conf.SNAPSHOT_ROOT or not conf.SNAPSHOT_URL:
+        return None
+    filename = snapshot_filename(name, current_generation())
+    if not os.path.exists(os.path.join(conf.SNAPSHOT_ROOT, filename)):
+        return None
+    return conf.SNAPSHOT_URL + filename
@@ -0,0 +1,92 @@
+"""
+Database router sending the locations reads to a read replica.
+
+Set `LOCATIONS_READ_DATABASE` to the alias of the replica and add the router
+to the project settings:
+
+    DATABASE_ROUTERS = ['locations.routers.LocationRouter']
+
+Searches, list views, feeds and the state choices of the locations and postal
+codes are then read from the replica, while every write goes to the default
+database. As the replica lags behind, the current thread is pinned to the
+primary for `LOCATIONS_READ_PRIMARY_WINDOW` seconds after any write, so that
+a request reads its own writes. Add the
+`locations.middleware.PrimaryPinningMiddleware` to extend the window to the
+following requests of the same client.
+"""
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+
+from locations import conf
+
+
+# Apps whose models are read from the replica
+READ_APPS = ('locations', 'postalcodes')
+
+_local = threading.local()
+
+
+def pinned_until():
+    """Returns the time until which reads go to the primary"""
+    return getattr(_local, 'until', 0)
+
+
+def is_pinned():
+    return time.time() < pinned_until()
+
+
+def pin_to_primary(until=None):
+    """
+    Sends the reads of the current thread to the primary until the given
+    time, by default `LOCATIONS_READ_PRIMARY_WINDOW` seconds from now.
+    """
+    if until is None:
+        until = time.time() + conf.READ_PRIMARY_WINDOW
+    _local.until = max(until, pinned_until())
+
+
+def has_written():
+    """Returns whether the current thread has written since `reset`"""
+    return getattr(_local, 'written', False)
+
+
+def reset():
+    _local.until = 0
+    _local.written = False
+
+
+class LocationRouter(object):
+    """
+    Routes the reads of the location models to `LOCATIONS_READ_DATABASE`
+    unless the current thread is pinned to the primary. Without a read
+    database the router has no opinion.
+    """
+
+    def db_for_read(self, model, **hints):
+        if (conf.READ_DATABASE and model._meta.app_label in READ_APPS and
+                not is_pinned()):
+            return conf.READ_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        if not conf.READ_DATABASE or model._meta.app_label not in READ_APPS:
+            return None
+        _local.written = True
+        pin_to_primary()
+        # Instances read from the replica would otherwise be saved back to it
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (DEFAULT_DB_ALIAS, conf.READ_DATABASE)
+        if (conf.READ_DATABASE and obj1._state.db in databases and
+                obj2._state.db in databases):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if (conf.READ_DATABASE and db == conf.READ_DATABASE and
+                model._meta.app_label in READ_APPS):
+            return False
+        return None
@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+
+# Sent for every timed phase when instrumentation is enabled. The duration is
+# in seconds; the query count is None unless DEBUG is on.
+phase_timed = Signal(providing_args=['phase', 'duration', 'queries'])
+
+# Sent once after a set-based update of many locations, which bypasses the
+# model's save signals.
+locations_updated = Signal(providing_args=['pks'])
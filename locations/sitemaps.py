@@ -0,0 +1,76 @@
+"""
+Sitemaps of the public location detail pages.
+
+The locations are split into chunks by consecutive ranges of
+`LOCATIONS_SITEMAP_CHUNK_SIZE` ids, so that a chunk never lists more URLs
+than that; the sitemap protocol allows at most 50,000. Chunks are read with
+range queries on the primary key rather than with offsets, and a change to a
+location only ever affects the chunk of its id.
+
+A rendered chunk is cached under its location count and latest modification
+time, which both change when any of its locations is changed, added or
+removed, so only the changed chunks are rendered again.
+"""
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db.models import Count, Max, Min
+from django.template.loader import render_to_string
+
+from locations import conf
+from locations.cache import generation_key
+from locations.models import Location
+
+
+def chunk_queryset(chunk):
+    """Returns a QuerySet of the public locations in the chunk"""
+    size = conf.SITEMAP_CHUNK_SIZE
+    return Location.objects.public().filter(pk__gt=chunk * size,
+            pk__lte=(chunk + 1) * size)
+
+
+def sitemap_chunks():
+    """
+    Returns a list of (chunk, count, lastmod) tuples of the chunks with
+    public locations, cached for the current data generation.
+    """
+    key = generation_key('sitemap_chunks', conf.SITEMAP_CHUNK_SIZE)
+    chunks = cache.get(key)
+    if chunks is None:
+        ids = Location.objects.public().aggregate(first=Min('id'),
+                last=Max('id'))
+        chunks = []
+        if ids['first'] is None:
+            return chunks
+        size = conf.SITEMAP_CHUNK_SIZE
+        for chunk in range((ids['first'] - 1) // size,
+                (ids['last'] - 1) // size + 1):
+            stats = chunk_queryset(chunk).aggregate(count=Count('id'),
+                    lastmod=Max('modified'))
+            if stats['count']:
+                chunks.append((chunk, stats['count'], stats['lastmod']))
+        cache.set(key, chunks, conf.SITEMAP_CACHE_TIMEOUT)
+    return chunks
+
+
+def chunk_etag(chunk, count, lastmod):
+    return '"%s-%s-%s-%s"' % (conf.SITEMAP_CHUNK_SIZE, chunk, count,
+            lastmod.strftime('%Y%m%d%H%M%S%f'))
+
+
+def render_chunk(site, chunk, count, lastmod):
+    """
+    Returns the sitemap XML of the chunk's location detail pages, ordered by
+    id, from the cache unless the chunk changed.
+    """
+    key = "locations:sitemap:%s:%s" % (site.domain, chunk_etag(chunk, count,
+        lastmod).strip('"'))
+    content = cache.get(key)
+    if content is None:
+        content = render_to_string("locations/location_sitemap.xml", {
+            'site': site,
+            'urls': [(reverse('location_detail', kwargs={'pk': pk}), modified)
+                for pk, modified in chunk_queryset(chunk).order_by(
+                    'pk').values_list('pk', 'modified').iterator()],
+        }).encode('utf-8')
+        cache.set(key, content, conf.SITEMAP_CACHE_TIMEOUT)
+    return content
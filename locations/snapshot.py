@@ -0,0 +1,221 @@
+"""
+Memory-mapped binary snapshot of the geocoded public locations.
+
+Unlike the published feed snapshots, which are served to clients by the web
+server, this snapshot is read by the application itself. The nearest
+location searches rank the locations by its coordinates, see
+`LocationManager.geosearch_many` and `LocationManager.geohash_candidates`,
+and the JSON list view reads the listed locations from it, see
+`LocationSnapshot.locations`. The builder writes the locations of the
+current generation to `LOCATIONS_BINARY_SNAPSHOT_ROOT` as a single binary
+file:
+
+    header      magic, generation, location count, string table size
+    ids         int64 per location, ascending
+    latitudes   float64 per location
+    longitudes  float64 per location
+    masks       int64 category mask per location
+    offsets     uint32 per string field of each location, plus the end
+    strings     the UTF-8 encoded string fields, or a single 0xff byte,
+                which is never valid UTF-8, for a null field
+
+Every worker process maps the file read-only, so the operating system keeps
+a single copy in the page cache however many workers there are, and a
+starting worker does not read the locations from the database. With NumPy
+installed the numeric columns are used in place; otherwise they are copied
+into arrays.
+
+The generation is the latest change version stored in the database, like
+that of the published snapshots (see `locations.publish`), so every worker
+agrees on it. A data change moves on to a new generation, after which
+workers ignore the mapped snapshot until the snapshot of the new generation
+has been built, with the `build_location_snapshot` command or automatically
+with `LOCATIONS_SNAPSHOT_AUTO`, and then map it in its place.
+"""
+import bisect
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from locations import conf, geo
+from locations.publish import atomic_write, current_generation, \
+        prune_snapshots
+
+
+MAGIC = 'LOCSNAP3'
+HEADER = struct.Struct('<8sQQQ')
+# The string fields stored for each location
+FIELDS = ('name', 'street_address', 'city', 'state', 'postal_code')
+NULL = '\xff'
+
+_current = None
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def snapshot_filename(generation):
+    # Matches the publish file pattern, so the files are pruned alike
+    return "locations-binary.%s.bin" % generation
+
+
+def render_snapshot(generation):
+    """Returns the binary snapshot of the geocoded public locations"""
+    from locations.models import Location
+    rows = list(Location.objects.geocoded().order_by('id').values_list('id',
+        'latitude', 'longitude', 'category_mask', *FIELDS))
+    count = len(rows)
+    strings = []
+    offsets = [0]
+    for row in rows:
+        for value in row[4:]:
+            strings.append(NULL if value is None else value.encode('utf-8'))
+            offsets.append(offsets[-1] + len(strings[-1]))
+    return ''.join([
+        HEADER.pack(MAGIC, generation, count, offsets[-1]),
+        struct.pack('<%dq' % count, *[row[0] for row in rows]),
+        struct.pack('<%dd' % count, *[float(row[1]) for row in rows]),
+        struct.pack('<%dd' % count, *[float(row[2]) for row in rows]),
+        struct.pack('<%dq' % count, *[row[3] for row in rows]),
+        struct.pack('<%dI' % len(offsets), *offsets),
+    ] + strings)
+
+
+def build_snapshot(root=None):
+    """
+    Writes the snapshot of the current generation and removes those of old
+    generations. Returns the generation.
+    """
+    root = root or conf.BINARY_SNAPSHOT_ROOT
+    generation = current_generation()
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    atomic_write(os.path.join(root, snapshot_filename(generation)),
+            render_snapshot(generation))
+    prune_snapshots(root, generation)
+    return generation
+
+
+class LocationSnapshot(object):
+    """
+    A read-only, memory-mapped snapshot file. The mapping is released when
+    the instance is garbage collected, so threads still using a replaced
+    snapshot are never left with a closed map.
+    """
+    def __init__(self, path):
+        self.path = path
+        snapshot_file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(snapshot_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        finally:
+            snapshot_file.close()
+        if len(self._map) < HEADER.size:
+            raise SnapshotError("%s is not a location snapshot" % path)
+        magic, self.generation, self.count, strings_size = \
+                HEADER.unpack_from(self._map)
+        self._offsets = HEADER.size + 32 * self.count
+        self._strings = self._offsets + 4 * (len(FIELDS) * self.count + 1)
+        if magic != MAGIC or len(self._map) != self._strings + strings_size:
+            raise SnapshotError("%s is not a location snapshot" % path)
+        self.ids = self._column('q', HEADER.size)
+        self.coordinates = geo.Coordinates(
+                self._column('d', HEADER.size + 8 * self.count),
+                self._column('d', HEADER.size + 16 * self.count))
+        self.masks = self._column('q', HEADER.size + 24 * self.count)
+
+    def _column(self, typecode, offset):
+        numpy = geo.get_numpy()
+        if numpy is not None:
+            return numpy.frombuffer(self._map, dtype='<' + {'q': 'i8',
+                'd': 'f8'}[typecode], count=self.count, offset=offset)
+        if typecode == 'q':
+            return list(struct.unpack_from('<%dq' % self.count, self._map,
+                offset))
+        column = array(typecode, self._map[offset:offset + 8 * self.count])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+    def __len__(self):
+        return self.count
+
+    def index(self, pk):
+        """Returns the index of the location with the id, or None"""
+        index = bisect.bisect_left(self.ids, pk)
+        if index < self.count and self.ids[index] == pk:
+            return index
+        return None
+
+    def record(self, index):
+        """Returns the dictionary of the location at the given index"""
+        offsets = struct.unpack_from('<%dI' % (len(FIELDS) + 1), self._map,
+                self._offsets + 4 * len(FIELDS) * index)
+        record = {
+            'id': int(self.ids[index]),
+            'latitude': float(self.coordinates.latitudes[index]),
+            'longitude': float(self.coordinates.longitudes[index]),
+            'category_mask': int(self.masks[index]),
+        }
+        for field, start, end in zip(FIELDS, offsets, offsets[1:]):
+            value = self._map[self._strings + start:self._strings + end]
+            record[field] = None if value == NULL else value.decode('utf-8')
+        return record
+
+    def get(self, pk):
+        """Returns the dictionary of the location with the id, or None"""
+        index = self.index(pk)
+        if index is None:
+            return None
+        return self.record(index)
+
+    def locations(self, pks):
+        """
+        Returns a dictionary of the locations with the given ids which are in
+        the snapshot by id, built from their records without reading the
+        database. Like `LocationManager.get_many_cached`, each location comes
+        with the list of its categories as its `cached_categories`
+        attribute. Only the snapshot's fields are set, and nothing is
+        returned unless every category has a mask bit.
+        """
+        from locations.categories import (all_categories_have_bits,
+                categories_from_mask)
+        from locations.models import Location
+        if not all_categories_have_bits():
+            return {}
+        locations = {}
+        for pk in pks:
+            record = self.get(pk)
+            if record is not None:
+                location = Location(**record)
+                location.cached_categories = categories_from_mask(
+                        location.category_mask)
+                locations[location.pk] = location
+        return locations
+
+
+def current_snapshot(root=None):
+    """
+    Returns the snapshot of the current generation, mapping it on first use,
+    or None if it has not been built, is not readable, for instance when it
+    was written by an older version, or snapshots are not configured.
+    """
+    global _current
+    root = root or conf.BINARY_SNAPSHOT_ROOT
+    if not root:
+        return None
+    path = os.path.join(root, snapshot_filename(current_generation()))
+    snapshot = _current
+    if snapshot is not None and snapshot.path == path:
+        return snapshot
+    try:
+        snapshot = LocationSnapshot(path)
+    except (IOError, OSError, SnapshotError):
+        return None
+    # Swapping the reference is atomic; threads holding the previous
+    # snapshot keep using it until they are done
+    _current = snapshot
+    return snapshot
@@ -3,14 +3,19 @@ from django import template
 register = template.Library()
 
 
+MAPS_URL = u"http://maps.google.com/maps?q=%s+%s+%s+%s+%s"
+MAPS_POINT_URL = MAPS_URL + u"&amp;sll=%s,%s"
+
+
 @register.simple_tag
 def google_maps_url(location):
     """
-    Parses together a google map link
+    Parses together a google map link with a single format
     """
-    url = u"http://maps.google.com/maps?"
-    url = u"%sq=%s+%s+%s+%s+%s" % (url, location.name, location.street_address,
-            location.city, location.state, location.postal_code)
+    parts = (location.name, location.street_address, location.city,
+            location.state, location.postal_code)
     if location.has_geolocation:
-        url = u"%s&amp;sll=%s,%s" % (url, location.latitude, location.longitude)
+        url = MAPS_POINT_URL % (parts + (location.latitude, location.longitude))
+    else:
+        url = MAPS_URL % parts
     return url.replace(" ", "+")
@@ -1,11 +1,51 @@
+import codecs
+import gzip
+import math
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
 from django import template
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.core.management.color import no_style
+from django.db import connection, connections, router, transaction
+from django.test import TestCase, TransactionTestCase
 from django.core.urlresolvers import reverse
-from django.http import QueryDict
+from django.http import Http404, HttpResponse, QueryDict
+from django.test.client import RequestFactory
+from django.utils import simplejson as json
+from django.utils.html import escape
+
+from postalcodes.models import PostalCode
 
+from locations import benchmark, clusters, conf, export, geo, geohash, \
+        instrumentation, loadtest, publish, routers, sitemaps
+from locations.categories import category_mask, filter_categories
+from locations.facets import cached_facet_counts, facet_cache_key, \
+        facet_counts
 from locations.forms import LocationSearchForm
-from locations.models import LocationCategory, Location
-from locations.views import LocationListView
+from locations.management.commands.benchmark_locations import \
+        Command as BenchmarkCommand
+from locations.fragments import render_cards
+from locations.middleware import PINNING_COOKIE, PrimaryPinningMiddleware
+from locations.models import LocationCategory, Location, NearestLocation, \
+        ChangeCounter, location_categories
+from locations.nearest import rebuild_nearest_locations
+from locations.postalindex import nearest_postal_code, PostalCodeIndex
+from locations.signals import locations_updated, phase_timed
+from locations.snapshot import build_snapshot, current_snapshot, \
+        snapshot_filename, LocationSnapshot, SnapshotError
+from locations.utils import geopoint_average, locations_from_csv, \
+        detect_encoding, read_csv, CSV_SAMPLE_SIZE
+from locations.views import LocationListView, LocationDetailView
 
 # Test managers
 # Test geocoding - mock?
@@ -62,6 +102,1604 @@ class LocationManagersTest(TestCase):
         self.assertEqual(12, Location.objects.geocodeable().count())
 
 
+class GeohashTest(TestCase):
+    """
+    Geohashes quantize coordinates into cells for caching proximity searches.
+    """
+    def test_encode(self):
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geohash.encode(38.863504, -77.058835, 5), 'dqcjn')
+
+    def test_decode(self):
+        latitude, longitude = geohash.decode('u4pruydqqvj')
+        self.assertAlmostEqual(latitude, 57.64911, 5)
+        self.assertAlmostEqual(longitude, 10.40744, 5)
+
+    def test_neighbors(self):
+        cells = geohash.neighbors('dqcjn')
+        self.assertEqual(len(cells), 8)
+        self.assertTrue('dqcjp' in cells)
+        self.assertFalse('dqcjn' in cells)
+
+    def test_neighbors_wrap_antimeridian(self):
+        cell = geohash.encode(51.5, 179.99, 4)
+        wrapped = [c for c in geohash.neighbors(cell)
+                if geohash.decode(c)[1] < 0]
+        self.assertEqual(len(wrapped), 3)
+
+
+class GeosearchCacheTest(TestCase):
+    """
+    Latitude and longitude searches are cached per geohash cell.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        self.precision = conf.GEOHASH_PRECISION
+        conf.GEOHASH_PRECISION = 4
+
+    def tearDown(self):
+        conf.GEOHASH_PRECISION = self.precision
+
+    def test_cell_cached(self):
+        """Ensure a second query in the same cell reuses the candidates"""
+        with self.assertNumQueries(2):
+            first = list(Location.objects.geosearch("38.8635,-77.0588"))
+        with self.assertNumQueries(1):
+            second = list(Location.objects.geosearch("38.8636,-77.0589"))
+        self.assertEqual([loc.pk for loc in first], [loc.pk for loc in second])
+
+    def test_only_public_geocoded(self):
+        locations = Location.objects.geosearch("38.8635,-77.0588")
+        self.assertEqual(len(locations), 10)
+
+    def test_invalidated_on_save(self):
+        list(Location.objects.geosearch("38.8635,-77.0588"))
+        Location.objects.filter(is_active=False).update(is_active=True)
+        Location.objects.get(pk=103).save()
+        locations = Location.objects.geosearch("38.8635,-77.0588")
+        self.assertEqual(len(locations), 11)
+
+    def test_cell_edge(self):
+        """
+        Ensure the nearest locations of a point at the edge of its cell are
+        candidates, however few are kept
+        """
+        count, conf.GEOHASH_CANDIDATES = conf.GEOHASH_CANDIDATES, 2
+        try:
+            # Just across the eastern edge of the cell of the query
+            location = Location.objects.create(name="Across", city="Washington",
+                    state="DC", latitude="38.9", longitude="-76.99")
+            nearest = Location.objects.geosearch("38.9,-76.995")
+            self.assertEqual(nearest[0], location)
+            exact = Location.objects.distance(38.9, -76.995).filter(
+                    is_active=True).exclude(latitude=None)
+            self.assertEqual([loc.pk for loc in nearest[:3]],
+                    [loc.pk for loc in exact[:3]])
+        finally:
+            conf.GEOHASH_CANDIDATES = count
+
+    def test_filtered(self):
+        """Ensure filtered searches are not limited to the candidates"""
+        count, conf.GEOHASH_CANDIDATES = conf.GEOHASH_CANDIDATES, 2
+        try:
+            response = self.client.get(reverse("location_list"), {
+                'format': 'json', 'geo_query': "38.8635,-77.0588",
+                'state': 'AK'})
+        finally:
+            conf.GEOHASH_CANDIDATES = count
+        self.assertEqual(len(json.loads(response.content)), 1)
+
+
+class GeoTest(TestCase):
+    """
+    Batched geographic operations over coordinate buffers.
+    """
+    def setUp(self):
+        self.points = [(38.8987, -77.0377), (30.2506, -89.7658),
+                (42.0411, -87.7185), (55.3422, -131.6461)]
+        self.coordinates = geo.Coordinates.from_points(self.points)
+
+    def test_centroid(self):
+        latitude, longitude = geo.centroid(self.coordinates)
+        self.assertAlmostEqual(latitude, 41.63315)
+        self.assertAlmostEqual(longitude, -96.542025)
+        self.assertEqual(geo.centroid(geo.Coordinates([], [])), None)
+
+    def test_geopoint_average(self):
+        self.assertEqual(geopoint_average(self.points),
+                geo.centroid(self.coordinates))
+        self.assertEqual(geopoint_average([]), None)
+
+    def test_bounds(self):
+        self.assertEqual(geo.bounds(self.coordinates),
+                (30.2506, -131.6461, 55.3422, -77.0377))
+
+    def test_haversine_many(self):
+        distances = geo.haversine_many(38.8635, -77.0588, self.coordinates)
+        for point, distance in zip(self.points, distances):
+            self.assertAlmostEqual(distance,
+                    geo.haversine(38.8635, -77.0588, *point))
+        self.assertAlmostEqual(distances[0], 2.7, 1)
+
+    def test_k_nearest(self):
+        nearest = geo.k_nearest(41.0, -88.0, self.coordinates, 2)
+        self.assertEqual([index for index, distance in nearest], [2, 0])
+        self.assertEqual(len(geo.k_nearest(41.0, -88.0, self.coordinates,
+            10)), 4)
+
+    def test_within(self):
+        within = geo.within(41.0, -88.0, self.coordinates, 800)
+        self.assertEqual([index for index, distance in within], [2, 0, 1])
+        self.assertEqual(within, geo.k_nearest(41.0, -88.0,
+            self.coordinates, 3))
+        self.assertEqual(geo.within(41.0, -88.0, self.coordinates, 1), [])
+
+
+def reference_distance(lat1, lng1, lat2, lng2, radius=geo.EARTH_RADIUS_MILES):
+    """
+    Great circle distance from the angle between the points' unit vectors,
+    an independent formula to check the haversine implementations against.
+    """
+    def vector(latitude, longitude):
+        latitude, longitude = math.radians(latitude), math.radians(longitude)
+        return (math.cos(latitude) * math.cos(longitude),
+                math.cos(latitude) * math.sin(longitude), math.sin(latitude))
+    (x1, y1, z1), (x2, y2, z2) = vector(lat1, lng1), vector(lat2, lng2)
+    cross = math.sqrt((y1 * z2 - z1 * y2) ** 2 + (z1 * x2 - x1 * z2) ** 2 +
+            (x1 * y2 - y1 * x2) ** 2)
+    return radius * math.atan2(cross, x1 * x2 + y1 * y2 + z1 * z2)
+
+
+def random_points(rng, count):
+    """
+    Returns random points biased towards the poles and the antimeridian.
+    """
+    points = []
+    for index in range(count):
+        kind = index % 4
+        if kind == 0:
+            points.append((rng.uniform(-90, 90), rng.uniform(-180, 180)))
+        elif kind == 1:
+            points.append((rng.choice([-1, 1]) * rng.uniform(85, 90),
+                rng.uniform(-180, 180)))
+        elif kind == 2:
+            points.append((rng.uniform(-70, 70),
+                rng.choice([-1, 1]) * rng.uniform(175, 180)))
+        else:
+            # Alaska, on both sides of the antimeridian
+            points.append((rng.uniform(51, 72), rng.choice([
+                rng.uniform(-180, -130), rng.uniform(172, 180)])))
+    return [(round(lat, 6), round(lng, 6)) for lat, lng in points]
+
+
+class DistanceTest(TestCase):
+    """
+    The Python and SQL distance implementations agree with a reference
+    implementation for random points, including the poles, the antimeridian
+    and identical points.
+    """
+    def setUp(self):
+        self.rng = random.Random(40)
+        self.points = random_points(self.rng, 120)
+
+    def create_locations(self):
+        for index, (latitude, longitude) in enumerate(self.points):
+            Location.objects.create(name="Location %s" % index, city="City",
+                    state="AK", latitude="%.6f" % latitude,
+                    longitude="%.6f" % longitude)
+
+    def test_haversine(self):
+        pairs = zip(self.points, random_points(self.rng, 120))
+        pairs += [(point, point) for point in self.points[:20]]
+        pairs += [((lat, lng), (-lat, lng + 180)) for lat, lng in
+                self.points[:20]]
+        for (lat1, lng1), (lat2, lng2) in pairs:
+            self.assertAlmostEqual(geo.haversine(lat1, lng1, lat2, lng2),
+                    reference_distance(lat1, lng1, lat2, lng2), 3)
+        for lat1, lng1 in self.points[:10]:
+            distances = geo.haversine_many(lat1, lng1,
+                    geo.Coordinates.from_points(self.points))
+            for (lat2, lng2), distance in zip(self.points, distances):
+                self.assertAlmostEqual(distance,
+                        reference_distance(lat1, lng1, lat2, lng2), 3)
+
+    def test_sql_distance(self):
+        self.create_locations()
+        for latitude, longitude in self.points[:8] + [(90, 0), (0, 180)]:
+            locations = list(Location.objects.distance(latitude, longitude))
+            self.assertEqual(len(locations), len(self.points))
+            for location in locations:
+                self.assertAlmostEqual(location.distance, reference_distance(
+                    latitude, longitude, *location.float_point()), 3)
+            self.assertEqual(locations, sorted(locations,
+                key=lambda location: location.distance))
+        # A location at the query point is at distance zero
+        latitude, longitude = self.points[5]
+        self.assertAlmostEqual(Location.objects.distance(latitude,
+            longitude)[0].distance, 0)
+
+    def test_bounding_boxes(self):
+        boxes = geo.bounding_boxes(60.0, 179.5, 100)
+        self.assertEqual(len(boxes), 2)
+        self.assertEqual(boxes[0][3], 180.0)
+        self.assertEqual(boxes[1][1], -180.0)
+        [(south, west, north, east)] = geo.bounding_boxes(89.5, 10.0, 100)
+        self.assertEqual((west, north, east), (-180.0, 90.0, 180.0))
+        self.assertEqual(len(geo.bounding_boxes(38.8, -77.0, 100)), 1)
+        for center in self.points:
+            radius = self.rng.uniform(1, 2000)
+            boxes = geo.bounding_boxes(center[0], center[1], radius)
+            for south, west, north, east in boxes:
+                self.assertTrue(-180.0 <= west <= east <= 180.0)
+            for latitude, longitude in self.points:
+                if reference_distance(center[0], center[1], latitude,
+                        longitude) <= radius:
+                    self.assertTrue([box for box in boxes if
+                        box[0] <= latitude <= box[2] and
+                        box[1] <= longitude <= box[3]])
+
+    def test_within(self):
+        self.create_locations()
+        for latitude, longitude in self.points[:20]:
+            radius = self.rng.uniform(10, 1500)
+            expected = set([index for index, point in enumerate(self.points)
+                if reference_distance(latitude, longitude, *point) <= radius])
+            found = set([int(location.name.split()[1]) for location in
+                Location.objects.within(latitude, longitude, radius)])
+            self.assertEqual(found, expected)
+
+
+class NearestLocationTest(TestCase):
+    """
+    Postal code searches can be answered from a precomputed table.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        self.enabled, self.count = conf.POSTAL_NEAREST, conf.POSTAL_NEAREST_COUNT
+        conf.POSTAL_NEAREST, conf.POSTAL_NEAREST_COUNT = True, 3
+        PostalCode.objects.create(code="22202", latitude="38.8566",
+                longitude="-77.0516")
+        PostalCode.objects.create(code="99901", latitude="55.3422",
+                longitude="-131.6461")
+        rebuild_nearest_locations(processes=1)
+
+    def tearDown(self):
+        conf.POSTAL_NEAREST, conf.POSTAL_NEAREST_COUNT = self.enabled, self.count
+
+    def test_rebuild(self):
+        self.assertEqual(NearestLocation.objects.count(), 6)
+        nearest = NearestLocation.objects.filter(postal_code="99901")
+        self.assertEqual(nearest[0].location.city, "Ketchikan")
+
+    def test_geosearch_postal_code(self):
+        with self.assertNumQueries(2):
+            locations = list(Location.objects.geosearch("22202"))
+        self.assertEqual(len(locations), 3)
+        self.assertTrue(locations[0].distance <= locations[1].distance)
+
+    def test_not_precomputed(self):
+        """Postal codes missing from the table are searched without it"""
+        self.assertEqual(len(Location.objects.geosearch("00000")), 12)
+        PostalCode.objects.create(code="20001", latitude="38.9109",
+                longitude="-77.0163")
+        locations = Location.objects.geosearch("20001")
+        self.assertEqual(locations[0].city, "Washington")
+        self.assertEqual(len(locations), 12)
+
+    def test_refresh_matches_rebuild(self):
+        """Merging the changed locations agrees with a full rebuild"""
+        conf.POSTAL_NEAREST_COUNT = 5
+        rebuild_nearest_locations(processes=1)
+        Location.objects.create(name="Crystal City", city="Arlington",
+                state="VA", latitude="38.8566", longitude="-77.0516")
+        moved = Location.objects.get(pk=105)
+        moved.latitude, moved.longitude = "55.3", "-131.6"
+        moved.save()
+        Location.objects.get(pk=107).delete()
+        location = Location.objects.get(pk=106)
+        location.is_active = False
+        location.save()
+        Location.objects.get(pk=104).save()
+        refreshed = [(code, location_id) for code, location_id in
+                NearestLocation.objects.values_list('postal_code',
+                    'location_id')]
+        rebuild_nearest_locations(processes=1)
+        self.assertEqual(refreshed, list(NearestLocation.objects.values_list(
+            'postal_code', 'location_id')))
+
+    def test_refresh_on_save(self):
+        location = Location.objects.create(name="Crystal City",
+                city="Arlington", state="VA", latitude="38.8566",
+                longitude="-77.0516")
+        nearest = Location.objects.geosearch("22202")
+        self.assertEqual(nearest[0], location)
+        self.assertEqual(len(nearest), 3)
+        location.is_active = False
+        location.save()
+        self.assertFalse(location in Location.objects.geosearch("22202"))
+
+    def test_refresh_on_delete(self):
+        radius, conf.POSTAL_NEAREST_RADIUS = conf.POSTAL_NEAREST_RADIUS, 1
+        try:
+            # Far outside the radius of the postal code listing it
+            NearestLocation.objects.get(postal_code="99901",
+                    rank=2).location.delete()
+        finally:
+            conf.POSTAL_NEAREST_RADIUS = radius
+        self.assertEqual(list(NearestLocation.objects.filter(
+            postal_code="99901").values_list('rank', flat=True)), [0, 1, 2])
+
+    def test_filtered(self):
+        """Ensure filtered searches are not limited to the nearest table"""
+        response = self.client.get(reverse("location_list"), {
+            'format': 'json', 'geo_query': "22202", 'state': 'AK'})
+        self.assertEqual(len(json.loads(response.content)), 1)
+
+
+class NearestLocationCommitTest(TransactionTestCase):
+    """
+    Refreshed nearest locations are committed outside of managed
+    transactions, like the deletion of the rows they replace.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        self.enabled, self.count = conf.POSTAL_NEAREST, conf.POSTAL_NEAREST_COUNT
+        conf.POSTAL_NEAREST, conf.POSTAL_NEAREST_COUNT = True, 3
+        PostalCode.objects.create(code="22202", latitude="38.8566",
+                longitude="-77.0516")
+
+    def tearDown(self):
+        conf.POSTAL_NEAREST, conf.POSTAL_NEAREST_COUNT = self.enabled, self.count
+
+    def test_refresh_is_committed(self):
+        Location.objects.get(pk=105).save()
+        # Discard anything uncommitted, as closing the connection would
+        connection._rollback()
+        self.assertEqual(NearestLocation.objects.filter(
+            postal_code="22202").count(), 3)
+
+
+class PostalCodeIndexTest(TestCase):
+    """
+    The nearest postal code of a point is found with an in-memory grid index,
+    and latitude and longitude searches can be snapped to it.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        self.settings = (conf.POSTAL_SNAP_DISTANCE, conf.POSTAL_NEAREST,
+                conf.POSTAL_NEAREST_COUNT)
+        PostalCode.objects.create(code="22202", latitude="38.8566",
+                longitude="-77.0516")
+        PostalCode.objects.create(code="99901", latitude="55.3422",
+                longitude="-131.6461")
+
+    def tearDown(self):
+        (conf.POSTAL_SNAP_DISTANCE, conf.POSTAL_NEAREST,
+                conf.POSTAL_NEAREST_COUNT) = self.settings
+
+    def test_index(self):
+        generator = random.Random(1)
+        points = [(str(code), generator.uniform(-89, 89),
+            generator.uniform(-180, 180)) for code in range(500)]
+        points.append(("east", 60.0, 179.95))
+        index = PostalCodeIndex(points)
+        self.assertEqual(len(index), 501)
+        queries = [(generator.uniform(-90, 90), generator.uniform(-180, 180))
+                for counter in range(50)] + [(60.0, -179.95), (90.0, 0.0)]
+        for latitude, longitude in queries:
+            expected = min([(geo.haversine(latitude, longitude, lat, lng),
+                code) for code, lat, lng in points])
+            code, lat, lng, distance = index.nearest(latitude, longitude)
+            self.assertEqual(code, expected[1])
+            self.assertAlmostEqual(distance, expected[0])
+        self.assertEqual(index.nearest(60.0, -179.95)[0], "east")
+        self.assertEqual(index.nearest(60.0, -178.0, 10), None)
+        self.assertEqual(PostalCodeIndex([]).nearest(0, 0), None)
+
+    def test_nearest_postal_code(self):
+        nearest_postal_code(0, 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(nearest_postal_code(38.86, -77.05, 5)[0],
+                    "22202")
+        self.assertEqual(nearest_postal_code(0, 0, 5), None)
+        # Changes to the postal codes reload the index
+        PostalCode.objects.create(code="22203", latitude="38.8738",
+                longitude="-77.1155")
+        self.assertEqual(nearest_postal_code(38.87, -77.11, 5)[0], "22203")
+
+    def test_geosearch(self):
+        locations = list(Location.objects.geosearch("38.86,-77.05"))
+        self.assertNotEqual(locations[0].distance, Location.objects.geosearch(
+            "22202")[0].distance)
+        conf.POSTAL_SNAP_DISTANCE = 5
+        self.assertEqual(
+            [(location.pk, location.distance) for location in
+                Location.objects.geosearch("38.86,-77.05")],
+            [(location.pk, location.distance) for location in
+                Location.objects.geosearch("22202")])
+        # Reuses the precomputed postal code table
+        conf.POSTAL_NEAREST, conf.POSTAL_NEAREST_COUNT = True, 3
+        rebuild_nearest_locations(processes=1)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(list(Location.objects.geosearch(
+                "38.86,-77.05"))), 3)
+        response = self.client.get(reverse("location_list"),
+                {'geo_query': "38.86,-77.05"})
+        self.assertEqual(response.context['postal_code'], "22202")
+        self.assertEqual(Location.objects.geosearch("0,0").count(),
+                Location.objects.count())
+
+
+class BenchmarkTest(TestCase):
+    """
+    The benchmark harness generates realistic synthetic data and flags
+    regressions against a baseline.
+    """
+    def test_generate_locations(self):
+        rows = benchmark.generate_locations(50, seed=1)
+        self.assertEqual(Location.objects.count(), 50)
+        self.assertEqual(Location.objects.filter(category=None).count(), 0)
+        self.assertEqual(len(rows), 50)
+
+    def test_synthetic_names(self):
+        names = [row['name'] for row in benchmark.synthetic_rows(500, seed=1,
+            prefix="Store")]
+        self.assertEqual(len(set(names)), 500)
+        self.assertTrue(all([name.startswith("Store ") for name in names]))
+
+    def test_compare(self):
+        baseline = {'results': [
+            {'name': 'fast', 'best': 0.1, 'queries': 2},
+            {'name': 'same', 'best': 0.1, 'queries': 2},
+        ]}
+        results = {'results': [
+            {'name': 'fast', 'best': 0.2, 'queries': 3},
+            {'name': 'same', 'best': 0.11, 'queries': 2},
+            {'name': 'new', 'best': 1.0, 'queries': 9},
+        ]}
+        self.assertEqual(len(benchmark.compare(results, baseline)), 2)
+
+    def test_peak_memory(self):
+        if benchmark.current_memory() is None:
+            return
+        def allocate():
+            block = ' ' * (32 * 1024 * 1024)
+            time.sleep(0.01)
+        # The growth is that of the call, whatever ran before it
+        for counter in range(2):
+            self.assertTrue(benchmark.peak_memory(allocate) > 16 * 1024)
+        self.assertTrue(benchmark.peak_memory(lambda: None) < 16 * 1024)
+
+    def test_import_runs_no_queries(self):
+        result = benchmark.import_benchmark()
+        self.assertEqual(result['queries'], 0)
+        self.assertFalse('googlemaps' in result['optional_dependencies'])
+        self.assertFalse('numpy' in result['optional_dependencies'])
+        self.assertTrue(result['peak_memory_kb'] >= 0)
+
+
+class BenchmarkCommandTest(TransactionTestCase):
+    """
+    The benchmark command writes its results and fails on regressions
+    against a baseline. It commits the synthetic data it generates.
+    """
+    def benchmark(self, **options):
+        command = BenchmarkCommand()
+        command.stdout = StringIO()
+        defaults = {'count': 50, 'seed': 0, 'repeat': 1, 'output': None,
+                'baseline': None, 'tolerance': 1000}
+        defaults.update(options)
+        command.handle(**defaults)
+        return command.stdout.getvalue()
+
+    def test_baseline(self):
+        directory = tempfile.mkdtemp()
+        try:
+            output = os.path.join(directory, 'results.json')
+            self.benchmark(output=output)
+            results = json.load(open(output))
+            # Only the query counts are compared, as the timings of a single
+            # run vary too much
+            self.assertTrue("No regressions" in self.benchmark(
+                baseline=output))
+            for result in results['results']:
+                if result.get('queries'):
+                    result['queries'] -= 1
+            json.dump(results, open(output, 'w'))
+            self.assertRaises(CommandError, self.benchmark, baseline=output)
+        finally:
+            shutil.rmtree(directory)
+
+
+class LoadTestTest(TestCase):
+    """
+    The load test replays a realistic request mix and flags regressions
+    against a baseline.
+    """
+    def test_request_paths(self):
+        rows = benchmark.generate_locations(50, seed=1)
+        requests = loadtest.request_paths(rows, 100, seed=1)
+        self.assertEqual(len(requests), 100)
+        self.assertEqual(requests, loadtest.request_paths(rows, 100, seed=1))
+        kinds = set([kind for kind, path in requests])
+        self.assertTrue(set(['postal_code', 'latlng', 'category']) <= kinds)
+        for kind, path in requests[:10]:
+            self.assertEqual(self.client.get(path).status_code, 200)
+
+    def test_summarize(self):
+        self.assertEqual(loadtest.percentile(range(1, 101), 95), 95)
+        self.assertEqual(loadtest.percentile([3], 99), 3)
+        samples = [('latlng', seconds / 100.0, 200, 2) for seconds in
+                range(1, 101)] + [('latlng', 0.5, 500, None)]
+        result = loadtest.summarize('latlng', 2.0, samples)
+        self.assertEqual(result['requests'], 101)
+        self.assertEqual(result['errors'], 1)
+        self.assertEqual(result['queries'], 2)
+        self.assertEqual(result['p50'], 0.5)
+
+    def test_compare(self):
+        baseline = {'results': [
+            {'name': 'all', 'p95': 0.1, 'throughput': 100, 'queries': 2.0},
+            {'name': 'kml', 'p95': 0.1, 'throughput': 10, 'queries': 2.0},
+        ]}
+        results = {'results': [
+            {'name': 'all', 'p95': 0.11, 'throughput': 90, 'queries': 2.01,
+                'errors': 0},
+            {'name': 'kml', 'p95': 0.2, 'throughput': 5, 'queries': 3.0,
+                'errors': 1},
+        ]}
+        self.assertEqual(len(loadtest.compare(results, baseline)), 4)
+
+
+class InstrumentationTest(TestCase):
+    """
+    Searches, feeds and imports report per-phase timings when enabled.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        self.settings = (conf.INSTRUMENTATION, conf.SERVER_TIMING,
+                conf.METRICS_CALLBACK)
+        conf.INSTRUMENTATION, conf.SERVER_TIMING = True, True
+        self.phases = []
+        conf.METRICS_CALLBACK = lambda *args: self.phases.append(args)
+
+    def tearDown(self):
+        (conf.INSTRUMENTATION, conf.SERVER_TIMING,
+                conf.METRICS_CALLBACK) = self.settings
+
+    def test_disabled(self):
+        conf.INSTRUMENTATION = False
+        self.assertTrue(instrumentation.phase('test') is instrumentation.NOOP)
+        response = self.client.get(reverse("location_list"))
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEqual(self.phases, [])
+
+    def test_signal(self):
+        received = []
+        def receiver(sender, **kwargs):
+            received.append(kwargs['phase'])
+        phase_timed.connect(receiver)
+        try:
+            with instrumentation.phase('test'):
+                pass
+        finally:
+            phase_timed.disconnect(receiver)
+        self.assertEqual(received, ['test'])
+        self.assertEqual(self.phases[0][0], 'test')
+
+    def test_json_server_timing(self):
+        response = self.client.get("%s?format=json" % reverse("location_list"))
+        self.assertTrue('categories;dur=' in response['Server-Timing'])
+        self.assertEqual([phase[0] for phase in self.phases],
+                ['locations', 'categories', 'serialize'])
+
+    def test_html_server_timing(self):
+        response = self.client.get(reverse("location_list"))
+        self.assertTrue('render;dur=' in response['Server-Timing'])
+
+    def test_kml_server_timing(self):
+        response = self.client.get(reverse("location_kml"))
+        self.assertTrue('locations;dur=' in response['Server-Timing'])
+
+
+class AdminChangelistTest(TestCase):
+    """
+    The admin changelist runs a fixed number of queries, however many
+    locations and states there are.
+    """
+    fixtures = ["test_data.json"]
+    query_budget = 12
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.url = reverse("admin:locations_location_changelist")
+
+    def count_queries(self):
+        debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            # The query log is reset when each request starts
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = debug_cursor
+
+    def test_state_filter(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, "?state__exact=AK")
+        self.assertContains(response, "Alaska")
+
+    def test_query_budget(self):
+        queries = self.count_queries()
+        self.assertTrue(queries <= self.query_budget,
+                "%s queries, budget %s" % (queries, self.query_budget))
+        for state in ('CA', 'TX', 'NY', 'WA', 'OR'):
+            for counter in range(5):
+                Location.objects.create(name="%s %s" % (state, counter),
+                        city="City", state=state, latitude="40.0",
+                        longitude="-100.0")
+        self.assertEqual(self.count_queries(), queries)
+
+
+class AdminActionsTest(TestCase):
+    """
+    The admin status actions update the selected locations in bulk.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.url = reverse("admin:locations_location_changelist")
+        self.batches = []
+        locations_updated.connect(self.receiver)
+
+    def tearDown(self):
+        locations_updated.disconnect(self.receiver)
+
+    def receiver(self, sender, pks, **kwargs):
+        self.batches.append(sorted(pks))
+
+    def action(self, action, pks):
+        return self.client.post(self.url, {'action': action,
+            '_selected_action': pks})
+
+    def test_toggle_active_status(self):
+        self.action('toggle_active_status', [101, 102, 103])
+        self.assertTrue(Location.objects.get(pk=101).is_active)
+        self.assertFalse(Location.objects.get(pk=102).is_active)
+        self.assertFalse(Location.objects.get(pk=103).is_active)
+        self.assertEqual(self.batches, [[101], [102, 103]])
+
+    def test_deactivate_locations(self):
+        self.action('deactivate_locations', [101, 102, 103])
+        self.assertEqual(Location.objects.public().count(), 9)
+        self.assertEqual(self.batches, [[102, 103]])
+
+    def test_activate_locations(self):
+        self.action('activate_locations', [101, 102])
+        self.assertEqual(Location.objects.public().count(), 12)
+
+    def test_deactivate_uploads(self):
+        Location.objects.filter(pk__in=[102, 103]).update(upload_count=1)
+        self.action('deactivate_uploads', [102])
+        self.assertEqual(Location.objects.public().count(), 9)
+
+
+class CsvImportTest(TestCase):
+    """
+    CSV uploads create new locations, re-activate existing ones and, in sync
+    mode, deactivate the ones missing from the file.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        self.category = LocationCategory.objects.get(name="Restaurant")
+        self.csv = StringIO("\r\n".join([
+            '"Test 1","1600 Pennsylvania Ave","Washington","DC","20500"',
+            '"Test 2","2006 Old Spanish Trl","Slidell","LA","70458"',
+            '"NEW PLACE","1 MAIN ST","ALEXANDRIA","va","22314"',
+        ]))
+
+    def test_import(self):
+        results = locations_from_csv(self.csv, self.category)
+        self.assertFalse(results['errors'])
+        self.assertEqual(results['created_count'], 1)
+        self.assertEqual(results['skipped_count'], 2)
+        self.assertEqual(results['deactivated_count'], 0)
+        location = Location.objects.get(original_name="NEW PLACE")
+        self.assertEqual(location.name, "New Place")
+        self.assertEqual(location.state, "VA")
+        self.assertEqual(list(location.category.all()), [self.category])
+        self.assertTrue(Location.objects.get(original_name="Test 1").is_active)
+
+    def test_sync(self):
+        restaurants = Location.objects.public().filter(
+                category=self.category).count()
+        results = locations_from_csv(self.csv, self.category, sync=True)
+        # Test 1 was re-activated and Test 2 is still listed
+        self.assertEqual(results['deactivated_count'], restaurants - 1)
+        self.assertEqual(sorted(Location.objects.public().filter(
+            category=self.category).values_list('original_name', flat=True)),
+            ["NEW PLACE", "Test 1", "Test 2"])
+        self.assertEqual(Location.objects.public().exclude(
+            category=self.category).count(), 11 - restaurants)
+
+    def test_sync_without_rows(self):
+        results = locations_from_csv(StringIO(""), self.category, sync=True)
+        self.assertTrue(results['errors'])
+        self.assertEqual(results['deactivated_count'], 0)
+        self.assertEqual(Location.objects.public().count(), 11)
+
+    def test_sync_without_original_name(self):
+        Location.objects.filter(pk=103).update(original_name=None)
+        csv_file = StringIO(self.csv.getvalue() +
+                '\r\n"Poochie\'s","818 Main St","Skokie","IL",""')
+        results = locations_from_csv(csv_file, self.category, sync=True)
+        self.assertEqual(results['created_count'], 1)
+        self.assertTrue(Location.objects.get(pk=103).is_active)
+
+    def test_import_without_original_name(self):
+        """Only sync imports match locations on their display name"""
+        Location.objects.filter(pk=103).update(original_name=None)
+        location = Location.objects.get(original_name="Test 1")
+        location.name = "Renamed"
+        location.save()
+        csv_file = StringIO('"Poochie\'s","818 Main St","Skokie","IL",""'
+                '\r\n"Test 1","1600 Pennsylvania Ave","Washington","DC",'
+                '"20500"\r\n"Renamed","1 Main St","Alexandria","VA","22314"')
+        results = locations_from_csv(csv_file, self.category)
+        self.assertEqual(results['skipped'], ["Test 1"])
+        self.assertEqual(results['created'], ["Poochie's", "Renamed"])
+
+    def test_encodings(self):
+        row = u'"Caf\xe9 Fran\xe7ais","1 Main St","Montr\xe9al","VA","22314"'
+        for data in (row.encode('utf-8'), row.encode('cp1252'),
+                codecs.BOM_UTF8 + row.encode('utf-8')):
+            [location] = read_csv(StringIO(data))
+            self.assertEqual(location['name'], u"Caf\xe9 Fran\xe7ais")
+            self.assertEqual(location['city'], u"Montr\xe9al")
+        self.assertEqual(detect_encoding(codecs.BOM_UTF8 + "a"), 'utf-8-sig')
+        self.assertEqual(detect_encoding(u"\xe9".encode('utf-8')[:1]),
+                'utf-8')
+        self.assertEqual(detect_encoding(u"\xe9a".encode('cp1252')),
+                'cp1252')
+        # cp1252 rows after a sample which is valid UTF-8
+        data = "\r\n".join(['"Place %s","Street","City","VA",""' % counter
+            for counter in range(2000)] + [row.encode('cp1252')])
+        self.assertTrue(len(data) > CSV_SAMPLE_SIZE)
+        self.assertEqual(read_csv(StringIO(data))[-1]['city'],
+                u"Montr\xe9al")
+        # Only the cells which are not valid UTF-8 are decoded as cp1252
+        location = read_csv(StringIO(data + '\r\n"%s","1 Main St","%s",'
+            '"VA",""' % (u"Caf\xe9".encode('utf-8'),
+                u"Montr\xe9al".encode('cp1252'))))[-1]
+        self.assertEqual(location['name'], u"Caf\xe9")
+        self.assertEqual(location['city'], u"Montr\xe9al")
+
+    def test_file_on_disk(self):
+        csv_file = tempfile.TemporaryFile()
+        csv_file.write(self.csv.getvalue())
+        csv_file.seek(0)
+        results = locations_from_csv(csv_file, self.category)
+        self.assertEqual(results['created_count'], 1)
+        self.assertEqual(read_csv(tempfile.TemporaryFile()), [])
+
+    def test_line_endings(self):
+        data = "\r".join(['"Place %s","Street","City","VA",""' % counter
+            for counter in range(3)])
+        csv_file = tempfile.TemporaryFile()
+        csv_file.write(data)
+        for csv_file in (csv_file, StringIO(data), StringIO(data + "\r")):
+            self.assertEqual([location['name'] for location in read_csv(
+                csv_file)], ["Place 0", "Place 1", "Place 2"])
+
+    def test_benchmark(self):
+        result = benchmark.csv_benchmark(500, repeat=1)
+        self.assertTrue(result['rows_per_second'] > 0)
+
+
+class BatchSearchTest(TestCase):
+    """
+    Many query points are answered at once with a fixed number of queries.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        PostalCode.objects.create(code="22202", latitude="38.8566",
+                longitude="-77.0516")
+        PostalCode.objects.create(code="99901", latitude="55.3422",
+                longitude="-131.6461")
+        self.queries = ["22202", "99901", "38.8635,-77.0588", "00000"]
+
+    def expected(self, query):
+        return [location.pk for location in Location.objects.geosearch(
+            query).filter(is_active=True).exclude(latitude=None)[:3]]
+
+    def test_geosearch_many(self):
+        with self.assertNumQueries(3):
+            results = Location.objects.geosearch_many(self.queries, 3)
+        self.assertEqual(sorted(results.keys()), sorted(self.queries))
+        for query in self.queries[:3]:
+            self.assertEqual([location.pk for location in results[query]],
+                    self.expected(query))
+        self.assertEqual(results["00000"], [])
+        nearest = results["38.8635,-77.0588"][0]
+        self.assertAlmostEqual(nearest.distance, Location.objects.distance(
+            38.8635, -77.0588).get(pk=nearest.pk).distance)
+
+    def test_view(self):
+        response = self.client.get(reverse("location_batch_search"),
+                {'q': self.queries, 'k': 3})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual([location['id'] for location in data["22202"]],
+                self.expected("22202"))
+        self.assertTrue(data["99901"][0]['categories'])
+        for params in ({}, {'q': "22202", 'k': 0}, {'q': "22202", 'k': 'x'},
+                {'q': ["22202"] * 101}):
+            self.assertEqual(self.client.get(reverse("location_batch_search"),
+                params).status_code, 400)
+
+
+class ClusterTest(TestCase):
+    """
+    The cluster endpoint aggregates locations in grid cells at low zoom
+    levels and returns individual points at high zoom levels.
+    """
+    fixtures = ["test_data.json"]
+
+    def get(self, **params):
+        response = self.client.get(reverse("location_clusters"), params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_clusters(self):
+        result = self.get(bbox="-135,25,-65,50", zoom=4)
+        total = sum([cluster['count'] for cluster in result['clusters']])
+        # Whole tiles are returned, which here includes Ketchikan, AK
+        self.assertEqual(total + len(result['points']), 10)
+        self.assertTrue(max([cluster['count'] for cluster in
+            result['clusters']]) >= 5)
+
+    def test_points_at_high_zoom(self):
+        result = self.get(bbox="-77.03,38.88,-76.99,38.90", zoom=14)
+        self.assertEqual(result['clusters'], [])
+        self.assertEqual([point['id'] for point in result['points']], [106])
+
+    def test_filters(self):
+        result = self.get(bbox="-180,-90,180,90", zoom=0, state="VA")
+        total = sum([cluster['count'] for cluster in result['clusters']])
+        self.assertEqual(total + len(result['points']), 4)
+
+    def test_tile_key(self):
+        key = clusters.tile_key(1, 2, 3, ["1", "2"], ["VA", "A B" * 200])
+        self.assertTrue(len(key) < 250)
+        self.assertFalse(" " in key)
+        self.assertEqual(key, clusters.tile_key(1, 2, 3, ["2", "1"],
+            ["A B" * 200, "VA"]))
+        self.assertNotEqual(key, clusters.tile_key(1, 2, 3, ["1", "2"],
+            ["VA"]))
+
+    def test_cached(self):
+        self.get(bbox="-135,25,-65,50", zoom=4)
+        with self.assertNumQueries(0):
+            self.get(bbox="-135,25,-65,50", zoom=4)
+
+    def test_antimeridian(self):
+        result = self.get(bbox="170,50,-125,60", zoom=3)
+        self.assertEqual(len(result['points']) + len(result['clusters']), 1)
+
+    def test_edges(self):
+        """Points on the antimeridian and the poles fall in existing tiles"""
+        self.assertEqual(clusters.point_tile(90.0, 180.0, 2), (0, 1))
+        self.assertEqual(clusters.point_tile(-90.0, -180.0, 2), (0, 0))
+        self.assertEqual(clusters.point_tile(0.0, 179.9, 2), (3, 1))
+        location = Location.objects.get(pk=104)
+        location.latitude, location.longitude = "90", "180"
+        location.save()
+        result = self.get(bbox="-180,-90,180,90", zoom=0)
+        total = sum([cluster['count'] for cluster in result['clusters']])
+        self.assertEqual(total + len(result['points']), 10)
+
+    def test_invalid(self):
+        url = reverse("location_clusters")
+        self.assertEqual(self.client.get(url, {'bbox': "1,2,3",
+            'zoom': 3}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'bbox': "-180,-90,180,90",
+            'zoom': 12}).status_code, 400)
+
+
+class ExportTest(TestCase):
+    """
+    The compact export serves columnar arrays versioned by data generation.
+    """
+    fixtures = ["test_data.json"]
+
+    def test_json(self):
+        response = self.client.get(reverse("location_export"))
+        data = json.loads(response.content)
+        self.assertEqual(len(data['ids']), 11)
+        self.assertEqual(data['generation'],
+                int(response['X-Locations-Generation']))
+        index = data['ids'].index(105)
+        self.assertEqual(data['city_table'][data['cities'][index]],
+                "Arlington")
+        categories = data['category_indexes'][
+                data['category_offsets'][index]:data['category_offsets'][index + 1]]
+        self.assertEqual([data['category_table'][category]['slug'] for
+            category in categories], ["restaurant", "retail"])
+        self.assertEqual(data['latitudes'][data['ids'].index(112)], None)
+
+    def test_binary(self):
+        response = self.client.get(reverse("location_export"),
+                {'format': 'binary', 'precision': '32'})
+        self.assertEqual(response['Content-Type'], "application/octet-stream")
+        magic, version, float_size, generation, count, index_size = \
+                struct.unpack('<4sHBQIB', response.content[:20])
+        self.assertEqual((magic, float_size, count, index_size),
+                ('LOKJ', 4, 11, 1))
+        ids = struct.unpack('<11I', response.content[20:64])
+        self.assertEqual(ids[0], 102)
+        latitude = struct.unpack('<f', response.content[64:68])[0]
+        self.assertAlmostEqual(latitude, 30.2506, 4)
+
+    def test_many_categories(self):
+        """Category indexes widen past 256 categories"""
+        self.assertEqual(export.index_code(256), 'B')
+        self.assertEqual(export.index_code(257), 'H')
+        self.assertEqual(export.index_code(70000), 'I')
+        columns = export.export_columns()
+        columns['category_table'] = [{'id': pk, 'name': u"Category %s" % pk,
+            'slug': "category-%s" % pk} for pk in range(400)]
+        columns['category_indexes'] = [index + 300 for index in
+                columns['category_indexes']]
+        payload = export.encode_binary(columns, 1)
+        self.assertEqual(struct.unpack('<B', payload[19])[0], 2)
+        offsets_end = 20 + 11 * (4 + 8 + 8 + 4 + 1) + 12 * 4
+        first = struct.unpack('<H', payload[offsets_end:offsets_end + 2])[0]
+        self.assertEqual(first, columns['category_indexes'][0])
+
+    def test_not_modified(self):
+        response = self.client.get(reverse("location_export"))
+        generation = response['X-Locations-Generation']
+        response = self.client.get(reverse("location_export"),
+                {'generation': generation})
+        self.assertEqual(response.status_code, 304)
+        Location.objects.get(pk=102).save()
+        response = self.client.get(reverse("location_export"),
+                {'generation': generation})
+        self.assertEqual(response.status_code, 200)
+
+
+class ChangesTest(TestCase):
+    """
+    Locations are versioned on every change so that sync clients can fetch
+    only what changed since their last sync.
+    """
+    fixtures = ["test_data.json"]
+
+    def get(self, **params):
+        response = self.client.get(reverse("location_changes"), params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_versions(self):
+        location = Location.objects.create(name="New", city="Nowhere",
+                state="VA")
+        self.assertTrue(location.version > 0)
+        self.assertEqual(location.created_version, location.version)
+        created = location.version
+        location.save()
+        self.assertTrue(location.version > created)
+        self.assertEqual(location.created_version, created)
+
+    def test_full_sync(self):
+        data = self.get()
+        self.assertEqual(len(data['changes']), 12)
+        self.assertFalse(data['more'])
+
+    def test_since(self):
+        version = self.get()['version']
+        location = Location.objects.create(name="New", city="Nowhere",
+                state="VA")
+        Location.objects.get(pk=102).save()
+        Location.objects.bulk_update([103, 104], is_active=False)
+        data = self.get(since=version)
+        self.assertEqual([(change['id'], change['op']) for change in
+            data['changes']], [(location.pk, 'created'), (102, 'updated'),
+                (103, 'deactivated'), (104, 'deactivated')])
+        self.assertEqual(self.get(since=data['version'])['changes'], [])
+
+    def test_limit_cursor(self):
+        data = self.get(limit=5)
+        self.assertEqual(len(data['changes']), 5)
+        self.assertTrue(data['more'])
+        rest = self.get(since=data['version'], after=data['after'])
+        self.assertEqual(len(rest['changes']), 7)
+        self.assertEqual(len(set([change['id'] for change in
+            data['changes'] + rest['changes']])), 12)
+
+
+class ChangeVersionTest(TransactionTestCase):
+    """
+    Concurrent changes take their versions in the order they are committed.
+    Both transactions run against a database file of their own, as each
+    thread has its own in-memory test database.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        connections.databases['versions'] = dict(connection.settings_dict,
+                NAME=os.path.join(self.directory, 'versions.db'))
+        cursor = connections['versions'].cursor()
+        for model in (Location, ChangeCounter):
+            for statement in connections['versions'].creation.sql_create_model(
+                    model, no_style(), set())[0]:
+                cursor.execute(statement)
+        transaction.commit_unless_managed(using='versions')
+
+    def tearDown(self):
+        connections['versions'].close()
+        del connections._connections['versions']
+        del connections.databases['versions']
+        shutil.rmtree(self.directory)
+
+    def test_interleaved_transactions(self):
+        manager = Location.objects.db_manager('versions')
+        events = []
+        taken = threading.Event()
+
+        @transaction.commit_on_success(using='versions')
+        def first():
+            events.append(('first', manager.next_version()))
+            taken.set()
+            # The second transaction starts before this one commits
+            time.sleep(0.2)
+            events.append(('commit', None))
+
+        def second():
+            taken.wait(5)
+            events.append(('second', manager.next_version()))
+            transaction.commit_unless_managed(using='versions')
+
+        threads = [threading.Thread(target=function) for function in (first,
+            second)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(events, [('first', 1), ('commit', None),
+            ('second', 2)])
+
+
+class PublishTest(TestCase):
+    """
+    The feeds can be published as static, precompressed snapshot files which
+    the views redirect to.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        self.settings = (conf.SNAPSHOT_ROOT, conf.SNAPSHOT_URL,
+                conf.SNAPSHOT_AUTO)
+        conf.SNAPSHOT_ROOT = tempfile.mkdtemp()
+        conf.SNAPSHOT_URL = "/snapshots/"
+
+    def tearDown(self):
+        shutil.rmtree(conf.SNAPSHOT_ROOT)
+        (conf.SNAPSHOT_ROOT, conf.SNAPSHOT_URL,
+                conf.SNAPSHOT_AUTO) = self.settings
+
+    def test_publish(self):
+        generation = publish.publish_snapshots()
+        path = os.path.join(conf.SNAPSHOT_ROOT,
+                publish.snapshot_filename('json', generation))
+        data = json.loads(open(path).read())
+        self.assertEqual(len(data), 11)
+        self.assertEqual(gzip.open(path + '.gz').read(), open(path).read())
+        kml = open(os.path.join(conf.SNAPSHOT_ROOT,
+            publish.snapshot_filename('kml', generation))).read()
+        self.assertEqual(kml.count("<Placemark>"), 10)
+
+    def test_redirects(self):
+        response = self.client.get(reverse("location_kml"))
+        self.assertEqual(response.status_code, 200)
+        generation = publish.publish_snapshots()
+        response = self.client.get(reverse("location_kml"))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(
+            "/snapshots/locations-kml.%s.kml" % generation))
+        response = self.client.get(reverse("location_list"),
+                {'format': 'json'})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get(reverse("location_list"),
+                {'format': 'json', 'state': 'VA'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(
+            reverse("location_sitemap")).status_code, 302)
+        # A change moves on to a new, unpublished generation
+        Location.objects.get(pk=102).save()
+        self.assertEqual(self.client.get(
+            reverse("location_kml")).status_code, 200)
+
+    def test_generation_is_shared(self):
+        """
+        The generation comes from the database, so a process with a cache of
+        its own finds the snapshots another process published
+        """
+        generation = publish.publish_snapshots()
+        self.assertEqual(generation, Location.objects.current_version())
+        cache.clear()
+        self.assertEqual(self.client.get(
+            reverse("location_kml")).status_code, 302)
+        # Deletions and category changes stamp no location but still move
+        # on to a new generation
+        Location.objects.get(pk=102).delete()
+        self.assertNotEqual(Location.objects.current_version(), generation)
+        generation = publish.publish_snapshots()
+        Location.objects.get(pk=103).category.clear()
+        self.assertNotEqual(Location.objects.current_version(), generation)
+
+    def test_auto_publish(self):
+        conf.SNAPSHOT_AUTO = True
+        publish.publish_snapshots()
+        Location.objects.get(pk=102).save()
+        Location.objects.get(pk=103).save()
+        self.assertEqual(self.client.get(
+            reverse("location_kml")).status_code, 302)
+        # Only the last two generations are kept
+        self.assertEqual(len(os.listdir(conf.SNAPSHOT_ROOT)),
+                2 * 3 * (publish.brotli and 3 or 2))
+
+
+class BinarySnapshotTest(TestCase):
+    """
+    The geocoded public locations can be written as a binary snapshot which
+    the worker processes memory-map and swap as the generation changes.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        self.settings = (conf.BINARY_SNAPSHOT_ROOT, conf.SNAPSHOT_AUTO)
+        conf.BINARY_SNAPSHOT_ROOT = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(conf.BINARY_SNAPSHOT_ROOT)
+        conf.BINARY_SNAPSHOT_ROOT, conf.SNAPSHOT_AUTO = self.settings
+
+    def test_build(self):
+        self.assertEqual(current_snapshot(), None)
+        generation = build_snapshot()
+        snapshot = current_snapshot()
+        self.assertEqual(snapshot.generation, generation)
+        locations = Location.objects.geocoded().order_by('id')
+        self.assertEqual(len(snapshot), locations.count())
+        for index, (pk, latitude, longitude) in enumerate(
+                locations.values_list('id', 'latitude', 'longitude')):
+            self.assertEqual(snapshot.ids[index], pk)
+            self.assertAlmostEqual(snapshot.coordinates.latitudes[index],
+                    float(latitude))
+            self.assertAlmostEqual(snapshot.coordinates.longitudes[index],
+                    float(longitude))
+        for location in locations:
+            record = snapshot.get(location.pk)
+            self.assertEqual(record['name'], location.name)
+            self.assertEqual(record['street_address'],
+                    location.street_address)
+            self.assertEqual(record['postal_code'], location.postal_code)
+            self.assertEqual(record['category_mask'], location.category_mask)
+        self.assertEqual(snapshot.get(0), None)
+        self.assertTrue(current_snapshot() is snapshot)
+        path = os.path.join(conf.BINARY_SNAPSHOT_ROOT, "invalid")
+        open(path, 'wb').write("LOCSNAP2")
+        self.assertRaises(SnapshotError, LocationSnapshot, path)
+        # Snapshots which cannot be read, like those of an older format,
+        # are ignored
+        Location.objects.get(pk=102).save()
+        open(os.path.join(conf.BINARY_SNAPSHOT_ROOT, snapshot_filename(
+            Location.objects.current_version())), 'wb').write("LOCSNAP2")
+        self.assertEqual(current_snapshot(), None)
+
+    def test_geohash_candidates(self):
+        settings = (conf.GEOHASH_PRECISION, conf.GEOHASH_CANDIDATES)
+        conf.GEOHASH_PRECISION, conf.GEOHASH_CANDIDATES = 4, 2
+        try:
+            expected = Location.objects.geohash_candidates(38.9, -76.995)
+            cache.clear()
+            build_snapshot()
+            # Only the version is read from the database
+            with self.assertNumQueries(1):
+                candidates = Location.objects.geohash_candidates(38.9,
+                        -76.995)
+        finally:
+            conf.GEOHASH_PRECISION, conf.GEOHASH_CANDIDATES = settings
+        self.assertEqual(candidates, expected)
+        self.assertTrue(len(candidates) > 2)
+
+    def test_list_view(self):
+        url = reverse("location_list")
+        expected = json.loads(self.client.get(url, {'format': 'json',
+            'state': 'VA'}).content)
+        build_snapshot()
+        # The geocoded locations are read from the snapshot, and only the
+        # ids and the version from the database; the ungeocoded 112 is
+        # still in the object cache
+        Location.objects.uncache([105, 107, 108, 109])
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'format': 'json',
+                'state': 'VA'})
+        self.assertEqual(json.loads(response.content), expected)
+
+    def test_generations(self):
+        build_snapshot()
+        snapshot = current_snapshot()
+        with self.assertNumQueries(2):
+            Location.objects.geosearch_many(["38.8635,-77.0588"], 3)
+        # A change moves on to a new, unbuilt generation
+        Location.objects.get(pk=102).save()
+        self.assertEqual(current_snapshot(), None)
+        with self.assertNumQueries(3):
+            Location.objects.geosearch_many(["38.8635,-77.0588"], 3)
+        conf.SNAPSHOT_AUTO = True
+        Location.objects.get(pk=103).save()
+        self.assertNotEqual(current_snapshot().generation, snapshot.generation)
+        # The previous mapping stays usable
+        self.assertEqual(len(snapshot), len(current_snapshot()))
+
+
+class FragmentCacheTest(TestCase):
+    """
+    The list templates assemble their pages from rendered location cards
+    cached by location version.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        cache.clear()
+        self.locations = list(Location.objects.public())
+
+    def test_render_cards(self):
+        with self.assertNumQueries(2):
+            cards = render_cards(self.locations)
+        self.assertEqual(len(cards), len(self.locations))
+        for location, card in zip(self.locations, cards):
+            for category in location.category.all():
+                self.assertTrue(category.name in card)
+        with self.assertNumQueries(0):
+            self.assertEqual(render_cards(self.locations), cards)
+        # Only the changed location's card is rendered again
+        location = self.locations[0]
+        location.category.clear()
+        # The category table is still in memory
+        with self.assertNumQueries(1):
+            changed = render_cards(self.locations)
+        self.assertEqual(changed[0].strip(), u'<a href="%s">%s</a>' % (
+            location.get_absolute_url(), escape(location.name)))
+        self.assertEqual(changed[1:], cards[1:])
+
+    def test_category_changes(self):
+        cards = render_cards(self.locations)
+        category = LocationCategory.objects.filter(
+                location__in=self.locations)[0]
+        category.name = "Renamed category"
+        category.save()
+        self.assertTrue([card for card in render_cards(self.locations) if
+            "Renamed category" in card])
+        self.assertFalse([card for card in cards if
+            "Renamed category" in card])
+
+    def test_list_view(self):
+        response = self.client.get(reverse("location_list"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['location_cards']), 11)
+        self.assertContains(response, self.locations[0].get_absolute_url())
+        # The rows only render the distance besides the cached cards
+        response = self.client.get(reverse("location_list"),
+                {'geo_query': "38.8635,-77.0588"})
+        with self.assertNumQueries(0):
+            self.assertEqual(render_cards(response.context['locations']),
+                    [card for location, card in
+                        response.context['location_cards']])
+        self.assertContains(response, " mi)")
+
+
+class ObjectCacheTest(TestCase):
+    """
+    Locations are read through an object cache which is invalidated when
+    they change.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_get_many_cached(self):
+        pks = list(Location.objects.values_list('pk', flat=True))
+        with self.assertNumQueries(3):
+            locations = Location.objects.get_many_cached(pks)
+        self.assertEqual(sorted(locations.keys()), sorted(pks))
+        with self.assertNumQueries(0):
+            cached = Location.objects.get_many_cached(pks)
+        location = cached[pks[0]]
+        self.assertEqual(location.name, locations[pks[0]].name)
+        self.assertEqual(location.cached_categories,
+                list(location.category.all()))
+        self.assertRaises(Location.DoesNotExist, Location.objects.get_cached,
+                999)
+
+    def test_invalidation(self):
+        location = Location.objects.get_cached(102)
+        location.name = "Renamed"
+        location.save()
+        self.assertEqual(Location.objects.get_cached(102).name, "Renamed")
+        Location.objects.bulk_update([102], name="Bulk renamed")
+        self.assertEqual(Location.objects.get_cached(102).name,
+                "Bulk renamed")
+        category = LocationCategory.objects.create(name="New", slug="new")
+        location.category.add(category)
+        self.assertTrue(category in
+                Location.objects.get_cached(102).cached_categories)
+
+    def test_views(self):
+        location = Location.objects.public()[0]
+        url = reverse("location_detail", kwargs={'pk': location.pk})
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.context['location'].pk, location.pk)
+        Location.objects.bulk_update([location.pk], is_active=False)
+        view = LocationDetailView.as_view()
+        for pk in (location.pk, 999):
+            self.assertRaises(Http404, view, RequestFactory().get(url), pk=pk)
+        self.client.get(reverse("location_list"), {'format': 'json',
+            'state': 'VA'})
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("location_list"),
+                    {'format': 'json', 'state': 'VA'})
+        self.assertTrue(json.loads(response.content))
+        self.client.get(reverse("location_kml"))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("location_kml"))
+        self.assertEqual(response.content.count("<Placemark>"), 9)
+
+
+class SitemapTest(TestCase):
+    """
+    The location detail pages are listed in chunked sitemaps behind a
+    sitemap index, and only changed chunks are rendered again.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        cache.clear()
+        self.chunk_size = conf.SITEMAP_CHUNK_SIZE
+        conf.SITEMAP_CHUNK_SIZE = 5
+
+    def tearDown(self):
+        conf.SITEMAP_CHUNK_SIZE = self.chunk_size
+
+    def test_index(self):
+        response = self.client.get(reverse("location_sitemap_index"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count("<sitemap>"), 4)
+        self.assertContains(response, reverse("location_sitemap_chunk",
+            kwargs={'chunk': 21}))
+        self.assertContains(response, reverse("location_sitemap"))
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertEqual(self.client.get(reverse("location_sitemap_index"),
+            HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_chunks(self):
+        self.assertEqual([(chunk, count) for chunk, count, lastmod in
+            sitemaps.sitemap_chunks()], [(20, 4), (21, 5), (22, 2)])
+        url = reverse("location_sitemap_chunk", kwargs={'chunk': 20})
+        response = self.client.get(url)
+        self.assertEqual(response.content.count("<url>"), 4)
+        self.assertContains(response, reverse("location_detail",
+            kwargs={'pk': 102}))
+        self.assertNotContains(response, reverse("location_detail",
+            kwargs={'pk': 101}))
+        self.assertEqual(self.client.get(url,
+            HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_changed_chunks_only(self):
+        site = Site.objects.get_current()
+        for chunk_stats in sitemaps.sitemap_chunks():
+            sitemaps.render_chunk(site, *chunk_stats)
+        Location.objects.bulk_update([102], is_active=False)
+        chunks = sitemaps.sitemap_chunks()
+        with self.assertNumQueries(0):
+            for chunk_stats in chunks[1:]:
+                sitemaps.render_chunk(site, *chunk_stats)
+        with self.assertNumQueries(1):
+            content = sitemaps.render_chunk(site, *chunks[0])
+        self.assertEqual(content.count("<url>"), 3)
+
+
+class FacetTest(TestCase):
+    """
+    Searches can return the state, category and city counts of their results
+    with one grouped query per facet.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        cache.clear()
+
+    def counts(self, facets, name, key='value'):
+        return dict([(facet[key], facet['count']) for facet in facets[name]])
+
+    def test_facet_counts(self):
+        queryset = Location.objects.public()
+        with self.assertNumQueries(3):
+            facets = facet_counts(queryset)
+        states = self.counts(facets, 'state')
+        self.assertEqual(sum(states.values()), 11)
+        for state, count in states.items():
+            self.assertEqual(queryset.filter(state=state).count(), count)
+        restaurant = LocationCategory.objects.get(name="Restaurant")
+        self.assertEqual(self.counts(facets, 'category', 'id')[restaurant.id],
+                queryset.filter(category=restaurant).count())
+        self.assertEqual(self.counts(facets, 'city')['Arlington'], 2)
+        counts = [facet['count'] for facet in facets['state']]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+    def test_json(self):
+        response = self.client.get(reverse("location_list"),
+                {'format': 'json', 'state': 'VA', 'facets': 1})
+        data = json.loads(response.content)
+        self.assertEqual(self.counts(data['facets'], 'state'),
+                {'VA': len(data['locations'])})
+        # Cached until a location changes
+        with self.assertNumQueries(0):
+            cached_facet_counts(Location.objects.none(),
+                    QueryDict("state=VA&format=json&facets=1"))
+        response = self.client.get(reverse("location_list"),
+                {'format': 'json', 'state': 'VA'})
+        self.assertTrue(isinstance(json.loads(response.content), list))
+        response = self.client.get(reverse("location_list"), {'format': 'json',
+            'geo_query': "38.8635,-77.0588", 'limit': 3, 'facets': 1})
+        data = json.loads(response.content)
+        self.assertEqual(len(data['locations']), 3)
+        self.assertEqual(sum(self.counts(data['facets'], 'state').values()),
+                11)
+
+    def test_html(self):
+        response = self.client.get(reverse("location_list"),
+                {'search': 'Arlington', 'facets': 1})
+        self.assertEqual(self.counts(response.context['facets'], 'city'),
+                {'Arlington': 2})
+        response = self.client.get(reverse("location_list"))
+        self.assertEqual(response.context['facets'], None)
+
+    def test_cache_key(self):
+        key = facet_cache_key(QueryDict("search=%s&state=VA&page=2" % (
+            "a b\xc3\xa9" * 100)))
+        self.assertTrue(len(key) < 250)
+        self.assertFalse(" " in key)
+        self.assertEqual(key, facet_cache_key(QueryDict("state=VA&search=%s"
+            % ("a b\xc3\xa9" * 100))))
+        self.assertNotEqual(key, facet_cache_key(QueryDict("state=VA")))
+
+
+class CategoryMaskTest(TestCase):
+    """
+    The category masks of the locations follow their categories, so category
+    filters need no join.
+    """
+    fixtures = ["test_data.json"]
+
+    def joined(self, categories):
+        return sorted(Location.objects.filter(
+            category__in=categories).distinct().values_list('pk', flat=True))
+
+    def masked(self, categories):
+        return sorted(filter_categories(Location.objects.all(),
+            [category.pk for category in categories]).values_list('pk',
+                flat=True))
+
+    def test_filter(self):
+        categories = list(LocationCategory.objects.all())
+        self.assertEqual(len(set([category.bit for category in categories])),
+                len(categories))
+        for category in categories:
+            self.assertEqual(self.masked([category]), self.joined([category]))
+        self.assertEqual(self.masked(categories[:2]),
+                self.joined(categories[:2]))
+        self.assertEqual(category_mask([0]), 0)
+        queryset = filter_categories(Location.objects.all(), [categories[0].pk])
+        self.assertFalse('locations_location_category' in str(queryset.query))
+
+    def test_changes(self):
+        location = Location.objects.get(original_name="Test 1")
+        category = LocationCategory.objects.create(name="New", slug="new")
+        location.category.add(category)
+        self.assertEqual(self.masked([category]), [location.pk])
+        location.category.remove(category)
+        self.assertEqual(self.masked([category]), [])
+        category.location_set.add(location)
+        self.assertEqual(self.masked([category]), [location.pk])
+        category.location_set.clear()
+        self.assertEqual(self.masked([category]), [])
+        location.category.add(category)
+        bit = category.bit
+        category.delete()
+        other = LocationCategory.objects.create(name="Other", slug="other")
+        self.assertEqual(other.bit, bit)
+        self.assertEqual(self.masked([other]), [])
+
+    def test_import(self):
+        category = LocationCategory.objects.get(name="Restaurant")
+        locations_from_csv(StringIO('"NEW PLACE","1 Main St","Alexandria",'
+            '"VA","22314"'), category)
+        self.assertEqual(self.masked([category]), self.joined([category]))
+
+    def test_labels(self):
+        pks = list(Location.objects.values_list('pk', flat=True))
+        location_categories(pks)
+        with self.assertNumQueries(1):
+            categories = location_categories(pks)
+        for location in Location.objects.all():
+            self.assertEqual(categories[location.pk],
+                    list(location.category.order_by('id')))
+
+
+class ReadReplicaTest(TestCase):
+    """
+    Reads can be routed to a read replica, except for a short window after a
+    write.
+    """
+    fixtures = ["test_data.json"]
+
+    def setUp(self):
+        self.settings = conf.READ_DATABASE, router.routers
+        conf.READ_DATABASE = 'replica'
+        router.routers = [routers.LocationRouter()]
+        routers.reset()
+
+    def tearDown(self):
+        conf.READ_DATABASE, router.routers = self.settings
+        routers.reset()
+
+    def test_routing(self):
+        self.assertEqual(Location.objects.public().db, 'replica')
+        self.assertEqual(PostalCode.objects.all().db, 'replica')
+        self.assertEqual(User.objects.all().db, 'default')
+        Location.objects.using('default').get(pk=102).save()
+        self.assertTrue(routers.has_written())
+        self.assertEqual(Location.objects.public().db, 'default')
+        routers.reset()
+        self.assertEqual(Location.objects.public().db, 'replica')
+
+    def test_middleware(self):
+        middleware = PrimaryPinningMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        self.assertEqual(Location.objects.all().db, 'replica')
+        Location.objects.using('default').get(pk=102).save()
+        response = middleware.process_response(request, HttpResponse())
+        cookie = response.cookies[PINNING_COOKIE].value
+        self.assertEqual(Location.objects.all().db, 'replica')
+        # The next request of the client reads from the primary
+        request.COOKIES[PINNING_COOKIE] = cookie
+        middleware.process_request(request)
+        self.assertEqual(Location.objects.all().db, 'default')
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(PINNING_COOKIE in response.cookies)
+        request.COOKIES[PINNING_COOKIE] = str(time.time() - 1)
+        middleware.process_request(request)
+        self.assertEqual(Location.objects.all().db, 'replica')
+        middleware.process_request(RequestFactory().post('/'))
+        self.assertEqual(Location.objects.all().db, 'default')
+
+
 class LocationSearchFormTest(TestCase):
     """
     The search form allows users to find locations by filtering on categories,
@@ -224,4 +1862,8 @@ class MapTagTest(TestCase):
     def test_tag_url(self):
         t = template.Template("{% load map_tags %}{% google_maps_url loc %}")
         context = template.Context({'loc': self.loc_full})
-        t.render(context)
+        self.assertEqual(t.render(context), "http://maps.google.com/maps?"
+                "q=Bob's+Place+1600+Pennsylvania+Ava+Washington+DC+20500")
+        self.loc_full.point = (38.8977, -77.0366)
+        self.assertTrue(t.render(context).endswith(
+            "+20500&amp;sll=38.8977,-77.0366"))
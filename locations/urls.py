@@ -1,8 +1,9 @@
 from django.conf.urls.defaults import patterns, url
-from django.views.generic import DetailView
 
-from locations.models import Location
-from locations.views import LocationListView, LocationKMLFeed
+from locations.views import LocationListView, LocationKMLFeed, \
+        LocationClusterView, LocationExportView, LocationChangesView, \
+        LocationBatchSearchView, LocationDetailView, LocationSitemapIndex, \
+        LocationSitemap
 
 
 urlpatterns = patterns('',
@@ -12,8 +13,19 @@ urlpatterns = patterns('',
             paginate_by=24,
         ), name="location_index"),
     url(r'^search/$', view=LocationListView.as_view(), name="location_list"),
+    url(r'^search/batch/$', view=LocationBatchSearchView.as_view(),
+        name="location_batch_search"),
     url(r'^locations.kml$', view=LocationKMLFeed.as_view(), name="location_kml"),
-    url(r'^(?P<pk>[\d]+)/$',
-        view=DetailView.as_view(queryset=Location.objects.public(),
-        context_object_name="location"), name="location_detail"),
+    url(r'^clusters/$', view=LocationClusterView.as_view(),
+        name="location_clusters"),
+    url(r'^export/$', view=LocationExportView.as_view(),
+        name="location_export"),
+    url(r'^changes/$', view=LocationChangesView.as_view(),
+        name="location_changes"),
+    url(r'^sitemap.xml$', view=LocationSitemapIndex.as_view(),
+        name="location_sitemap_index"),
+    url(r'^sitemap-(?P<chunk>[\d]+).xml$', view=LocationSitemap.as_view(),
+        name="location_sitemap_chunk"),
+    url(r'^(?P<pk>[\d]+)/$', view=LocationDetailView.as_view(),
+        name="location_detail"),
 )
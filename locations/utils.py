@@ -1,10 +1,12 @@
+import codecs
 import csv
+import mmap
 
+from django.db import transaction
 from django.db.models import Max
 from django.utils.translation import ugettext_lazy as _
 from urllib2 import URLError
-from googlemaps import GoogleMaps, GoogleMapsError
-from locations.models import Location
+from locations import geo, instrumentation, routers
 from locations.exceptions import LocationEncodingError
 
 
@@ -12,19 +14,104 @@ class CsvParseError(csv.Error):
     pass
 
 
-def unicode_csv_reader(unicode_csv_data, dialect=csv.excel, **kwargs):
-    """From Python csv documentation, used to read non-ASCII data"""
-    # csv.py doesn't do Unicode; encode temporarily as UTF-8:
-    csv_reader = csv.reader(utf_8_encoder(unicode_csv_data),
-                            dialect=dialect, **kwargs)
-    for row in csv_reader:
-        # decode UTF-8 back to Unicode, cell by cell:
-        yield [unicode(cell, 'utf-8') for cell in row]
+# Bytes read from the start of a CSV file to detect its encoding and dialect
+CSV_SAMPLE_SIZE = 64 * 1024
 
 
-def utf_8_encoder(unicode_csv_data):
-    for line in unicode_csv_data:
-        yield unicode(line.decode('cp1252')).encode('utf8')
+def detect_encoding(sample):
+    """
+    Returns the encoding of a CSV file from a sample of its first bytes:
+    'utf-8-sig' if it starts with the UTF-8 byte order mark, 'utf-8' if the
+    sample is valid UTF-8, and 'cp1252', the encoding of spreadsheets saved
+    on Windows, otherwise.
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError, e:
+        # The sample may end in the middle of a multibyte character
+        if e.end < len(sample) or e.start < len(sample) - 3:
+            return 'cp1252'
+    return 'utf-8'
+
+
+def csv_lines(csv_file):
+    """
+    Yields the lines of the CSV file without reading it whole. Files on
+    disk, like the command's input and large uploads spooled to temporary
+    files, are memory-mapped; other files are iterated in buffered chunks.
+    """
+    try:
+        csv_file.seek(0, 2)
+        size = csv_file.tell()
+        csv_file.seek(0)
+        data = mmap.mmap(csv_file.fileno(), size, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        csv_file.seek(0)
+        for line in _split_lines(csv_file):
+            yield line
+        return
+    try:
+        for line in _split_lines(iter(data.readline, '')):
+            yield line
+    finally:
+        data.close()
+
+
+def _split_lines(lines):
+    """
+    Splits the lines read up to each newline at the carriage returns within
+    them, as files saved with Mac line endings have no newlines at all and
+    are then read as a single line.
+    """
+    for line in lines:
+        if line.find('\r', 0, -2) == -1:
+            yield line
+        else:
+            for part in line.splitlines(True):
+                yield part
+
+
+def unicode_csv_reader(csv_data, dialect=csv.excel, encoding='utf-8',
+        **kwargs):
+    """
+    Reads byte string CSV lines in the given encoding as lists of unicode
+    cells, decoding each cell once.
+
+    The csv module only reads byte strings, but UTF-8 and cp1252 both encode
+    the delimiters, quotes and line breaks as ASCII, so the rows can be
+    parsed from the raw bytes. A byte order mark is removed. Files detected
+    as UTF-8 from their first bytes may still hold cp1252 further on, so
+    cells which are not valid UTF-8 are decoded as cp1252, leaving the other
+    cells of their row alone.
+    """
+    if encoding == 'utf-8-sig':
+        csv_data = _strip_bom(csv_data)
+        encoding = 'utf-8'
+    for row in csv.reader(csv_data, dialect=dialect, **kwargs):
+        try:
+            yield [unicode(cell, encoding) for cell in row]
+        except UnicodeDecodeError:
+            yield [_decode_cell(cell, encoding) for cell in row]
+
+
+def _decode_cell(cell, encoding):
+    try:
+        return unicode(cell, encoding)
+    except UnicodeDecodeError:
+        return unicode(cell, 'cp1252')
+
+
+def _strip_bom(lines):
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith(codecs.BOM_UTF8):
+            line = line[len(codecs.BOM_UTF8):]
+        yield line
+        break
+    for line in lines:
+        yield line
 
 
 def get_data_list(csv_reader, has_header=False):
@@ -56,22 +143,48 @@ def get_data_list(csv_reader, has_header=False):
                 'postal_code': postal_code,
                 })
         except IndexError:
-            raise CsvParseError("Missing a column in row %s" % (counter + row))
-        except Exception:
+            raise CsvParseError("Missing a column in row %s" % (counter + 1))
+        except Exception, e:
             raise CsvParseError(
-                    "%s exception in row %s, %s" % (Exception, (counter + row), row))
+                    "%s exception in row %s, %s" % (e, (counter + 1), row))
     return locations_list
 
 
-def locations_from_csv(csv_file, category, has_header=False,
-                                                duplicates_field=None):
+def read_csv(csv_file):
     """
-    Something something
+    Returns the list of location dictionaries of the CSV file.
+
+    The encoding and the dialect are detected once from the start of the
+    file, which is then read line by line, see `csv_lines`.
     """
-    sample = csv_file.read(1024)
-    dialect = csv.Sniffer().sniff(sample)
     csv_file.seek(0)
-    csv_reader = unicode_csv_reader(csv_file, dialect)
+    sample = csv_file.read(CSV_SAMPLE_SIZE)
+    try:
+        dialect = csv.Sniffer().sniff(sample[:1024])
+    except csv.Error:
+        dialect = csv.excel
+    return get_data_list(unicode_csv_reader(csv_lines(csv_file), dialect,
+        detect_encoding(sample)))
+
+
+def title_case(value):
+    return " ".join([word[0].upper() + word[1:].lower() for word in value.split()])
+
+
+def locations_from_csv(csv_file, category, has_header=False,
+                                                duplicates_field=None, sync=False):
+    """
+    Creates new locations from the rows of the CSV file, assigning them to the
+    given category, and re-activates the existing locations listed in it.
+    Locations are matched on their `original_name`.
+
+    In sync mode the file is treated as a full snapshot of the category: its
+    active locations which are missing from the file are deactivated with a
+    single UPDATE in the same transaction. A file without any rows is
+    refused rather than deactivating the whole category. Locations without
+    an `original_name`, like those added in the admin, are then matched on
+    their `name`, so that they are not deactivated and duplicated.
+    """
     messages = {
             'errors': True,
             'warnings': [],
@@ -79,57 +192,96 @@ def locations_from_csv(csv_file, category, has_header=False,
             'skipped': [],
             'created_count': 0,
             'skipped_count': 0,
+            'deactivated_count': 0,
             'upload_count': 0,
     }
     try:
-        location_list = get_data_list(csv_reader)
+        with instrumentation.phase('csv_parse'):
+            location_list = read_csv(csv_file)
     except CsvParseError, e:
         messages['warnings'].append(e)
         return messages
+    if sync and not location_list:
+        messages['warnings'].append("The file has no locations, so no "
+                "locations were deactivated")
+        return messages
+    with instrumentation.phase('csv_import'):
+        _import_locations(location_list, category, messages, sync)
+    messages['errors'] = False
+    messages['created_count'] = len(messages['created'])
+    messages['skipped_count'] = len(messages['skipped'])
+    return messages
+
+
+@transaction.commit_on_success
+def _import_locations(location_list, category, messages, sync=False):
+    """
+    Creates the new locations and re-activates the existing ones, recording
+    the results in the messages dictionary.
+
+    Existing locations are looked up with a single query up front and
+    re-activated with a single UPDATE, so only new locations are saved
+    individually. The existing locations are read from the primary
+    database, as a lagging read replica would duplicate them. New locations
+    are created with the category's mask bit and their category membership
+    is inserted directly, rather than through the many-to-many manager and
+    its per-location signals.
+    """
+    from locations.categories import filter_categories
+    from locations.models import Location
+    Membership = Location.category.through
+    category_mask = 0 if category.bit is None else 1 << category.bit
+    routers.pin_to_primary()
     counter_query = Location.objects.aggregate(Max('upload_count')).get('upload_count__max', 0)
     upload_counter = 0 if counter_query is None else counter_query + 1
+    existing = {}
+    inactive = set()
+    for pk, original_name, name, is_active in Location.objects.values_list(
+            'pk', 'original_name', 'name', 'is_active'):
+        if sync:
+            original_name = original_name or name
+        existing.setdefault(original_name, []).append(pk)
+        if not is_active:
+            inactive.add(pk)
+    reactivate = []
     for location_row in location_list:
-        try:
-            location, created = Location.objects.get_or_create(
-                    original_name=location_row['name'], defaults={
-                        'name':  " ".join([word[0].upper() + word[1:].lower() for word in location_row['name'].split()]),
-                        'street_address': " ".join([word[0].upper() + word[1:].lower() for word in location_row['address'].split()]),
-                        'city': " ".join([word[0].upper() + word[1:].lower() for word in location_row['city'].split()]),
-                        'state': location_row['state'].upper(),
-                        'postal_code': location_row['postal_code'],
-                        'upload_count': upload_counter,
-                        })
-        except Location.MultipleObjectsReturned:
-            messages['warnings'].append(
-                    "%s is already duplicated in the database" % location_row['name'])
-            created = False
-        if created:
-            location.category.add(category)
-            location.save()
+        pks = existing.get(location_row['name'])
+        if pks is None:
+            location = Location.objects.create(
+                    original_name=location_row['name'],
+                    name=title_case(location_row['name']),
+                    street_address=title_case(location_row['address']),
+                    city=title_case(location_row['city']),
+                    state=location_row['state'].upper(),
+                    postal_code=location_row['postal_code'],
+                    upload_count=upload_counter,
+                    category_mask=category_mask)
+            Membership.objects.create(location=location,
+                    locationcategory=category)
+            existing[location_row['name']] = [location.pk]
             messages['created'].append(location_row['name'])
         else:
+            if len(pks) > 1:
+                messages['warnings'].append(
+                        "%s is already duplicated in the database" % location_row['name'])
             # Duplicate, but enforce that it is now active
-            location.is_active = True
-            location.save()
+            reactivate.extend([pk for pk in pks if pk in inactive])
             messages['skipped'].append(location_row['name'])
-    messages['errors'] = False
-    messages['created_count'] = len(messages['created'])
-    messages['skipped_count'] = len(messages['skipped'])
+    Location.objects.bulk_update(reactivate, is_active=True)
+    if sync:
+        names = set([location_row['name'] for location_row in location_list])
+        missing = [pk for pk, original_name, name in filter_categories(
+            Location.objects.filter(is_active=True), [category.pk]
+            ).values_list('pk', 'original_name', 'name')
+            if (original_name or name) not in names]
+        messages['deactivated_count'] = Location.objects.bulk_update(missing,
+                is_active=False)
     messages['upload_count'] = upload_counter
-    return messages
 
 
 def geopoint_average(points):
     """Takes a list of lat-lng tuples and returns an average"""
-    count = len(points)
-    if not count:
-        return None
-    lat = 0
-    lng = 0
-    for point in points:
-        lat += point[0]
-        lng += point[1]
-    return (lat/count, lng/count)
+    return geo.centroid(geo.Coordinates.from_points(points))
 
 
 def get_address_latlng(location):
@@ -137,7 +289,9 @@ def get_address_latlng(location):
     Requests the latitude and longitude for the given location's address.
 
     Uses the Google Maps API, but could be extended to use a different API.
+    The geocoder client is only imported when it is first needed.
     """
+    from googlemaps import GoogleMaps, GoogleMapsError
     address = u"%s, %s, %s %s" % (location.street_address, location.city,
             location.state, location.postal_code)
     try:
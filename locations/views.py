@@ -1,15 +1,93 @@
+import time
+
 from django.contrib import messages
 from django.db.models import Q
-from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.http import Http404, HttpResponse, HttpResponseRedirect, \
+        HttpResponseBadRequest, HttpResponseNotModified
+from django.template.loader import render_to_string
 from django.utils import simplejson as json
-from django.views.generic import TemplateView, ListView, FormView
+from django.utils.http import http_date
+from django.views.generic import TemplateView, ListView, DetailView, \
+        FormView, View
 
-from locations.models import Location
+from locations import conf, export, instrumentation
+from locations.categories import filter_categories
+from locations.changes import change_stream
+from locations.clusters import clusters, ClusterError
+from locations.facets import cached_facet_counts
+from locations.publish import snapshot_url
+from locations.sitemaps import chunk_etag, render_chunk, sitemap_chunks
+from locations.snapshot import current_snapshot
+from locations.models import Location, location_categories
 from locations.forms import CsvUploadForm, LocationSearchForm
+from locations.fragments import render_cards
 from locations.utils import locations_from_csv
 
 
+def snapped_postal_code(geo_query):
+    """
+    Returns the postal code a latitude and longitude query is snapped to,
+    see `LocationManager.snap_postal_code`, or None.
+    """
+    try:
+        latitude, longitude = [float(value) for value in geo_query.split(',')]
+    except (AttributeError, ValueError):
+        return None
+    snapped = Location.objects.snap_postal_code(latitude, longitude)
+    return snapped and snapped[0]
+
+
+def location_dicts(location_categories):
+    """
+    Returns the JSON-serializable dictionaries of a list of (location,
+    categories) pairs, as served by the list view.
+    """
+    return [{
+        "id": location.id,
+        "name": location.name,
+        "street_address": location.street_address,
+        "city": location.city,
+        "postal_code": location.postal_code,
+        "categories": [{
+            "id": category.id,
+            "name": category.name,
+            "slug": category.slug,
+            } for category in categories],
+        "distance": getattr(location, 'distance', None),
+        "latlng": location.float_point(),
+        } for location, categories in location_categories]
+
+
+def cached_locations(queryset, use_snapshot=False):
+    """
+    Returns the list of the locations of the queryset from the object cache,
+    in order. Only the ids and any extra selected values, like the distance,
+    are read from the database and set on the cached locations.
+
+    With `use_snapshot` the locations are first looked up in the binary
+    snapshot when it is current, see `LocationSnapshot.locations`, which
+    only holds the fields the JSON list serves.
+    """
+    extra = list(queryset.query.extra.keys())
+    rows = list(queryset.values_list('id', *extra))
+    pks = [row[0] for row in rows]
+    locations = {}
+    snapshot = current_snapshot() if use_snapshot else None
+    if snapshot is not None:
+        locations = snapshot.locations(pks)
+    missing = [pk for pk in pks if pk not in locations]
+    if missing:
+        locations.update(Location.objects.get_many_cached(missing))
+    results = []
+    for row in rows:
+        location = locations[row[0]]
+        for name, value in zip(extra, row[1:]):
+            setattr(location, name, value)
+        results.append(location)
+    return results
+
+
 class LocationListView(ListView):
     """
     A view to list and search available locations. It allows filtering by:
@@ -27,6 +105,10 @@ class LocationListView(ListView):
 
     It also provides the results in JSON if that format is specified.
 
+    With the `facets` parameter, or `LOCATIONS_SEARCH_FACETS`, the state,
+    category and city counts of the filtered results are added to the
+    context as `facets`, and the JSON response becomes an object with the
+    `locations` and their `facets`.
     """
     context_object_name = 'locations'
 
@@ -55,6 +137,11 @@ class LocationListView(ListView):
         url_params = url_params.copy() # Make it mutable
         url_params.pop('page', None) # Get rid of any page references
         context["url_params"] = url_params.urlencode()
+        context["postal_code"] = snapped_postal_code(
+                url_params.get('geo_query'))
+        # The page's rendered location cards, mostly from the cache
+        locations = list(context["object_list"])
+        context["location_cards"] = zip(locations, render_cards(locations))
         return context
 
     def get_queryset(self, querydict, **kwargs):
@@ -73,7 +160,11 @@ class LocationListView(ListView):
         sort = querydict.get('sort', None)
         limit = querydict.get('limit', None)
         if geo_query:
-            queryset = Location.objects.geosearch(geo_query).filter(is_active=True)
+            # Filtered results are ranked among all the locations
+            exact = bool(city_filter or state_filter or postal_filter or
+                    search_query or category_filter)
+            queryset = Location.objects.geosearch(geo_query,
+                    exact=exact).filter(is_active=True)
             sort = 'distance' if not sort else 'name'
         if city_filter:
             queryset = queryset.filter(city=city_filter)
@@ -86,12 +177,14 @@ class LocationListView(ListView):
                     Q(street_address__icontains=search_query) |
                     Q(city__icontains=search_query)))
         if category_filter:
-            queryset = queryset.filter(category__id__in=category_filter)
+            queryset = filter_categories(queryset, category_filter)
         try:
             limit = int(limit)
         except TypeError:
             # [:None] evaluates to the entire list
             limit = None
+        # The whole filtered result set, for the facet counts
+        self.filtered_queryset = queryset
         sort = sort if sort else 'name'
         queryset = queryset.select_related('category')
         # Make sure we do not try to sort distance outside of the select extra,
@@ -111,30 +204,101 @@ class LocationListView(ListView):
         return False
 
     def get(self, request, *args, **kwargs):
+        """
+        Returns the HTML or JSON response. The search, category and rendering
+        phases are timed when instrumentation is enabled.
+        """
         use_json = self.is_ajax_request(request)
-        self.object_list = self.get_queryset(request.GET, **kwargs)
-        context = self.get_context_data(object_list=self.object_list,
-                query_dict=request.GET)
-        if use_json:
-            locations = [{
-                "id": location.id,
-                "name": location.name,
-                "street_address": location.street_address,
-                "city": location.city,
-                "postal_code": location.postal_code,
-                "categories": [{
-                    "id": category.id,
-                    "name": category.name,
-                    "slug": category.slug,
-                    } for category in location.category.all()],
-                "distance": getattr(location, 'distance', None),
-                "latlng": location.float_point(),
-                } for location in self.object_list]
-            response = HttpResponse(content_type="application/json")
-            response.content = json.dumps(locations)
-            return response
-        else:
-            return self.render_to_response(context)
+        if use_json and not [key for key in request.GET if key != 'format']:
+            snapshot = snapshot_url('json')
+            if snapshot:
+                return HttpResponseRedirect(snapshot)
+        with instrumentation.recording() as timings:
+            self.object_list = self.get_queryset(request.GET, **kwargs)
+            facets = None
+            if request.GET.get('facets') or conf.SEARCH_FACETS:
+                facets = cached_facet_counts(self.filtered_queryset,
+                        request.GET)
+            if use_json:
+                with instrumentation.phase('locations'):
+                    self.object_list = cached_locations(self.object_list,
+                            use_snapshot=True)
+                with instrumentation.phase('categories'):
+                    categories = [(location, location.cached_categories)
+                            for location in self.object_list]
+                with instrumentation.phase('serialize'):
+                    response = HttpResponse(content_type="application/json")
+                    data = location_dicts(categories)
+                    if facets is not None:
+                        data = {'locations': data, 'facets': facets}
+                    response.content = json.dumps(data)
+            else:
+                with instrumentation.phase('context'):
+                    context = self.get_context_data(
+                            object_list=self.object_list,
+                            query_dict=request.GET, facets=facets)
+                with instrumentation.phase('render'):
+                    response = self.render_to_response(context)
+                    if timings:
+                        response.render()
+        return instrumentation.add_server_timing(response, timings)
+
+
+class LocationDetailView(DetailView):
+    """
+    Shows a public location, read through the object cache.
+    """
+    model = Location
+    context_object_name = "location"
+
+    def get_object(self, queryset=None):
+        try:
+            location = Location.objects.get_cached(self.kwargs['pk'])
+        except Location.DoesNotExist:
+            raise Http404
+        if not location.is_active:
+            raise Http404
+        return location
+
+
+class LocationBatchSearchView(View):
+    """
+    Returns the locations nearest to many query points at once as JSON, an
+    object mapping each query to its list of locations, nearest first. See
+    `LocationManager.geosearch_many`. Parameters:
+
+        * q - a postal code or "latitude,longitude", repeated for each query
+          point, at most `max_queries`
+        * k - the number of locations per query, at most `max_k`
+    """
+    max_queries = 100
+    max_k = 50
+
+    def get(self, request, *args, **kwargs):
+        queries = [query.strip() for query in request.GET.getlist('q')
+                if query.strip()]
+        try:
+            k = int(request.GET.get('k', 10))
+        except ValueError:
+            return HttpResponseBadRequest(u"k must be an integer")
+        if not queries or len(queries) > self.max_queries:
+            return HttpResponseBadRequest(
+                    u"Send between 1 and %s queries" % self.max_queries)
+        if not 1 <= k <= self.max_k:
+            return HttpResponseBadRequest(
+                    u"k must be between 1 and %s" % self.max_k)
+        with instrumentation.recording() as timings:
+            results = Location.objects.geosearch_many(queries, k)
+            with instrumentation.phase('categories'):
+                categories = location_categories(set([location.pk for
+                    locations in results.values() for location in locations]))
+            with instrumentation.phase('serialize'):
+                response = HttpResponse(content_type="application/json")
+                response.content = json.dumps(dict([(query,
+                    location_dicts([(location, categories[location.pk])
+                        for location in locations]))
+                    for query, locations in results.items()]))
+        return instrumentation.add_server_timing(response, timings)
 
 
 class LocationKMLFeed(ListView):
@@ -146,10 +310,110 @@ class LocationKMLFeed(ListView):
     template_name = "locations/location_list.xml"
 
     def get(self, request, *args, **kwargs):
-        self.object_list = self.get_queryset()
-        context = self.get_context_data(object_list=self.object_list)
-        return self.render_to_response(context,
-                **{'content_type':"application/vnd.google-earth.kml+xml"})
+        snapshot = snapshot_url('kml')
+        if snapshot:
+            return HttpResponseRedirect(snapshot)
+        with instrumentation.recording() as timings:
+            with instrumentation.phase('locations'):
+                self.object_list = cached_locations(self.get_queryset())
+            with instrumentation.phase('render'):
+                context = self.get_context_data(object_list=self.object_list)
+                response = self.render_to_response(context,
+                        **{'content_type':"application/vnd.google-earth.kml+xml"})
+                if timings:
+                    response.render()
+        return instrumentation.add_server_timing(response, timings)
+
+
+class LocationClusterView(View):
+    """
+    Returns the public locations within a bounding box as JSON, aggregated in
+    clusters with their counts at low zoom levels and as individual points at
+    high zoom levels. Expects the parameters:
+
+        * bbox - west,south,east,north in degrees
+        * zoom - the map zoom level
+
+    and optionally filters by `category` and `state`, like the list view.
+    """
+    def get(self, request, *args, **kwargs):
+        try:
+            west, south, east, north = [float(value) for value in
+                    request.GET.get('bbox', '').split(',')]
+            zoom = int(request.GET.get('zoom', ''))
+            result = clusters(west, south, east, north, zoom,
+                    categories=request.GET.getlist('category'),
+                    states=request.GET.getlist('state'))
+        except (ValueError, ClusterError), e:
+            return HttpResponseBadRequest(u"%s" % e)
+        response = HttpResponse(content_type="application/json")
+        response.content = json.dumps(result)
+        return response
+
+
+class LocationExportView(View):
+    """
+    Serves the complete list of public locations in the compact columnar
+    export format, see `locations.export`. Parameters:
+
+        * format - `json` (default) or `binary`
+        * precision - `32` for float32 coordinates in the binary format
+        * generation - the generation the client already holds; if it is
+          still current the response is a 304 Not Modified
+
+    The generation is also sent as the ETag and `X-Locations-Generation`
+    headers.
+    """
+    content_types = {
+        'json': "application/json",
+        'binary': "application/octet-stream",
+    }
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get('format', 'json')
+        if format not in self.content_types:
+            return HttpResponseBadRequest(u"Unknown format %s" % format)
+        float_size = 4 if request.GET.get('precision') == '32' else 8
+        etag = '"%s"' % Location.objects.current_version()
+        if request.GET.get('generation') == etag.strip('"') or \
+                request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+        generation, payload = export.export(format, float_size)
+        response = HttpResponse(payload,
+                content_type=self.content_types[format])
+        response['ETag'] = '"%s"' % generation
+        response['X-Locations-Generation'] = str(generation)
+        return response
+
+
+class LocationChangesView(View):
+    """
+    Streams the changes to locations made after a given version as JSON, see
+    `locations.changes`. Parameters:
+
+        * since - the last version the client has seen; omit it to fetch
+          every location
+        * after - the last id seen within that version, when the previous
+          response was cut short by the limit
+        * limit - the maximum number of changes, at most `max_limit`
+    """
+    max_limit = 5000
+    batch_size = 500
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = int(request.GET.get('since', -1))
+            after = request.GET.get('after')
+            after = int(after) if after else None
+            limit = min(int(request.GET.get('limit', self.max_limit)),
+                    self.max_limit)
+        except ValueError:
+            return HttpResponseBadRequest(
+                    u"since, after and limit must be integers")
+        if since < -1 or limit < 1:
+            return HttpResponseBadRequest(u"Invalid since or limit")
+        return HttpResponse(change_stream(since, after, limit,
+            self.batch_size), content_type="application/json")
 
 
 class LocationGeoSitemap(TemplateView):
@@ -171,11 +435,69 @@ class LocationGeoSitemap(TemplateView):
         }
 
     def get(self, request, *args, **kwargs):
+        snapshot = snapshot_url('sitemap')
+        if snapshot:
+            return HttpResponseRedirect(snapshot)
         context = self.get_context_data(**kwargs)
         return self.render_to_response(context,
                 **{'content_type':'application/xml'})
 
 
+class LocationSitemapIndex(View):
+    """
+    Serves the sitemap index listing the sitemap chunks of the location
+    detail pages, see `locations.sitemaps`, and the geo sitemap when it is
+    installed as `location_sitemap`.
+    """
+    def get(self, request, *args, **kwargs):
+        from django.contrib.sites.models import Site
+        etag = '"%s"' % Location.objects.current_version()
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+        chunks = sitemap_chunks()
+        sitemaps = [(reverse('location_sitemap_chunk',
+            kwargs={'chunk': chunk}), lastmod) for chunk, count, lastmod in
+            chunks]
+        try:
+            sitemaps.append((reverse('location_sitemap'), None))
+        except NoReverseMatch:
+            pass
+        response = HttpResponse(render_to_string(
+            "locations/sitemap_index.xml", {
+                'site': Site.objects.get_current(),
+                'sitemaps': sitemaps,
+            }), content_type="application/xml")
+        response['ETag'] = etag
+        if chunks:
+            response['Last-Modified'] = http_date(time.mktime(
+                max([lastmod for chunk, count, lastmod in chunks]).timetuple()))
+        return response
+
+
+class LocationSitemap(View):
+    """
+    Serves a sitemap chunk of the location detail pages with its ETag and
+    Last-Modified headers, see `locations.sitemaps`.
+    """
+    def get(self, request, *args, **kwargs):
+        from django.contrib.sites.models import Site
+        chunk = int(kwargs['chunk'])
+        for chunk_stats in sitemap_chunks():
+            if chunk_stats[0] == chunk:
+                break
+        else:
+            raise Http404
+        etag = chunk_etag(*chunk_stats)
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+        response = HttpResponse(render_chunk(Site.objects.get_current(),
+            *chunk_stats), content_type="application/xml")
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(time.mktime(
+            chunk_stats[2].timetuple()))
+        return response
+
+
 class CsvUpload(FormView):
     """
     A view class used in the admin area to upload and process a CSV file with
@@ -210,7 +532,8 @@ class CsvUpload(FormView):
         # probably needs to make a stringio object out of it
         csv_file = form.cleaned_data['csv_file']
         category = form.cleaned_data['category']
-        csv_results = locations_from_csv(csv_file, category)
+        csv_results = locations_from_csv(csv_file, category,
+                sync=form.cleaned_data['sync'])
         if csv_results['errors']:
             messages.add_message(request, messages.ERROR, 'There was an error.')
         else:
@@ -220,6 +543,10 @@ class CsvUpload(FormView):
             if csv_results['skipped_count']:
                 messages.add_message(request, messages.WARNING,
                         "%s duplicates skipped" % csv_results['skipped_count'])
+            if csv_results['deactivated_count']:
+                messages.add_message(request, messages.WARNING,
+                        "%s missing locations deactivated" %
+                        csv_results['deactivated_count'])
         if "_edit" in request.POST:
             if csv_results['created_count'] == 0:
                 messages.add_message(request, messages.WARNING,